@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+测量import耗时，每个模块都在新的解释器里import，避免缓存影响
+
+    python benchmark/bench_import.py -o import.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+MODULES = [
+    "pygetex.config",
+    "pygetex.core",
+    "pygetex.handler.http",
+    "pygetex.handler.ftp",
+    "pygetex.handler.sftp",
+    "pygetex.downloader.aiohttpdownloader",
+    "pygetex.downloader.aioftpdownloader",
+    "pygetex.downloader.asyncsshdownloader",
+]
+HEAVY_MODULES = ["aiohttp", "aioftp", "asyncssh", "cryptography", "httpx"]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_once(module: str) -> Dict:
+    """
+    在子进程里import一次，返回耗时(秒)和顺带import进来的重量级依赖
+    :param module:
+    :return:
+    """
+    code = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "cost = time.perf_counter() - start\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps({'seconds': cost, 'heavy': heavy}))\n"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def bench_import(modules: List[str], repeat: int = 5) -> Dict[str, Dict]:
+    results = {}
+    for module in modules:
+        try:
+            runs = [import_once(module) for _ in range(repeat)]
+        except subprocess.CalledProcessError as e:
+            results[module] = {"error": e.stderr.strip().splitlines()[-1]}
+            continue
+        seconds = [run["seconds"] for run in runs]
+        results[module] = {
+            "median_ms": statistics.median(seconds) * 1000,
+            "min_ms": min(seconds) * 1000,
+            "heavy": runs[0]["heavy"],
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pygetex import time benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", default=None, help="write json here")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args()
+    results = bench_import(args.modules, args.repeat)
+    data = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data)
+    print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+吞吐量benchmark，只打benchmark/servers.py起的本地服务器
+
+矩阵: 协议/downloader x 文件大小 x split x fileio，每个场景在新的子进程里跑，
+这样峰值内存和CPU时间只算这一个场景的。结果写成json，--compare可以和之前的结果对比
+
+    python benchmark/bench_throughput.py --sizes 1M,64M --splits 4,16 -o new.json
+    python benchmark/bench_throughput.py --protocols http --latency 0.05 --compare old.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, astuple, dataclass
+from typing import Dict, List, Optional, cast
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None  # type: ignore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pygetex.config import Config
+from pygetex.core import CoreProcess
+from pygetex.plugin import PluginBase
+
+import servers  # isort: skip
+
+DOWNLOADERS = {
+    "http": {
+        "aiohttp": "pygetex.downloader.aiohttpdownloader.AIOHTTPDownloader",
+        "httpx": "pygetex.downloader.httpxdownloader.HTTPXDownloader",
+        "curl": "pygetex.downloader.curldownloader.CURLDownloader",
+        "curlmulti": "pygetex.downloader.curldownloader.CURLMultiDownloader",
+    },
+    "h2": {"h2": "pygetex.downloader.h2downloader.H2Downloader"},
+    "ftp": {"aioftp": "pygetex.downloader.aioftpdownloader.AIOFTPDownloader"},
+    "sftp": {"asyncssh": "pygetex.downloader.asyncsshdownloader.SFTPDownloader"},
+}
+CONFIG_KEYS = {
+    "http": "http_downloader",
+    "h2": "http_downloader",
+    "ftp": "ftp_downloader",
+    "sftp": "sftp_downloader",
+}
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+@dataclass
+class Scenario:
+    protocol: str
+    downloader: str
+    size: int
+    split: int
+    fileio: str
+    files: int
+    workers: int = 0
+
+    @property
+    def key(self) -> str:
+        return "/".join(map(str, astuple(self)))
+
+
+class BenchPlugin(PluginBase):
+    name = "benchmark"
+
+    def __init__(self, core: "CoreProcess"):
+        self.done = {}  # type: Dict[int, float]
+        self.errors = {}  # type: Dict[int, str]
+
+    async def on_download_complete(self, taskid: int):
+        self.done[taskid] = time.perf_counter()
+
+    async def on_download_error(self, taskid: int, e: Exception, tb: str):
+        self.errors[taskid] = repr(e)
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+def remote_name(size: int) -> str:
+    return f"bench-{size}.bin"
+
+
+def scenario_uris(scenario: Scenario, ports: Dict[str, int]) -> List[str]:
+    port = ports[scenario.protocol]
+    name = remote_name(scenario.size)
+    if scenario.protocol in ("http", "h2"):
+        return [
+            f"http://127.0.0.1:{port}/files/{scenario.size}/{index}-{name}"
+            for index in range(scenario.files)
+        ]
+    return [f"{scenario.protocol}://127.0.0.1:{port}/{name}"] * scenario.files
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes on macos, KiB elsewhere
+        return rss / 1024**2
+    return rss / 1024
+
+
+def cpu_seconds() -> float:
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def verify_file(path: str, size: int) -> bool:
+    if os.path.getsize(path) != size:
+        return False
+    with open(path, "rb") as f:
+        offset = 0
+        while data := f.read(len(servers.BLOCK)):
+            if data != servers.payload(offset, len(data)):
+                return False
+            offset += len(data)
+    return True
+
+
+async def _run_scenario(scenario: Scenario, uris: List[str], verify: bool) -> Dict:
+    downloader = DOWNLOADERS[scenario.protocol][scenario.downloader]
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Config(
+            database=f"sqlite+aiosqlite:///{tmp}/bench.db",
+            dir=tmp,
+            fileio=scenario.fileio,  # type: ignore
+            split=scenario.split,
+            username="bench",
+            password="bench",
+            known_hosts=None,
+            workers=scenario.workers,
+            http2_prior_knowledge=True,
+            **{CONFIG_KEYS[scenario.protocol]: downloader},  # type: ignore
+        )
+        async with CoreProcess(config) as process:
+            plugin = cast(BenchPlugin, process.plugins[BenchPlugin.name])
+            cpu_start = cpu_seconds()
+            start = time.perf_counter()
+            added = await asyncio.gather(
+                *(process.add_uri(uri) for uri in uris), return_exceptions=True
+            )
+            tasks = [
+                task for result in added if isinstance(result, list) for task in result
+            ]
+            add_errors = [
+                repr(result) for result in added if isinstance(result, BaseException)
+            ]
+            await process.wait()
+            while len(plugin.done) + len(plugin.errors) < len(tasks):
+                await asyncio.sleep(0.001)  # on_download_complete是在后台dispatch的
+            seconds = time.perf_counter() - start
+            cpu = cpu_seconds() - cpu_start
+            completed = [task for task in tasks if task.id in plugin.done]
+            corrupted = 0
+            if verify:
+                corrupted = sum(
+                    not verify_file(task.path, scenario.size) for task in completed
+                )
+        total = len(completed) * scenario.size
+        latencies = [plugin.done[task.id] - start for task in completed]
+        return {
+            "scenario": asdict(scenario),
+            "seconds": seconds,
+            "bytes": total,
+            "mb_per_s": total / seconds / 1e6 if seconds else None,
+            "files_per_s": len(completed) / seconds if seconds else None,
+            "cpu_seconds_per_gb": cpu / (total / 1e9) if total else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "p50_latency": percentile(latencies, 0.5),
+            "p99_latency": percentile(latencies, 0.99),
+            "completed": len(completed),
+            "corrupted": corrupted,
+            "errors": add_errors + list(plugin.errors.values()),
+        }
+
+
+def run_scenario(scenario: Scenario, uris: List[str], verify: bool) -> Dict:
+    """子进程入口"""
+    return asyncio.run(_run_scenario(scenario, uris, verify))
+
+
+def build_matrix(args) -> List[Scenario]:
+    scenarios = []
+    for protocol in args.protocols:
+        for downloader in DOWNLOADERS[protocol]:
+            if args.downloaders and downloader not in args.downloaders:
+                continue
+            for size in args.sizes:
+                for split in args.splits:
+                    for fileio in args.fileio:
+                        for workers in args.workers:
+                            scenarios.append(
+                                Scenario(
+                                    protocol,
+                                    downloader,
+                                    size,
+                                    split,
+                                    fileio,
+                                    args.files,
+                                    workers,
+                                )
+                            )
+    return scenarios
+
+
+def compare(old: Dict, new: Dict) -> None:
+    old_results = {Scenario(**r["scenario"]).key: r for r in old["results"]}
+    print(f"{'scenario':<60} {'old MB/s':>10} {'new MB/s':>10} {'delta':>8}")
+    for result in new["results"]:
+        key = Scenario(**result["scenario"]).key
+        before = old_results.get(key, {}).get("mb_per_s")
+        after = result["mb_per_s"]
+        if before and after:
+            delta = f"{(after - before) / before * 100:+.1f}%"
+        else:
+            delta = "n/a"
+        print(f"{key:<60} {before or 0:>10.1f} {after or 0:>10.1f} {delta:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pygetex throughput benchmark")
+    parser.add_argument(
+        "--protocols",
+        type=lambda s: s.split(","),
+        default=["http", "h2", "ftp", "sftp"],
+    )
+    parser.add_argument("--downloaders", type=lambda s: s.split(","), default=None)
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [parse_size(i) for i in s.split(",")],
+        default=[parse_size("1M"), parse_size("64M")],
+    )
+    parser.add_argument(
+        "--splits", type=lambda s: [int(i) for i in s.split(",")], default=[4, 16]
+    )
+    parser.add_argument(
+        "--fileio",
+        type=lambda s: s.split(","),
+        default=["mmapio", "sysio", "generalio"],
+    )
+    parser.add_argument(
+        "--files", type=int, default=4, help="concurrent tasks per scenario"
+    )
+    parser.add_argument(
+        "--workers",
+        type=lambda s: [int(i) for i in s.split(",")],
+        default=[0],
+        help="worker processes, 0 means single process",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="server first byte delay in seconds"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=parse_size,
+        default=None,
+        help="per connection cap, bytes/second",
+    )
+    parser.add_argument("--fault-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--max-streams", type=int, default=100, help="h2 server concurrent streams"
+    )
+    parser.add_argument("--timeout", type=float, default=300.0, help="per scenario")
+    parser.add_argument("--verify", action="store_true", help="check downloaded bytes")
+    parser.add_argument(
+        "--with-import", action="store_true", help="include import time benchmark"
+    )
+    parser.add_argument("-o", "--output", default=None, help="write json here")
+    parser.add_argument("--compare", default=None, help="previous json result")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    scenarios = build_matrix(args)
+    output = {
+        "meta": {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "time": time.time(),
+            "args": {
+                k: v for k, v in vars(args).items() if k not in ("output", "compare")
+            },
+        },
+        "results": [],
+    }  # type: Dict
+    if args.with_import:
+        import bench_import
+
+        output["import"] = bench_import.bench_import(bench_import.MODULES, 3)
+
+    with tempfile.TemporaryDirectory() as root:
+        options = servers.ServerOptions(
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            fault_rate=args.fault_rate,
+            max_streams=args.max_streams,
+            files={remote_name(size): size for size in args.sizes},
+        )
+        queue = ctx.Queue()
+        server = ctx.Process(
+            target=servers.serve_forever,
+            args=(root, options, args.protocols, queue),
+            daemon=True,
+        )
+        server.start()
+        try:
+            ports = queue.get(timeout=120)
+            if isinstance(ports, BaseException):
+                raise ports
+            for scenario in scenarios:
+                for _ in range(args.repeat):
+                    executor = ProcessPoolExecutor(1, mp_context=ctx)
+                    future = executor.submit(
+                        run_scenario,
+                        scenario,
+                        scenario_uris(scenario, ports),
+                        args.verify,
+                    )
+                    try:
+                        result = future.result(args.timeout)
+                    except Exception as e:
+                        result = {
+                            "scenario": asdict(scenario),
+                            "mb_per_s": None,
+                            "errors": [repr(e)],
+                        }
+                    finally:
+                        # with语句退出会一直等卡住的子进程，超时的时候直接杀掉
+                        children = list(executor._processes.values())  # type: ignore
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        if not future.done():
+                            for child in children:
+                                child.terminate()
+                    output["results"].append(result)
+                    print(
+                        f"{scenario.key:<60} {result['mb_per_s'] or 0:>10.1f} MB/s"
+                        f" {result.get('files_per_s') or 0:>8.1f} files/s"
+                        f" errors={len(result['errors'])}",
+                        flush=True,
+                    )
+        finally:
+            server.terminate()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
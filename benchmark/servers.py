@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+本地的协议替身，benchmark只打本机，不受外网波动影响
+
+http: GET /files/{size}/{name}，内容是确定的伪随机字节，支持Range和HEAD，
+      可以配置首包延迟、每个连接的带宽上限和故障注入
+h2:   明文HTTP/2(h2c，需要prior knowledge)，路径和http一样，可以限制每条连接的并发stream数
+ftp:  aioftp.Server，匿名登录
+sftp: asyncssh服务端，任意用户名密码都能登录
+"""
+import asyncio
+import os
+import random
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+BLOCK = random.Random(0).randbytes(64 * 1024)  # 所有文件都由这块数据重复构成
+re_range = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def payload(offset: int, count: int) -> bytes:
+    """
+    文件[offset, offset+count)的内容，benchmark可以拿来校验下载结果
+    """
+    ret = bytearray()
+    while count > 0:
+        start = offset % len(BLOCK)
+        chunk = BLOCK[start : start + count]
+        ret.extend(chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+    return bytes(ret)
+
+
+def write_file(path: str, size: int) -> None:
+    with open(path, "wb") as f:
+        offset = 0
+        while offset < size:
+            count = min(len(BLOCK), size - offset)
+            f.write(payload(offset, count))
+            offset += count
+
+
+@dataclass
+class ServerOptions:
+    latency: float = 0.0  # 每个请求的首包延迟 秒
+    bandwidth: Optional[int] = None  # 每个连接 bytes/second
+    fault_rate: float = 0.0  # 每个请求出故障的概率，一半返回503，一半传到一半断开
+    write_size: int = 64 * 1024
+    seed: int = 0
+    max_streams: int = 100  # h2服务器每条连接允许的并发stream
+    files: Dict[str, int] = field(
+        default_factory=dict
+    )  # ftp和sftp用的文件 name -> size
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    if not header:
+        return None
+    m = re_range.match(header)
+    if m is None:
+        return None
+    start, end = m.group(1), m.group(2)
+    if start == "":  # bytes=-500
+        return max(size - int(end), 0), size - 1
+    return int(start), min(int(end), size - 1) if end else size - 1
+
+
+async def start_http_server(
+    host: str, port: int, options: ServerOptions
+) -> Tuple[Any, int]:
+    from aiohttp import web
+
+    rnd = random.Random(options.seed)
+
+    async def handle_file(request: "web.Request") -> "web.StreamResponse":
+        size = int(request.match_info["size"])
+        name = request.match_info["name"]
+        if options.latency:
+            await asyncio.sleep(options.latency)
+        fault = rnd.random() < options.fault_rate
+        if fault and rnd.random() < 0.5:
+            raise web.HTTPServiceUnavailable()
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Content-Disposition": f'attachment; filename="{name}"',
+        }
+        byte_range = parse_range(request.headers.get("Range"), size)
+        if byte_range is None:
+            status, start, end = 200, 0, size - 1
+        else:
+            status, (start, end) = 206, byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        resp = web.StreamResponse(status=status, headers=headers)
+        resp.content_length = end - start + 1
+        await resp.prepare(request)
+        if request.method == "HEAD":
+            return resp
+        offset = start
+        abort_at = start + (end - start + 1) // 2 if fault else None
+        while offset <= end:
+            count = min(options.write_size, end - offset + 1)
+            if abort_at is not None and offset + count > abort_at:
+                request.transport.close()  # type: ignore
+                return resp
+            try:
+                await resp.write(payload(offset, count))
+            except ConnectionError:  # 客户端拿到header就关掉连接是正常的
+                return resp
+            offset += count
+            if options.bandwidth:
+                await asyncio.sleep(count / options.bandwidth)
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/files/{size}/{name}", handle_file)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]  # type: ignore
+
+
+re_file_path = re.compile(r"^/files/(\d+)/([^/?]+)")
+
+
+async def start_h2_server(
+    host: str, port: int, options: ServerOptions
+) -> Tuple[Any, int]:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+
+    rnd = random.Random(options.seed)
+
+    async def handle_connection(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        conn.local_settings = h2.settings.Settings(
+            client=False,
+            initial_values={
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: options.max_streams
+            },
+        )
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        window_updated = asyncio.Event()
+        senders = set()  # type: set
+
+        def flush():
+            if data := conn.data_to_send():
+                writer.write(data)
+
+        async def send_body(stream_id: int, start: int, end: int, fault: bool):
+            offset = start
+            abort_at = start + (end - start + 1) // 2 if fault else None
+            try:
+                while offset <= end:
+                    window = min(
+                        conn.local_flow_control_window(stream_id),
+                        conn.max_outbound_frame_size,
+                    )
+                    if window <= 0:
+                        window_updated.clear()
+                        await window_updated.wait()
+                        continue
+                    count = min(window, options.write_size, end - offset + 1)
+                    if abort_at is not None and offset + count > abort_at:
+                        conn.reset_stream(stream_id)
+                        flush()
+                        return
+                    conn.send_data(stream_id, payload(offset, count))
+                    flush()
+                    offset += count
+                    await writer.drain()
+                    if options.bandwidth:
+                        await asyncio.sleep(count / options.bandwidth)
+                conn.end_stream(stream_id)
+                flush()
+            except (h2.exceptions.StreamClosedError, ConnectionError):
+                pass
+
+        async def handle_request(stream_id: int, headers: Dict[str, str]):
+            if options.latency:
+                await asyncio.sleep(options.latency)
+            m = re_file_path.match(headers[":path"])
+            if m is None:
+                conn.send_headers(stream_id, [(":status", "404")], end_stream=True)
+                flush()
+                return
+            size, name = int(m.group(1)), m.group(2)
+            fault = rnd.random() < options.fault_rate
+            if fault and rnd.random() < 0.5:
+                conn.send_headers(stream_id, [(":status", "503")], end_stream=True)
+                flush()
+                return
+            response_headers = [
+                ("accept-ranges", "bytes"),
+                ("content-disposition", f'attachment; filename="{name}"'),
+            ]
+            byte_range = parse_range(headers.get("range"), size)
+            if byte_range is None:
+                status, start, end = 200, 0, size - 1
+            else:
+                status, (start, end) = 206, byte_range
+                response_headers.append(
+                    ("content-range", f"bytes {start}-{end}/{size}")
+                )
+            response_headers.append(("content-length", str(end - start + 1)))
+            head = headers[":method"] == "HEAD"
+            conn.send_headers(
+                stream_id,
+                [(":status", str(status))] + response_headers,
+                end_stream=head,
+            )
+            flush()
+            if not head:
+                await send_body(stream_id, start, end, fault)
+
+        try:
+            while data := await reader.read(65536):
+                for event in conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        task = asyncio.create_task(
+                            handle_request(event.stream_id, dict(event.headers))
+                        )
+                        senders.add(task)
+                        task.add_done_callback(senders.discard)
+                    elif isinstance(event, h2.events.DataReceived):
+                        conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id
+                        )
+                    elif isinstance(
+                        event, (h2.events.WindowUpdated, h2.events.StreamReset)
+                    ):
+                        window_updated.set()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                flush()
+        except (ConnectionError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            for task in senders:
+                task.cancel()
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def start_ftp_server(
+    host: str, port: int, root: str, options: ServerOptions
+) -> Tuple[Any, int]:
+    import aioftp  # type: ignore
+    from aioftp.server import ConnectionConditions, PathConditions  # type: ignore
+
+    class SizeServer(aioftp.Server):
+        """aioftp的服务端没有SIZE命令，FTPDownloader要靠它拿文件大小"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.commands_mapping["size"] = self.size
+
+        @ConnectionConditions(ConnectionConditions.login_required)
+        @PathConditions(PathConditions.path_must_exists)
+        async def size(self, connection, rest) -> bool:
+            real_path, virtual_path = self.get_paths(connection, rest)
+            stat = await connection.path_io.stat(real_path)
+            connection.response("213", str(stat.st_size))
+            return True
+
+    server = SizeServer(
+        [aioftp.User(base_path=root, home_path="/")],
+        write_speed_limit_per_connection=options.bandwidth,  # 服务端往外写才是下载
+    )
+    await server.start(host, port)
+    return server, server.server.sockets[0].getsockname()[1]
+
+
+async def start_sftp_server(host: str, port: int, root: str) -> Tuple[Any, int]:
+    import asyncssh
+
+    class NoAuthServer(asyncssh.SSHServer):
+        def begin_auth(self, username: str) -> bool:
+            return True
+
+        def password_auth_supported(self) -> bool:
+            return True
+
+        def validate_password(self, username: str, password: str) -> bool:
+            return True
+
+    server = await asyncssh.create_server(
+        NoAuthServer,
+        host,
+        port,
+        server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+        sftp_factory=lambda chan: asyncssh.SFTPServer(chan, chroot=root.encode()),
+    )
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def serve(
+    root: str, options: ServerOptions, protocols: List[str], host: str = "127.0.0.1"
+) -> Dict[str, int]:
+    """
+    启动所有需要的服务器，返回 protocol -> port
+    """
+    for name, size in options.files.items():
+        path = os.path.join(root, name)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            write_file(path, size)
+    ports = {}
+    if "http" in protocols:
+        _, ports["http"] = await start_http_server(host, 0, options)
+    if "h2" in protocols:
+        _, ports["h2"] = await start_h2_server(host, 0, options)
+    if "ftp" in protocols:
+        _, ports["ftp"] = await start_ftp_server(host, 0, root, options)
+    if "sftp" in protocols:
+        _, ports["sftp"] = await start_sftp_server(host, 0, root)
+    return ports
+
+
+def serve_forever(root: str, options: ServerOptions, protocols: List[str], queue):
+    """
+    multiprocessing的入口，端口号通过queue告诉父进程，服务器和被测进程分开，不占被测进程的CPU
+    """
+
+    async def main():
+        try:
+            ports = await serve(root, options, protocols)
+        except Exception as e:
+            queue.put(e)
+            raise
+        queue.put(ports)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
-from copy import deepcopy
 from pathlib import Path
-from typing import Literal, Optional
+from typing import Any, Dict, List, Literal, Optional, Tuple, cast
 
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -29,6 +28,137 @@ class Config(BaseSettings):
     update_interval: Optional[float] = Field(
         5.0, description="update interval in seconds"
     )  # statscollector更新间隔
+    plugin_timeout: Optional[float] = Field(
+        None, description="default timeout in seconds for each plugin hook"
+    )
+    coalesce: bool = Field(
+        True, description="attach duplicate uris to the running download"
+    )
+    coalesce_link: Literal["reflink", "hardlink", "copy"] = Field(
+        "reflink", description="how duplicates get the finished file"
+    )
+    cache_dir: Optional[str] = Field(
+        None, description="content cache of finished downloads, None to disable"
+    )
+    cache_size: int = Field(
+        10 * 1024 * 1024 * 1024, description="max bytes kept in the content cache"
+    )
+    cache_link: Literal["reflink", "hardlink", "copy"] = Field(
+        "reflink", description="how files move in and out of the content cache"
+    )
+    cache_ttl: Optional[float] = Field(
+        None,
+        description="seconds a cached file is used without asking the origin, None for ever",
+    )
+    cache_revalidate: bool = Field(
+        False, description="ask the origin with a conditional request before every hit"
+    )
+    max_concurrent_downloads: int = Field(
+        0, description="downloads running at the same time, 0 for no limit"
+    )
+    schedule_policy: Literal["fifo", "srpt"] = Field(
+        "fifo", description="order within a priority: added first or fewest bytes left"
+    )
+    expand_concurrency: int = Field(
+        8, description="running downloads per expanded uri, e.g. an ftp directory"
+    )
+    postprocess_workers: int = Field(
+        2, description="processes running post-processing steps of finished tasks"
+    )
+    workers: int = Field(
+        0, description="worker processes for block downloading, 0 to disable"
+    )
+    node_id: Optional[str] = Field(
+        None, description="enable cluster mode, unique name of this node"
+    )
+    lease_ttl: float = Field(
+        30, description="seconds before a dead node's tasks are taken over"
+    )
+    lease_heartbeat: float = Field(
+        10, description="renew leases and look for unclaimed tasks this often"
+    )
+    cluster_max_tasks: int = Field(
+        0, description="max tasks this node downloads in cluster mode, 0 for unlimited"
+    )
+    event_loop: str = Field(
+        "asyncio",
+        description="asyncio, uvloop or path of an EventLoopPolicy, used by pygetex.core.loop.run",
+    )
+    loop_monitor_interval: Optional[float] = Field(
+        0.1, description="measure event loop lag this often, None to disable"
+    )
+    loop_slow_threshold: float = Field(
+        0.1, description="capture the loop thread stack when it blocks this long"
+    )
+    metrics_host: Optional[str] = Field(
+        "127.0.0.1", description="address of the OpenMetrics endpoint"
+    )
+    metrics_port: Optional[int] = Field(
+        None, description="serve OpenMetrics on this port, None to disable"
+    )
+    peer_host: str = Field(
+        "127.0.0.1",
+        description="address to serve pieces to peers, set it to the LAN address explicitly",
+    )
+    peer_port: Optional[int] = Field(
+        None, description="serve downloaded pieces to other nodes, None to disable"
+    )
+    peers: List[str] = Field(
+        default_factory=list,
+        description="host:port of other nodes to fetch pieces from",
+    )
+    peer_token: Optional[str] = Field(
+        None, description="shared secret peers send to each other"
+    )
+    peer_allow: List[str] = Field(
+        default_factory=list,
+        description="addresses or networks allowed to fetch pieces, like 10.0.0.0/24",
+    )
+    peer_trust: bool = Field(
+        False, description="use peer data even if the task has no piece hashes"
+    )
+    peer_piece_size: int = Field(
+        1024 * 1024, description="bytes per peer request when there are no piece hashes"
+    )
+    peer_timeout: float = Field(5, description="timeout of a request to a peer")
+    event_interval: float = Field(
+        0.5, description="push progress to event subscribers this often"
+    )
+    event_queue_size: int = Field(
+        1000, description="events buffered per subscriber before dropping old ones"
+    )
+    cleanup_workers: int = Field(
+        2, description="threads for removing temp files in background"
+    )
+    small_file_size: int = Field(
+        1024 * 1024, description="files up to this size are fetched with one request"
+    )
+    sequential: bool = Field(
+        False, description="download the lowest offsets first, for open_stream"
+    )
+    decompress: Optional[Literal["auto", "gzip", "xz", "zstd"]] = Field(
+        None, description="decompress .gz/.xz/.zst while downloading"
+    )
+    stream_piece_size: int = Field(
+        4 * 1024 * 1024, description="piece size of sequential downloads"
+    )
+    stream_poll_interval: float = Field(
+        0.05, description="how often open_stream checks for new bytes"
+    )
+    dns_ttl: float = Field(60, description="seconds to cache resolved addresses")
+    dns_negative_ttl: float = Field(5, description="seconds to cache failed lookups")
+    dns_hosts: Dict[str, List[str]] = Field(
+        {}, description="pin host names to these ips, skip DNS"
+    )
+    dns_spread: bool = Field(
+        False, description="rotate A records so blocks connect to different ips"
+    )
+    happy_eyeballs_delay: Optional[float] = Field(
+        0.25, description="start the next address after this many seconds"
+    )
+    metalink_mirrors: int = Field(
+        4, description="max mirrors per file taken from a metalink manifest"
+    )
     split: int = Field(
         16, description="block count for large file downloading"
     )  # 默认下载线程数
@@ -50,8 +180,47 @@ class Config(BaseSettings):
     )
 
 
+class ConfigView:
+    """
+    全局config上面叠一层任务自己的选项，只读
+
+    不复制全局config，change_global_option改了全局config这里马上能看到，
+    叠在别的ConfigView上面也可以，比如任务上面再叠block的选项
+    """
+
+    __slots__ = ("_base", "_overrides")
+
+    def __init__(self, base: "Config | ConfigView", overrides: Dict[str, Any]):
+        object.__setattr__(self, "_base", base)
+        object.__setattr__(self, "_overrides", overrides)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):  # unpickle的时候_base还没有，不然会一直递归
+            raise AttributeError(name)
+        try:
+            return self._overrides[name]
+        except KeyError:
+            return getattr(self._base, name)
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return type(self), (self._base, self._overrides)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self._base!r}, {self._overrides!r})"
+
+    def model_dump(self) -> Dict[str, Any]:
+        return {**self._base.model_dump(), **self._overrides}
+
+
 def update_config(config: Config, **options) -> Config:
-    temp_config = deepcopy(config)
-    for name, value in options.items():
-        setattr(temp_config, name, value)
-    return temp_config
+    """
+    :param config: 全局config或者另一个ConfigView
+    :param options: 这个任务自己的选项
+    :return: 没有选项的时候就是config本身
+    """
+    if not options:
+        return config
+    return cast(Config, ConfigView(config, options))
@@ -1,59 +1,204 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from functools import partial
 from itertools import chain
-from typing import Any, Dict, List, Set
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlmodel import and_, func, or_, select
+import orjson
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import SQLModel, and_, delete, func, or_, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from pygetex import __version__
 from pygetex.config import Config
+from pygetex.core.cache import CacheEntry, ContentCache
+from pygetex.core.cluster import ClusterNode, LeaseError
+from pygetex.core.events import Event, EventHub
+from pygetex.core.loop import LoopMonitor
+from pygetex.core.metrics import CoreMetrics, MetricsServer
+from pygetex.core.paths import PathRegistry
+from pygetex.core.peer import PeerClient, PeerServer
+from pygetex.core.postprocess import DONE_OPTION, PostProcessor
+from pygetex.core.scheduler import SCHEDULE_OPTIONS, Scheduler
 from pygetex.core.statscollector import StatsCollector
-from pygetex.handler import HandlerBase, HandlerMeta
-from pygetex.handler.ftp import FTPHandler
-from pygetex.handler.http import HTTPHandler  # load this handler
-from pygetex.handler.sftp import SFTPHandler
+from pygetex.core.stream import TaskStream
+from pygetex.core.workers import WorkerPool
+from pygetex.fileio.utils import clone_file, prepare_paths, remove_tempfiles
+from pygetex.handler import ExpandedFile, HandlerBase, HandlerMeta, get_lazy_handlers
 from pygetex.plugin import PluginBase, PluginMeta
-from pygetex.task import DownloadTask
+from pygetex.task import DownloadTask, TaskLease
+from pygetex.utils.dns import get_resolver
+from pygetex.utils.misc import load_object, normalize_uri
+
+Hook = Tuple[str, Callable, Optional[float]]  # plugin name, bound method, timeout
 
 
 class CoreProcess:
     def __init__(self, config: Config):
         self.config = config
-        self.db = create_async_engine(config.database, echo=config.debug)
+        self._db = None  # type: Optional[AsyncEngine]
+        self._db_ready = False  # 第一次访问数据库的时候才建表
+        self._db_lock = asyncio.Lock()
         self.handlers = {}  # type: Dict[str, HandlerBase]
+        self._lazy_handlers = get_lazy_handlers()  # type: Dict[str, str]
+        # scheme -> handler的导入路径，第一次遇到这个scheme的uri才import
         self.plugins = {}  # type: Dict[str, PluginBase]
         self.collector = StatsCollector(self)  # type: ignore
+        self.metrics = CoreMetrics(self)
+        self._metrics_server = None  # type: Optional[MetricsServer]
+        self.peer_server = (
+            None
+        )  # type: Optional[PeerServer]  # 设置了config.peer_port才有
+        self.peers = (
+            PeerClient(self) if config.peers else None
+        )  # type: Optional[PeerClient] # 下载之前先问局域网里的节点
+        self.workers = None  # type: Optional[WorkerPool]  # config.workers > 0才有
+        self.cache = None  # type: Optional[ContentCache]  # 设置了config.cache_dir才有
+        if config.cache_dir:
+            self.cache = ContentCache(self, config.cache_dir, config.cache_size)
         for name, plugin_tp in PluginMeta.plugins.items():
             self.plugins[name] = plugin_tp(self)  # type: ignore
         for name, handler_tp in HandlerMeta.handlers.items():
             self.handlers[name] = handler_tp(self)  # type: ignore
         self._pending_tasks = {}  # type: Dict[int, asyncio.Task]
         self._dispatch_tasks = set()  # type: Set[asyncio.Task]
+        self._cleanup_executor = ThreadPoolExecutor(
+            max_workers=config.cleanup_workers, thread_name_prefix="pygetex-cleanup"
+        )  # 删除临时文件之类的磁盘操作放到后台线程
+        self._cleanup_futures = set()  # type: Set[asyncio.Future]
+        self._hooks = {}  # type: Dict[str, List[Hook]]
+        # funcname -> hooks 只包含启用了的plugin
+        self._nowait_hooks = {}  # type: Dict[str, List[Hook]]
+        # 同上，但去掉了实现了funcname_batch的plugin，它们走批量通道
+        self._batched_events = {}  # type: Dict[str, List[tuple]]
+        # funcname -> 这一轮事件循环里攒下的参数
+        self._rebuild_hooks()
+        self.paths = PathRegistry()  # 分配不重名的保存路径
+        self.scheduler = Scheduler(self)  # 排队的任务谁先下载
+        self.postprocessor = PostProcessor(self)  # 下载完成之后的校验解压移动
+        get_resolver().configure(config)  # 所有downloader共用的DNS缓存
+        self.loop_monitor = LoopMonitor(self)  # 事件循环被卡住了多久
+        self.event_hub = EventHub(self)  # 推给events()的订阅者
+        self.cluster = (
+            ClusterNode(self) if config.node_id else None
+        )  # type: Optional[ClusterNode] # 几个节点共用数据库的时候靠租约分任务
+        self._insert_queue = []  # type: List[Tuple[List[DownloadTask], asyncio.Future]]
+        self._insert_flusher = None  # type: Optional[asyncio.Task]
+        self._inflight = {}  # type: Dict[str, Tuple[DownloadTask, str]]
+        # coalesce key -> 正在下载的task和它的文件名，重复添加的uri挂到它上面
         self._complete_event = asyncio.Event()
         self._complete_event.set()
 
     def enable_plugin(self, name: str):
         if name in self.plugins:
             self.plugins[name].enabled = True
+            self._rebuild_hooks()
 
     def disable_plugin(self, name: str):
         if name in self.plugins:
             self.plugins[name].enabled = False
+            self._rebuild_hooks()
+
+    def _rebuild_hooks(self) -> None:
+        """
+        plugin启用或者禁用之后重新计算hook表，dispatch的时候就不用再getattr了
+        :return:
+        """
+        self._hooks.clear()
+        self._nowait_hooks.clear()
+        for plugin in self.plugins.values():
+            if plugin.enabled:
+                for funcname in dir(plugin):
+                    if funcname.startswith("on_"):
+                        self._get_hooks(funcname)
+
+    def _get_hooks(self, funcname: str, nowait: bool = False) -> List[Hook]:
+        table = self._nowait_hooks if nowait else self._hooks
+        if (hooks := table.get(funcname)) is not None:
+            return hooks
+        hooks = []
+        for name, plugin in self.plugins.items():
+            if not plugin.enabled:
+                continue
+            method = getattr(plugin, funcname, None)
+            if not (callable(method) and asyncio.iscoroutinefunction(method)):
+                continue
+            if nowait and asyncio.iscoroutinefunction(
+                getattr(plugin, funcname + "_batch", None)
+            ):
+                continue
+            timeout = getattr(plugin, "timeout", None)
+            if timeout is None:
+                timeout = self.config.plugin_timeout
+            hooks.append((name, method, timeout))
+        table[funcname] = hooks
+        return hooks
 
     def get_plugins(self) -> List[str]:
         return list(self.plugins.keys())
 
+    @property
+    def db(self) -> AsyncEngine:
+        if self._db is None:
+            self._db = create_async_engine(
+                self.config.database, echo=self.config.debug  # type: ignore
+            )
+        return self._db
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[AsyncSession]:
+        """
+        所有数据库访问都走这里，第一次访问时才创建表
+        :return:
+        """
+        if not self._db_ready:
+            async with self._db_lock:
+                if not self._db_ready:
+                    async with self.db.begin() as conn:
+                        await conn.run_sync(SQLModel.metadata.create_all)
+                    self._db_ready = True
+        with self.metrics.db_seconds.labels().time():
+            async with AsyncSession(self.db) as session:
+                yield session
+
+    def _load_handler(self, uri: str) -> None:
+        """
+        按uri的scheme加载对应的handler，没用到的协议就不会import aiohttp asyncssh之类的
+        :param uri:
+        :return:
+        """
+        scheme = uri.split(":", 1)[0].lower()
+        path = self._lazy_handlers.pop(scheme, None)
+        if path is None:
+            return
+        handler_tp = load_object(path)
+        name = getattr(handler_tp, "name", None) or handler_tp.__name__
+        if name not in self.handlers:
+            self.handlers[name] = handler_tp(self)
+
     async def _check_handler(self, uri: str) -> List[HandlerBase]:
         """
         哪些handler可以处理uri
         :param uri:
         :return:
         """
+        self._load_handler(uri)
         tasks = []
         all_handlers = []
         for handler in self.handlers.values():
@@ -75,52 +220,456 @@ class CoreProcess:
         results = await self.dispatch(
             "on_add_uri", uri, **options
         )  # plugin handle this
-        results_filtered = set(
-            filter(lambda x: x is not None, chain(*results.values()))
-        )  # type: Set[str]
-        uris = list(results_filtered) if results_filtered else [uri]
+        returned = [
+            x for x in chain(*filter(None, results.values())) if x is not None
+        ]  # 超时的plugin返回None
+        uris = list(
+            dict.fromkeys(x for x in returned if not isinstance(x, ExpandedFile))
+        )  # type: List[str]
+        if not returned:
+            uris = [uri]
 
         download_tasks = []  # type: List[DownloadTask]
-        async with AsyncSession(self.db) as session:
-            for uri in uris:
-                handlers = await self._check_handler(uri)
-                if handlers:
-                    filesize, filename, support_range = await handlers[
-                        0
-                    ].get_file_metadata(uri, **options)
-                    path = os.path.join(
-                        options.get("dir", None) or self.config.dir, filename
-                    )
-                    while os.path.exists(path):
-                        dir_, ext = os.path.splitext(path)
-                        path = dir_ + "(1)" + ext
-                    download_task = DownloadTask(
-                        uri=uri,
-                        filesize=filesize,
-                        path=path,
-                        support_range=support_range,
-                        options=options,
-                        start_time=datetime.now(
-                            tz=timezone(timedelta(hours=self.config.timezone_offset))  # type: ignore
+        if expanded := [x for x in returned if isinstance(x, ExpandedFile)]:
+            download_tasks.extend(await self._add_plugin_files(expanded, options))
+        for uri in uris:
+            key = self._coalesce_key(uri, options)
+            if entry := await self._lookup_cache(key, uri, options):  # 以前下载过
+                download_task = await self._add_cached(entry, uri, options)
+                download_tasks.append(download_task)
+                continue
+            if (
+                self.config.coalesce
+                and key in self._inflight
+                and not options.get("postprocess")  # primary的文件可能已经被处理掉了
+                and not options.get("decompress")
+            ):
+                primary, filename = self._inflight[key]
+                download_task = await self._add_follower(
+                    primary, filename, uri, options
+                )
+                download_tasks.append(download_task)
+                continue
+            handlers = await self._check_handler(uri)
+            if (
+                handlers
+                and (expanded := await handlers[0].expand(uri, **options)) is not None
+            ):  # 目录之类的，一次展开成很多任务
+                download_tasks.extend(
+                    await self._add_expanded(handlers[0], expanded, options)
+                )
+                continue
+            if handlers:
+                filesize, filename, support_range = await handlers[0].get_file_metadata(
+                    uri, **options
+                )
+                path = self.paths.reserve(
+                    options.get("dir", None) or self.config.dir, filename
+                )
+                download_task = DownloadTask(
+                    uri=uri,
+                    filesize=filesize,
+                    path=path,
+                    support_range=support_range,
+                    options=options,
+                    start_time=datetime.now(
+                        tz=timezone(timedelta(hours=self.config.timezone_offset))  # type: ignore
+                    ),
+                    status="downloading",
+                )
+
+                await self._insert_tasks([download_task])
+
+                aiotask = asyncio.create_task(
+                    self._run_task(
+                        download_task,
+                        self.scheduler.run(
+                            download_task, partial(handlers[0].handle, download_task)
                         ),
-                        status="downloading",
                     )
+                )
+                self._pending_tasks[download_task.id] = aiotask  # type: ignore
+                self._inflight[key] = (download_task, filename)
+                aiotask.add_done_callback(
+                    partial(self._forget_inflight, key=key, taskid=download_task.id)
+                )
+                aiotask.add_done_callback(
+                    partial(self._on_download_task_complete, taskid=download_task.id)
+                )
+                download_tasks.append(download_task)
+                self.dispatch_nowait("on_download_start", download_task.id)
+                self._complete_event.clear()  # 现在不是处于完成状态了
+        return download_tasks  # 下载results_new的东西
+
+    async def submit_uri(self, uri: str, **options) -> DownloadTask:
+        """
+        只探测元数据写进数据库，不在本地下载。
+        集群模式下由有空的节点领取，单机模式下次启动的时候断点续传
+        :param uri:
+        :param options:
+        :return:
+        """
+        handlers = await self._check_handler(uri)
+        if not handlers:
+            raise ValueError(f"no handler for {uri}")
+        filesize, filename, support_range = await handlers[0].get_file_metadata(
+            uri, **options
+        )
+        download_task = DownloadTask(
+            uri=uri,
+            filesize=filesize,
+            path=self.paths.reserve(
+                options.get("dir", None) or self.config.dir, filename
+            ),
+            support_range=support_range,
+            options=options,
+            start_time=self._now(),
+            status="downloading",
+        )
+        await self._insert_tasks([download_task])
+        if self.cluster is not None:
+            self.cluster.wake()
+        return download_task
 
-                    session.add(download_task)
-                    await session.commit()
-                    await session.refresh(download_task)
+    async def cluster_status(self) -> List[Dict[str, Any]]:
+        """
+        集群里所有任务的租约和进度，owner是None表示没有节点在下载
+        """
+        if self.cluster is None:
+            return []
+        return await self.cluster.status()
 
-                    aiotask = asyncio.create_task(handlers[0].handle(download_task))
-                    self._pending_tasks[download_task.id] = aiotask  # type: ignore
-                    aiotask.add_done_callback(
-                        partial(
-                            self._on_download_task_complete, taskid=download_task.id
-                        )
+    async def _add_plugin_files(
+        self, files: List[ExpandedFile], options: dict
+    ) -> List[DownloadTask]:
+        """
+        plugin直接给出了元数据的文件，按scheme分给handler批量创建，不再探测
+        :param files:
+        :param options: 用来确定下载目录
+        :return:
+        """
+        groups = {}  # type: Dict[str, List[ExpandedFile]]
+        for file in files:
+            groups.setdefault(file.uri.split(":", 1)[0].lower(), []).append(file)
+        download_tasks = []  # type: List[DownloadTask]
+        for group in groups.values():
+            handlers = await self._check_handler(group[0].uri)
+            if not handlers:
+                print(f"no handler for {group[0].uri}, skip {len(group)} files")
+                continue
+            download_tasks.extend(await self._add_expanded(handlers[0], group, options))
+        return download_tasks
+
+    async def _add_expanded(
+        self,
+        handler: HandlerBase,
+        files: List[ExpandedFile],
+        options: dict,
+    ) -> List[DownloadTask]:
+        """
+        批量创建展开出来的任务，一次commit，同时下载的数量不超过expand_concurrency
+        :param handler: 展开uri的handler，也由它下载
+        :param files:
+        :param options: 用来确定下载目录
+        :return:
+        """
+        base = options.get("dir", None) or self.config.dir
+        download_tasks = []  # type: List[DownloadTask]
+        for file in files:
+            path = os.path.join(base, file.path)
+            self.paths.claim(path)
+            download_tasks.append(
+                DownloadTask(
+                    uri=file.uri,
+                    filesize=file.filesize,
+                    path=path,
+                    support_range=file.support_range,
+                    options=(
+                        {**file.options, "resume_offset": file.offset}
+                        if file.offset
+                        else file.options
+                    ),
+                    start_time=self._now(),
+                    status="downloading",
+                )
+            )
+        if not download_tasks:
+            return download_tasks
+        await asyncio.get_running_loop().run_in_executor(
+            self._cleanup_executor,
+            prepare_paths,
+            [
+                download_task.path
+                for download_task, file in zip(download_tasks, files)
+                if not file.offset  # 只追加了内容的文件保留已有的部分
+            ],
+        )
+        await self._insert_tasks(download_tasks)
+
+        semaphore = asyncio.Semaphore(self.config.expand_concurrency)
+        for download_task in download_tasks:
+            aiotask = asyncio.create_task(
+                self._run_task(
+                    download_task, self._run_limited(handler, semaphore, download_task)
+                )
+            )
+            self._pending_tasks[download_task.id] = aiotask  # type: ignore
+            aiotask.add_done_callback(
+                partial(self._on_download_task_complete, taskid=download_task.id)
+            )
+            self.dispatch_nowait("on_download_start", download_task.id)
+        self._complete_event.clear()
+        return download_tasks
+
+    async def _run_limited(
+        self,
+        handler: HandlerBase,
+        semaphore: asyncio.Semaphore,
+        download_task: DownloadTask,
+    ) -> None:
+        self.collector.task_add(download_task.id, [[0, -1]])  # type: ignore # 排队的时候也能暂停
+        async with semaphore:
+            await self.scheduler.run(
+                download_task, partial(handler.handle, download_task)
+            )
+
+    async def _run_task(
+        self, download_task: DownloadTask, download: Awaitable, processed: int = 0
+    ) -> None:
+        """
+        每个任务的aiotask，下载完了再跑后处理，都成功了才算完成
+        :param download_task:
+        :param download: 下载的协程
+        :param processed: 后处理已经做完了几步
+        :return:
+        """
+        if self.cluster is not None and not await self.cluster.acquire(
+            download_task.id  # type: ignore
+        ):
+            if asyncio.iscoroutine(download):
+                download.close()
+            raise LeaseError(f"task {download_task.id} is owned by another node")
+        await download
+        if steps := (download_task.options or {}).get("postprocess"):
+            await self.postprocessor.run(download_task, steps, processed)
+
+    async def _insert_tasks(self, download_tasks: List[DownloadTask]) -> None:
+        """
+        插入新任务并拿到id。并发的add_uri攒成一批，一个事务写进去，
+        前一批还在写的时候到达的任务等它写完一起进下一批
+        :param download_tasks:
+        :return:
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._insert_queue.append((download_tasks, future))
+        if self._insert_flusher is None:
+            self._insert_flusher = asyncio.create_task(self._flush_inserts())
+        await future
+
+    async def _flush_inserts(self) -> None:
+        try:
+            while self._insert_queue:
+                batch, self._insert_queue = self._insert_queue, []
+                try:
+                    async with self.session() as session:
+                        for download_tasks, _ in batch:
+                            session.add_all(download_tasks)
+                        await session.flush()  # 拿到id
+                        for download_tasks, _ in batch:
+                            for download_task in download_tasks:
+                                session.expunge(download_task)  # commit之后属性不会过期
+                        await session.commit()
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._insert_flusher = None
+
+    async def _lookup_cache(
+        self, key: str, uri: str, options: dict
+    ) -> Optional[CacheEntry]:
+        """
+        缓存里有，并且没过期或者源站确认过没变的才能用，变了的删掉重新下载
+        :param key: _coalesce_key
+        :param uri:
+        :param options:
+        :return:
+        """
+        if self.cache is None or options.get("no_cache"):
+            return None
+        if (entry := await self.cache.get(key)) is None or self.cache.fresh(entry):
+            return entry
+        handlers = await self._check_handler(uri)
+        if (
+            handlers
+            and (entry.etag or entry.last_modified)
+            and await handlers[0].revalidate(
+                uri, entry.etag, entry.last_modified, **options
+            )
+        ):
+            await self.cache.touch(key)
+            return entry
+        await self.cache.discard(key)
+        return None
+
+    @staticmethod
+    def _coalesce_key(uri: str, options: dict) -> str:
+        """
+        uri相同，影响下载内容的options也相同，才算同一个下载，dir只影响保存位置
+        """
+        options = {
+            k: v for k, v in options.items() if k != "dir" and k not in SCHEDULE_OPTIONS
+        }
+        return (
+            normalize_uri(uri)
+            + " "
+            + orjson.dumps(options, option=orjson.OPT_SORT_KEYS).decode()
+        )
+
+    def _forget_inflight(self, aiotask: asyncio.Task, key: str, taskid: int) -> None:
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight[0].id == taskid:  # 可能已经换成别的task了
+            del self._inflight[key]
+
+    async def _add_follower(
+        self,
+        primary: DownloadTask,
+        filename: str,
+        uri: str,
+        options: dict,
+    ) -> DownloadTask:
+        """
+        重复添加的uri不再下载，等primary下载完复制一份
+        :param primary: 正在下载的task
+        :param filename: primary的文件名
+        :param uri:
+        :param options:
+        :return:
+        """
+        return await self._add_local_task(
+            uri,
+            options,
+            filename,
+            primary.filesize,
+            primary.support_range,
+            partial(self._follow, primary),
+        )
+
+    async def _add_cached(
+        self, entry: CacheEntry, uri: str, options: dict
+    ) -> DownloadTask:
+        """
+        缓存里有的uri直接从缓存复制出来
+        :param entry: 缓存里的记录
+        :param uri:
+        :param options:
+        :return:
+        """
+        return await self._add_local_task(
+            uri,
+            options,
+            entry.filename,
+            entry.size,
+            entry.support_range,
+            partial(self._materialize, entry),
+        )
+
+    async def _add_local_task(
+        self,
+        uri: str,
+        options: dict,
+        filename: str,
+        filesize: Optional[int],
+        support_range: bool,
+        run: Callable[[DownloadTask], Any],
+    ) -> DownloadTask:
+        """
+        创建一个不直接调用handler的task，follower和缓存命中都走这里
+        :param uri:
+        :param options:
+        :param filename:
+        :param filesize:
+        :param support_range:
+        :param run: run(download_task)返回这个task的协程
+        :return:
+        """
+        path = self.paths.reserve(options.get("dir", None) or self.config.dir, filename)
+        download_task = DownloadTask(
+            uri=uri,
+            filesize=filesize,
+            path=path,
+            support_range=support_range,
+            options=options,
+            start_time=self._now(),
+            status="downloading",
+        )
+        await self._insert_tasks([download_task])
+
+        aiotask = asyncio.create_task(self._run_task(download_task, run(download_task)))
+        self._pending_tasks[download_task.id] = aiotask  # type: ignore
+        aiotask.add_done_callback(
+            partial(self._on_download_task_complete, taskid=download_task.id)
+        )
+        self.dispatch_nowait("on_download_start", download_task.id)
+        self._complete_event.clear()
+        return download_task
+
+    async def _materialize(
+        self, entry: CacheEntry, download_task: DownloadTask
+    ) -> None:
+        """
+        缓存命中的aiotask，复制失败了(比如刚好被淘汰)就正常下载
+        """
+        self.collector.task_add(download_task.id, [[0, -1]])  # type: ignore # 占坑
+        try:
+            method = await self.cache.materialize(  # type: ignore
+                entry, download_task.path, self.config.cache_link
+            )
+        except OSError:
+            pass
+        else:
+            self.metrics.cache_hits.labels(method).inc()
+            self.collector.task_add(
+                download_task.id, [[entry.size, entry.size - 1]]  # type: ignore
+            )
+            return
+        handlers = await self._check_handler(download_task.uri)
+        await handlers[0].handle(download_task)
+
+    async def _follow(self, primary: DownloadTask, download_task: DownloadTask) -> None:
+        """
+        follower的aiotask，和handler.handle一样会被pause stop cancel
+        primary下载完成就复制文件，primary出错或者被暂停停止了就自己下载
+        """
+        self.collector.task_add(download_task.id, [[0, -1]])  # type: ignore # 占坑
+        if (aiotask := self._pending_tasks.get(primary.id)) is not None:  # type: ignore
+            await asyncio.wait([aiotask])  # 不直接await，它被cancel不代表自己被cancel
+            if not aiotask.cancelled() and aiotask.exception() is None:
+                loop = asyncio.get_running_loop()
+                try:
+                    method = await loop.run_in_executor(
+                        self._cleanup_executor,
+                        clone_file,
+                        primary.path,
+                        download_task.path,
+                        self.config.coalesce_link,
                     )
-                    download_tasks.append(download_task)
-                    self.dispatch_nowait("on_download_start", download_task.id)
-                    self._complete_event.clear()  # 现在不是处于完成状态了
-        return download_tasks  # 下载results_new的东西
+                except OSError:  # primary的文件已经被删了之类的
+                    pass
+                else:
+                    self.metrics.coalesced.labels(method).inc()
+                    filesize = download_task.filesize or 0
+                    self.collector.task_add(
+                        download_task.id, [[filesize, filesize - 1]]  # type: ignore
+                    )
+                    return
+        handlers = await self._check_handler(download_task.uri)
+        await handlers[0].handle(download_task)
 
     def _on_download_task_complete(self, aiotask: asyncio.Task, taskid: int) -> None:
         if (
@@ -132,7 +681,7 @@ class CoreProcess:
             self._dispatch_tasks.add(tmp_task)
             tmp_task.add_done_callback(self._dispatch_tasks.discard)
             self.dispatch_nowait("on_download_complete", taskid)
-        self._pending_tasks.pop(taskid)  # type: ignore
+        self._pending_tasks.pop(taskid, None)  # type: ignore # stop可能已经pop过了
         if not self._pending_tasks:
             self._complete_event.set()  # 现在处于完成状态
 
@@ -149,15 +698,45 @@ class CoreProcess:
         self.dispatch_nowait("on_download_stop", taskid)
 
     async def remove(self, taskid: int):
-        await self.stop(taskid)
-        async with AsyncSession(self.db) as session:
-            download_task = (
+        if not await self.remove_many([taskid]):
+            raise ValueError(f"no task with id {taskid}")
+
+    async def remove_many(self, taskids: Iterable[int]) -> int:
+        """
+        批量删除任务，一条DELETE ... WHERE id IN (...)搞定，不再逐个select再delete
+        :param taskids:
+        :return: 实际删除的行数
+        """
+        taskids = list(set(taskids))
+        if not taskids:
+            return 0
+        cancelled = []
+        for taskid in taskids:
+            if aiotask := self._pending_tasks.pop(taskid, None):
+                aiotask.cancel()
+                cancelled.append(aiotask)
+        await asyncio.gather(*cancelled, return_exceptions=True)
+        for taskid in taskids:
+            self.collector.task_discard(taskid)
+        async with self.session() as session:
+            paths = (
                 await session.exec(
-                    select(DownloadTask).where(DownloadTask.id == taskid)
+                    select(DownloadTask.path).where(DownloadTask.id.in_(taskids))  # type: ignore
                 )
-            ).one()  # 反正都删除了，就不设置status为stopped了
-            await session.delete(download_task)
+            ).all()
+            result = await session.exec(
+                delete(DownloadTask).where(DownloadTask.id.in_(taskids))  # type: ignore
+            )  # 反正都删除了，就不设置status为stopped了
+            await session.exec(
+                delete(TaskLease).where(TaskLease.task_id.in_(taskids))  # type: ignore
+            )
             await session.commit()
+        self._cleanup_nowait(paths)
+        for path in paths:
+            self.paths.release(path)
+        for taskid in taskids:
+            self.dispatch_nowait("on_download_stop", taskid)
+        return result.rowcount
 
     async def pause(self, taskid: int):
         if taskid not in self._pending_tasks:
@@ -181,7 +760,7 @@ class CoreProcess:
     async def unpause(self, taskid: int):
         if taskid in self._pending_tasks:
             raise ValueError(f"task {taskid} is already running")
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             download_task = (
                 await session.exec(
                     select(DownloadTask).where(
@@ -199,7 +778,7 @@ class CoreProcess:
 
     async def unpause_all(self):
         aiotasks = []
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             download_tasks = (
                 await session.exec(
                     select(DownloadTask).where(DownloadTask.status == "paused")
@@ -210,7 +789,7 @@ class CoreProcess:
             await asyncio.gather(*aiotasks)
 
     async def tell_status(self, taskid: int) -> DownloadTask:
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             download_task = (
                 await session.exec(
                     select(DownloadTask).where(DownloadTask.id == taskid)
@@ -220,11 +799,41 @@ class CoreProcess:
                 download_task.speed = self.collector.speed[taskid]  # todo 是否需要返回下载进度？
             return download_task
 
+    def open_stream(
+        self, taskid: int, offset: int = 0, chunk_size: int = 1024 * 1024
+    ) -> TaskStream:
+        """
+        按顺序读任务的文件，不用等下载完，写好了连续的一段就能读到。
+        添加任务的时候加上sequential=True，开头的部分会先下载
+        async for chunk in process.open_stream(taskid): ...
+        :param taskid:
+        :param offset: 从哪里开始读
+        :param chunk_size: 每次最多读多少
+        :return:
+        """
+        return TaskStream(self, taskid, offset, chunk_size)
+
+    async def events(
+        self,
+        filter: Optional[Callable[[Event], bool]] = None,
+        taskids: Optional[Iterable[int]] = None,
+    ) -> AsyncIterator[Event]:
+        """
+        订阅状态变化和进度，不查数据库
+        async for event in process.events(taskids=[taskid]): ...
+        :param filter: 返回False的事件不要
+        :param taskids: 只要这些任务的事件
+        :return:
+        """
+        with self.event_hub.subscribe(filter, taskids) as subscription:
+            async for event in subscription:
+                yield event
+
     async def tell_active(self) -> List[int]:
         return list(self._pending_tasks.keys())
 
     async def tell_paused(self, offset: int, count: int) -> List[int]:
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             download_tasks = (
                 await session.exec(
                     select(DownloadTask)
@@ -236,7 +845,7 @@ class CoreProcess:
             return list(map(lambda x: x.id, download_tasks))
 
     async def tell_stopped(self, offset: int, count: int) -> List[int]:
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             download_tasks = (
                 await session.exec(
                     select(DownloadTask)
@@ -248,7 +857,7 @@ class CoreProcess:
             return list(map(lambda x: x.id, download_tasks))
 
     async def get_option(self, taskid: int) -> dict:
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             download_task = (
                 await session.exec(
                     select(DownloadTask).where(DownloadTask.id == taskid)
@@ -257,7 +866,7 @@ class CoreProcess:
             return download_task.options
 
     async def change_option(self, taskid: int, **options):
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             download_task = (
                 await session.exec(
                     select(DownloadTask).where(DownloadTask.id == taskid)
@@ -268,82 +877,236 @@ class CoreProcess:
             session.add_all(download_task)
             await session.commit()
 
+    async def change_priority(
+        self, taskid: int, priority: int, deadline: Optional[float] = None
+    ) -> None:
+        """
+        修改任务的priority和deadline，排队中的任务马上重新排序，
+        正在下载的任务priority降下来之后可能被排队的任务抢占
+        :param taskid:
+        :param priority: 越大越先下载，默认0
+        :param deadline: 希望在这个unix时间戳之前下载完，None表示没有
+        :return:
+        """
+        async with self.session() as session:
+            download_task = (
+                await session.exec(
+                    select(DownloadTask).where(DownloadTask.id == taskid)
+                )
+            ).one()
+            options = dict(download_task.options or {})
+            options["priority"] = priority
+            if deadline is None:
+                options.pop("deadline", None)
+            else:
+                options["deadline"] = deadline
+            download_task.options = options  # 重启之后排队也用得上
+            session.add(download_task)
+            await session.commit()
+        self.scheduler.update(taskid, priority, deadline)
+
+    async def tell_waiting(self) -> List[int]:
+        """
+        排队还没开始下载的任务，大致按开始的先后
+        :return:
+        """
+        return self.scheduler.tell_waiting()
+
     async def get_global_option(self) -> dict:
         return self.config.model_dump()
 
     async def change_global_option(self, **options):
         for key, value in options.items():
             setattr(self.config, key, value)
+        if "plugin_timeout" in options:
+            self._rebuild_hooks()
+        if any(key.startswith("dns_") for key in options):
+            get_resolver().configure(self.config)
 
-    async def get_global_stat(self):
-        ...
+    async def get_global_stat(self) -> Dict[str, Any]:
+        """
+        全局统计，不查数据库
+        :return:
+        """
+        return {
+            "download_speed": sum(self.collector.speed.values()),
+            "num_active": len(self._pending_tasks),
+            "num_processing": len(self.collector.processing),
+            "loop": self.loop_monitor.stats(),
+            "metrics": self.get_metrics(),
+        }
 
-    async def purge_download_result(self):
-        async with AsyncSession(self.db) as session:
-            download_tasks = (
-                await session.exec(
-                    select(DownloadTask).where(
-                        or_(
-                            DownloadTask.status == "complete",
-                            DownloadTask.status == "error",
-                        )
+    def get_metrics(self) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+        """
+        拉取所有指标 sample name -> [(labels, value)]
+        :return:
+        """
+        return self.metrics.registry.collect()
+
+    async def purge_download_result(
+        self,
+        statuses: Sequence[str] = ("complete", "error"),
+        older_than: Optional[timedelta] = None,
+        batch_size: int = 10000,
+    ) -> int:
+        """
+        清理下载记录，直接在数据库里DELETE ... WHERE status IN (...)，不把行加载进内存
+        :param statuses: 要清理的状态
+        :param older_than: 只清理end_time早于 now - older_than 的记录
+        :param batch_size: 每批交给后台线程删除的临时文件数
+        :return: 删除的行数
+        """
+        condition = DownloadTask.status.in_(statuses)  # type: ignore
+        if older_than is not None:
+            condition = and_(
+                condition,
+                DownloadTask.end_time < self._now() - older_than,  # type: ignore
+            )
+        async with self.session() as session:
+            # complete和stopped的临时文件在结束时就已经删除了，只有剩下的需要清理
+            paths = await session.stream_scalars(
+                select(DownloadTask.path).where(
+                    and_(
+                        condition,
+                        DownloadTask.status.not_in(("complete", "stopped")),  # type: ignore
                     )
                 )
-            ).all()
-            for download_task in download_tasks:
-                await session.delete(download_task)
+            )
+            async for batch in paths.partitions(batch_size):
+                self._cleanup_nowait(batch)
+            result = await session.exec(delete(DownloadTask).where(condition))
             await session.commit()
+        return result.rowcount
+
+    def _cleanup_nowait(self, paths: Sequence[str]) -> None:
+        """
+        在后台线程池里删除断点续传临时文件
+        :param paths: 下载任务的path
+        :return:
+        """
+        if not paths:
+            return
+        future = asyncio.get_running_loop().run_in_executor(
+            self._cleanup_executor,
+            remove_tempfiles,
+            list(paths),
+            self.config.tempfile_suffix,
+        )
+        self._cleanup_futures.add(future)
+        future.add_done_callback(self._cleanup_futures.discard)
+
+    def _now(self) -> datetime:
+        return datetime.now(
+            tz=timezone(timedelta(hours=self.config.timezone_offset))  # type: ignore
+        )
 
     def get_version(self) -> str:
         return __version__
 
     async def dispatch(self, funcname: str, *args, **kwargs) -> Dict[str, Any]:
-        names = []  # type: List[str]
-        tasks = []
-        for name, plugin in self.plugins.items():
-            if plugin.enabled:
-                if method := getattr(plugin, funcname, None):
-                    if callable(method) and asyncio.iscoroutinefunction(method):
-                        tasks.append(method(*args, **kwargs))
-                        names.append(name)
-        results = await asyncio.gather(*tasks)
-        return dict(zip(names, results))
+        hooks = self._get_hooks(funcname)
+        if not hooks:
+            return {}
+        return await self._call_hooks(hooks, args, kwargs)
+
+    async def _call_hooks(self, hooks: List[Hook], args, kwargs) -> Dict[str, Any]:
+        if len(hooks) == 1:
+            name, method, timeout = hooks[0]
+            return {name: await self._call_hook(name, method, timeout, args, kwargs)}
+        results = await asyncio.gather(
+            *(
+                self._call_hook(name, method, timeout, args, kwargs)
+                for name, method, timeout in hooks
+            )
+        )
+        return {hook[0]: result for hook, result in zip(hooks, results)}
+
+    async def _call_hook(
+        self, name: str, method: Callable, timeout: Optional[float], args, kwargs
+    ) -> Any:
+        with self.metrics.plugin_seconds.labels(name, method.__name__).time():
+            if timeout is None:
+                return await method(*args, **kwargs)
+            try:
+                return await asyncio.wait_for(method(*args, **kwargs), timeout)
+            except asyncio.TimeoutError:
+                print(f"plugin {name} {method.__name__} timed out after {timeout}s")
+                return None  # 慢plugin不能拖住add_uri之类的调用
 
     def dispatch_nowait(self, funcname: str, *args, **kwargs) -> None:
         """
         如果不需要返回结果就用这个，直接在后台运行
+        实现了funcname_batch的plugin会在下一轮事件循环收到这一轮攒下的所有args
         :param funcname:
         :param args:
         :param kwargs:
         :return:
         """
-        task = asyncio.create_task(self.dispatch(funcname, *args, **kwargs))
+        self.event_hub.on_hook(funcname, args)
+        if not kwargs and self._get_hooks(funcname + "_batch"):
+            if (events := self._batched_events.get(funcname)) is None:
+                events = self._batched_events[funcname] = []
+                asyncio.get_running_loop().call_soon(self._flush_batch, funcname)
+            events.append(args)
+            hooks = self._get_hooks(funcname, nowait=True)
+        else:
+            hooks = self._get_hooks(funcname)
+        if not hooks:
+            return  # 没有plugin关心这个事件，连task都不用创建
+        self._spawn_dispatch(self._call_hooks(hooks, args, kwargs))
+
+    def _flush_batch(self, funcname: str) -> None:
+        events = self._batched_events.pop(funcname, None)
+        hooks = self._get_hooks(funcname + "_batch")
+        if events and hooks:
+            self._spawn_dispatch(self._call_hooks(hooks, (events,), {}))
+
+    def _spawn_dispatch(self, coro) -> None:
+        task = asyncio.create_task(coro)
         self._dispatch_tasks.add(task)
         task.add_done_callback(self._dispatch_tasks.discard)
 
-    async def _resume_one(self, download_task: DownloadTask) -> None:
-        handlers = await self._check_handler(download_task.uri)
-        if handlers:
-            aiotask = asyncio.create_task(
-                handlers[0].handle(download_task, resume=True)
+    async def _resume_one(
+        self, download_task: DownloadTask, resume: bool = True
+    ) -> None:
+        options = download_task.options or {}
+        if download_task.status != "error" and DONE_OPTION in options:
+            # 已经下载完了，停在后处理中间，从没做完的那一步接着做
+            self.collector.task_add(download_task.id, [[0, -1]])  # type: ignore
+            download = asyncio.sleep(0)  # type: Awaitable
+            processed = options[DONE_OPTION]
+        elif handlers := await self._check_handler(download_task.uri):
+            download = self.scheduler.run(
+                download_task,
+                partial(handlers[0].handle, download_task),
+                resume=resume,
             )
-            self._pending_tasks[download_task.id] = aiotask  # type: ignore
-            aiotask.add_done_callback(
-                partial(self._on_download_task_complete, taskid=download_task.id)
-            )
-            self.dispatch_nowait("on_download_start", download_task.id)
-            self._complete_event.clear()  # 现在不是处于完成状态了
+            processed = 0
+        else:
+            return
+        aiotask = asyncio.create_task(
+            self._run_task(download_task, download, processed)
+        )
+        self._pending_tasks[download_task.id] = aiotask  # type: ignore
+        aiotask.add_done_callback(
+            partial(self._on_download_task_complete, taskid=download_task.id)
+        )
+        self.dispatch_nowait("on_download_start", download_task.id)
+        self._complete_event.clear()  # 现在不是处于完成状态了
 
     async def _resume_tasks(self) -> None:
         """
-        断点续传的逻辑 从数据库中寻找downloading的任务，以resume=True调用handler
+        断点续传的逻辑 从数据库中寻找downloading的任务，以resume=True调用handler，
+        processing的任务接着做后处理
         :return:
         """
         resume_aiotasks: List[asyncio.Task] = []
-        async with AsyncSession(self.db) as session:
+        async with self.session() as session:
             tasks: List[DownloadTask] = (
                 await session.exec(
-                    select(DownloadTask).where(DownloadTask.status == "downloading")
+                    select(DownloadTask).where(
+                        DownloadTask.status.in_(("downloading", "processing"))  # type: ignore
+                    )
                 )
             ).all()
             for download_task in tasks:
@@ -360,12 +1123,58 @@ class CoreProcess:
         await self._complete_event.wait()
 
     async def startup(self):
-        await self._resume_tasks()
+        loop_type = type(asyncio.get_running_loop())
+        if self.config.event_loop == "uvloop" and loop_type.__module__ != "uvloop":
+            print(
+                f"running on {loop_type}, start with pygetex.core.loop.run for uvloop"
+            )
+        if self.config.loop_monitor_interval is not None:
+            self.loop_monitor.start()
+        if self.config.metrics_port is not None:
+            self._metrics_server = MetricsServer(
+                self.metrics.registry,
+                self.config.metrics_host,  # type: ignore
+                self.config.metrics_port,
+            )
+            await self._metrics_server.start()
+        if self.config.peer_port is not None:
+            self.peer_server = PeerServer(
+                self, self.config.peer_host, self.config.peer_port
+            )
+            await self.peer_server.start()
+        if self.config.workers:
+            self.workers = WorkerPool(self.config, self.config.workers)
+            await self.workers.start()
+        if self.cluster is not None:
+            await self.cluster.start()  # downloading的任务可能是别的节点正在下的
+        else:
+            await self._resume_tasks()
         await self.dispatch("on_startup")
 
     async def shutdown(self):
+        if self._metrics_server is not None:
+            await self._metrics_server.close()
+            self._metrics_server = None
+        if self.peer_server is not None:
+            await self.peer_server.close()
+            self.peer_server = None
+        if self.workers is not None:  # 先停worker，拿到最后的进度再保存
+            await self.workers.close()
+            self.workers = None
+        await self.postprocessor.close()  # 正在做的那一步做完，记下后处理的进度
         await self.collector.close()
+        if self.cluster is not None:  # 进度存好了再放掉租约
+            await self.cluster.close()
+        for handler in self.handlers.values():
+            await handler.close()
+        if self.cache is not None:
+            await self.cache.close()  # 还在后台存入缓存的文件
         await self.dispatch("on_shutdown")
+        await self.event_hub.close()  # 订阅者的async for结束
+        await self.loop_monitor.close()
+        if self._cleanup_futures:
+            await asyncio.gather(*self._cleanup_futures, return_exceptions=True)
+        self._cleanup_executor.shutdown(wait=False)
 
     async def __aenter__(self):
         await self.startup()
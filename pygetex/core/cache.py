@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+下载完成的文件的本地内容仓库，同一个资源再下载到别的目录时直接从这里复制，不走网络
+
+内容按sha256存在 cache_dir/objects/ab/abcdef...，cache_entry表记录 任务key -> sha256，
+不同的uri可以指向同一份内容。总大小超过cache_size时按最近访问时间淘汰
+
+设置了cache_ttl或者cache_revalidate的时候，存入时顺便记下源站的ETag和Last-Modified，
+过期了先用条件请求问源站，没变才用缓存，变了就删掉这条重新下载。带no_cache选项的任务不查也不存
+"""
+import asyncio
+import hashlib
+import os
+import time
+from typing import TYPE_CHECKING, List, Optional, Set, Tuple
+
+from sqlmodel import Field, SQLModel, delete, func, select
+
+from pygetex.fileio.utils import clone_file
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class CacheEntry(SQLModel, table=True):
+    __tablename__ = "cache_entry"
+    key: str = Field(..., primary_key=True, description="normalized uri + options")
+    sha256: str = Field(..., index=True)
+    filename: str = Field(..., description="file name when it was downloaded")
+    size: int = Field(...)
+    support_range: bool = Field(...)
+    last_access: float = Field(..., index=True, description="unix timestamp")
+    etag: Optional[str] = Field(None)
+    last_modified: Optional[str] = Field(None)
+    validated: float = Field(
+        0, description="unix timestamp of the last time the origin confirmed it"
+    )
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def store_object(src: str, dst: str, mode: str) -> None:
+    """
+    先复制到临时文件再rename，别的线程不会看到写了一半的object
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        clone_file(src, tmp, mode)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def remove_objects(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+
+
+class ContentCache:
+    def __init__(self, process: "CoreProcess", root: str, capacity: int):
+        self.process = process
+        self.root = root
+        self.capacity = capacity
+        self.ttl = process.config.cache_ttl
+        self.revalidate = process.config.cache_revalidate
+        self._lock = asyncio.Lock()  # put和淘汰串行执行，免得重复计算同一个文件
+        self._tasks = set()  # type: Set[asyncio.Task]
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.process._cleanup_executor, func, *args
+        )
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        """
+        查找key对应的内容，找到了就更新访问时间
+        :param key: CoreProcess._coalesce_key
+        :return:
+        """
+        async with self.process.session() as session:
+            entry = (
+                await session.exec(select(CacheEntry).where(CacheEntry.key == key))
+            ).first()
+            if entry is None:
+                return None
+            if not os.path.exists(self.object_path(entry.sha256)):  # 被外部删了
+                await session.delete(entry)
+                await session.commit()
+                return None
+            entry.last_access = time.time()
+            session.add(entry)
+            await session.commit()
+            await session.refresh(entry)
+            return entry
+
+    def fresh(self, entry: CacheEntry) -> bool:
+        """
+        不用问源站就能直接用
+        """
+        if self.revalidate:
+            return False
+        return self.ttl is None or time.time() - entry.validated <= self.ttl
+
+    @property
+    def expires(self) -> bool:
+        """
+        会不会有过期的时候，不会的话存入时不用记validator
+        """
+        return self.revalidate or self.ttl is not None
+
+    async def touch(self, key: str) -> None:
+        """
+        源站确认过没变
+        """
+        async with self.process.session() as session:
+            entry = (
+                await session.exec(select(CacheEntry).where(CacheEntry.key == key))
+            ).first()
+            if entry is not None:
+                entry.validated = time.time()
+                session.add(entry)
+                await session.commit()
+
+    async def discard(self, key: str) -> None:
+        """
+        源站上变了，这条不能再用，内容没有别的key引用了就一起删掉
+        """
+        async with self._lock:
+            async with self.process.session() as session:
+                entry = (
+                    await session.exec(select(CacheEntry).where(CacheEntry.key == key))
+                ).first()
+                if entry is None:
+                    return
+                sha256 = entry.sha256
+                await session.delete(entry)
+                await session.commit()
+                shared = (
+                    await session.exec(
+                        select(CacheEntry.key).where(CacheEntry.sha256 == sha256)
+                    )
+                ).first()
+            if shared is None:
+                await self._run(remove_objects, [self.object_path(sha256)])
+
+    async def materialize(self, entry: CacheEntry, path: str, mode: str) -> str:
+        """
+        把缓存的内容复制到path
+        :param entry:
+        :param path:
+        :param mode: reflink hardlink copy
+        :return: 实际用的方式
+        """
+        return await self._run(clone_file, self.object_path(entry.sha256), path, mode)
+
+    def put_nowait(
+        self,
+        key: str,
+        path: str,
+        support_range: bool,
+        mode: str = "reflink",
+        source: Optional[Tuple[str, dict, float]] = None,
+    ) -> None:
+        """
+        在后台把下载完成的文件加入缓存
+        """
+        task = asyncio.create_task(self.put(key, path, support_range, mode, source))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_put_done)
+
+    def _on_put_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and (e := task.exception()) is not None:
+            print(f"failed to cache {e!r}")
+
+    async def put(
+        self,
+        key: str,
+        path: str,
+        support_range: bool,
+        mode: str = "reflink",
+        source: Optional[Tuple[str, dict, float]] = None,
+    ) -> None:
+        """
+        计算sha256，内容还没有的话存一份，然后超出容量就淘汰
+        :param key: CoreProcess._coalesce_key
+        :param path: 下载完成的文件
+        :param support_range:
+        :param mode: 存入的方式，hardlink的话以后改下载好的文件会连缓存一起改掉
+        :param source: (uri, options, 开始下载的时间戳)，会过期的缓存用它向源站要validator
+        :return:
+        """
+        validated = time.time()
+        async with self._lock:
+            async with self.process.session() as session:
+                entry = (
+                    await session.exec(select(CacheEntry).where(CacheEntry.key == key))
+                ).first()
+                if entry is not None and os.path.exists(self.object_path(entry.sha256)):
+                    entry.last_access = time.time()
+                    session.add(entry)
+                    await session.commit()
+                    return
+            sha256 = await self._run(hash_file, path)
+            object_path = self.object_path(sha256)
+            if not os.path.exists(object_path):  # 别的uri可能已经存过同样的内容
+                await self._run(store_object, path, object_path, mode)
+            etag = last_modified = None
+            if self.expires and source is not None:
+                uri, options, validated = source  # ttl从开始下载算起
+                if handlers := await self.process._check_handler(uri):
+                    etag, last_modified = await handlers[0].get_validators(
+                        uri, validated, **options
+                    )
+            entry = CacheEntry(
+                key=key,
+                sha256=sha256,
+                filename=os.path.basename(path),
+                size=os.path.getsize(object_path),
+                support_range=support_range,
+                last_access=time.time(),
+                etag=etag,
+                last_modified=last_modified,
+                validated=validated,
+            )
+            async with self.process.session() as session:
+                await session.merge(entry)
+                await session.commit()
+            await self._evict()
+
+    async def _evict(self) -> None:
+        """
+        同一个sha256的多个key算一份大小，按其中最近一次访问排序，从最久没用的开始删
+        """
+        async with self.process.session() as session:
+            rows = (
+                await session.exec(
+                    select(
+                        CacheEntry.sha256,
+                        func.max(CacheEntry.size),
+                        func.max(CacheEntry.last_access),
+                    )
+                    .group_by(CacheEntry.sha256)
+                    .order_by(func.max(CacheEntry.last_access))
+                )
+            ).all()
+            total = sum(size for _, size, _ in rows)
+            victims = []  # type: List[str]
+            for sha256, size, _ in rows:
+                if total <= self.capacity:
+                    break
+                victims.append(sha256)
+                total -= size
+            if not victims:
+                return
+            await session.exec(
+                delete(CacheEntry).where(CacheEntry.sha256.in_(victims))  # type: ignore
+            )
+            await session.commit()
+        await self._run(remove_objects, [self.object_path(i) for i in victims])
+
+    async def close(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+集群模式，几个节点共用一个数据库，谁有空谁下载
+
+每个downloading的任务最多有一个节点持有它的租约(task_lease表)，抢租约是一条带条件的UPDATE，
+行还不存在的时候INSERT，主键冲突说明被别人抢先了，SQLite和Postgres上都是原子的。
+持有者每隔lease_heartbeat续约，顺便写上剩余字节和速度，在哪个节点上都能用cluster_status看进度。
+节点挂了租约lease_ttl秒后过期，别的节点抢过来断点续传；续约失败说明租约已经被抢走，
+马上取消本地的下载，同一个任务不会有两个节点在下。连不上数据库续不了约的时候，
+在下一次心跳之前租约就要过期了也取消本地的下载，免得过期之后别的节点抢过去一起下。
+节点之间比较的是time.time()，时钟要大致同步(误差远小于lease_ttl)
+"""
+
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import or_, select, update
+
+from pygetex.task import DownloadTask, TaskLease
+from pygetex.utils.misc import get_remain_bytes
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+
+class LeaseError(RuntimeError):
+    """租约在别的节点手里"""
+
+
+class ClusterNode:
+    def __init__(self, process: "CoreProcess"):
+        self.process = process
+        self.config = process.config
+        self.node_id = process.config.node_id  # type: str # type: ignore
+        self.owned = set()  # type: Set[int]
+        self._wake = asyncio.Event()
+        self._task = None  # type: Optional[asyncio.Task]
+        self._renewed = time.time()  # 上一次续约成功的时间
+
+    async def start(self) -> None:
+        await self.claim()
+        self._task = asyncio.create_task(self._run())
+
+    def wake(self) -> None:
+        """有新任务了，不用等到下一次心跳"""
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.config.lease_heartbeat)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.heartbeat()
+                await self.claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # 数据库暂时连不上，下次再试
+                print(f"cluster heartbeat failed: {e!r}")
+                await self._check_expired()
+
+    async def _check_expired(self) -> None:
+        """
+        续约失败的时候，租约在下一次心跳之前就过期了的话，停掉本地的下载
+        """
+        expires = self._renewed + self.config.lease_ttl
+        if time.time() + self.config.lease_heartbeat < expires:
+            return
+        for taskid in list(self.owned):
+            print(f"lease of task {taskid} can not be renewed, stop downloading")
+            await self._lost(taskid)
+
+    async def acquire(self, taskid: int) -> bool:
+        """
+        :param taskid:
+        :return: 拿到了租约，或者本来就是自己的
+        """
+        now = time.time()
+        async with self.process.session() as session:
+            result = await session.exec(
+                update(TaskLease)
+                .where(
+                    TaskLease.task_id == taskid,  # type: ignore
+                    or_(
+                        TaskLease.owner == None,  # type: ignore
+                        TaskLease.owner == self.node_id,  # type: ignore
+                        TaskLease.expires < now,  # type: ignore
+                    ),
+                )
+                .values(owner=self.node_id, expires=now + self.config.lease_ttl)
+            )
+            if result.rowcount == 0:  # 没有这一行，或者在别人手里
+                session.add(
+                    TaskLease(
+                        task_id=taskid,
+                        owner=self.node_id,
+                        expires=now + self.config.lease_ttl,
+                    )
+                )
+            try:
+                await session.commit()
+            except IntegrityError:
+                return False
+        self.owned.add(taskid)
+        return True
+
+    async def heartbeat(self) -> None:
+        """
+        续约本地还在跑的任务，续不上的说明被抢走了
+        """
+        pending = self.process._pending_tasks
+        self.owned = {taskid for taskid in self.owned if taskid in pending}
+        # 下载完了或者暂停了就不再续约，status已经不是downloading，过期了也没人抢
+        if not self.owned:
+            self._renewed = time.time()
+            return
+        now = time.time()
+        lost = []
+        collector = self.process.collector
+        async with self.process.session() as session:
+            for taskid in self.owned:
+                split_result = collector._active_tasks.get(taskid)
+                remaining = None  # type: Optional[int]
+                if split_result and split_result[-1][-1] != -1:
+                    remaining = get_remain_bytes(split_result)
+                result = await session.exec(
+                    update(TaskLease)
+                    .where(
+                        TaskLease.task_id == taskid,  # type: ignore
+                        TaskLease.owner == self.node_id,  # type: ignore
+                    )
+                    .values(
+                        expires=now + self.config.lease_ttl,
+                        remaining=remaining,
+                        speed=collector.speed.get(taskid, 0.0),
+                    )
+                )
+                if result.rowcount == 0:
+                    lost.append(taskid)
+            await session.commit()
+        self._renewed = now
+        for taskid in lost:
+            print(f"lease of task {taskid} was taken by another node, stop downloading")
+            await self._lost(taskid)
+
+    async def _lost(self, taskid: int) -> None:
+        self.owned.discard(taskid)
+        if aiotask := self.process._pending_tasks.pop(taskid, None):
+            aiotask.cancel()
+            await asyncio.gather(aiotask, return_exceptions=True)
+        self.process.collector.task_discard(taskid)  # 进度归新的持有者
+
+    async def claim(self) -> None:
+        """
+        领取没人持有或者租约过期了的downloading和processing任务，不超过cluster_max_tasks
+        """
+        pending = self.process._pending_tasks
+        limit = self.config.cluster_max_tasks
+        if limit:
+            limit -= len(pending)
+            if limit <= 0:
+                return
+        now = time.time()
+        query = (
+            select(DownloadTask)
+            .join(
+                TaskLease,
+                TaskLease.task_id == DownloadTask.id,  # type: ignore
+                isouter=True,
+            )
+            .where(
+                DownloadTask.status.in_(("downloading", "processing")),  # type: ignore
+                or_(
+                    TaskLease.task_id == None,  # type: ignore
+                    TaskLease.owner == None,  # type: ignore
+                    TaskLease.expires < now,  # type: ignore
+                ),
+            )
+            .order_by(DownloadTask.id)  # type: ignore
+        )
+        if limit:
+            query = query.limit(limit)
+        async with self.process.session() as session:
+            rows = (await session.exec(query)).all()
+        for download_task in rows:
+            taskid = download_task.id  # type: int # type: ignore
+            if taskid in pending or not await self.acquire(taskid):
+                continue
+            # submit_uri提交的新任务还没有进度文件，别的节点下了一半的接着下
+            resume = os.path.exists(
+                download_task.path + self.config.tempfile_suffix  # type: ignore
+            )
+            await self.process._resume_one(download_task, resume=resume)
+
+    async def status(self) -> List[Dict[str, Any]]:
+        """
+        所有节点上的任务的进度
+        """
+        async with self.process.session() as session:
+            leases = (await session.exec(select(TaskLease))).all()
+        now = time.time()
+        return [
+            {
+                "task_id": lease.task_id,
+                "owner": lease.owner if lease.expires >= now else None,
+                "expires": lease.expires,
+                "remaining": lease.remaining,
+                "speed": lease.speed,
+            }
+            for lease in leases
+        ]
+
+    async def close(self) -> None:
+        """
+        正常退出的时候放掉租约，别的节点不用等过期就能接手
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        async with self.process.session() as session:
+            await session.exec(
+                update(TaskLease)
+                .where(TaskLease.owner == self.node_id)  # type: ignore
+                .values(owner=None, expires=0.0)
+            )
+            await session.commit()
+        self.owned.clear()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+推送任务的状态变化和进度，代替轮询tell_status
+
+async for event in process.events(): ...
+状态变化(start complete error stop pause processing)跟着hook一起发出去，
+进度每隔event_interval从内存里的split_result算一次，只发有变化的任务，不查数据库。
+每个订阅者一个有界队列，消费得慢也不会拖住别人:
+- 同一个任务的progress只留最新的一条
+- 状态变化不合并，超过event_queue_size丢最旧的，再补一条overflow，订阅者需要的话用tell_status重新同步
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from pygetex.utils.misc import get_remain_bytes
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+HOOK_EVENTS = {
+    "on_download_start": "start",
+    "on_download_complete": "complete",
+    "on_download_error": "error",
+    "on_download_stop": "stop",
+    "on_download_pause": "pause",
+}
+
+
+class Event(NamedTuple):
+    type: str  # start complete error stop pause processing progress overflow
+    taskid: Optional[int]  # overflow没有taskid
+    time: float
+    data: Dict[str, Any]
+
+
+class Subscription:
+    def __init__(
+        self,
+        hub: "EventHub",
+        filter: Optional[Callable[[Event], bool]],
+        taskids: Optional[Iterable[int]],
+        maxsize: int,
+    ):
+        self.hub = hub
+        self.filter = filter
+        self.taskids = set(taskids) if taskids is not None else None
+        self.maxsize = maxsize
+        self.dropped = 0  # 还没告诉订阅者的，丢掉的状态变化
+        self._transitions = deque()  # type: Deque[Event]
+        self._progress = {}  # type: Dict[int, Event]
+        self._ready = asyncio.Event()
+        self._closed = False
+
+    def put(self, event: Event) -> None:
+        if self._closed:
+            return
+        if self.taskids is not None and event.taskid not in self.taskids:
+            return
+        if self.filter is not None and not self.filter(event):
+            return
+        if event.type == "progress":
+            if (
+                event.taskid not in self._progress
+                and len(self._transitions) + len(self._progress) >= self.maxsize
+            ):
+                return  # 下一轮还有更新的
+            self._progress[event.taskid] = event  # type: ignore
+        else:
+            self._progress.pop(event.taskid, None)  # type: ignore # 旧的进度没意义了
+            if len(self._transitions) + len(self._progress) >= self.maxsize:
+                if self._progress:
+                    self._progress.pop(next(iter(self._progress)))
+                else:
+                    self._transitions.popleft()
+                    self.dropped += 1
+            self._transitions.append(event)
+        self._ready.set()
+
+    def get_nowait(self) -> Optional[Event]:
+        if self.dropped:
+            event = Event("overflow", None, time.time(), {"dropped": self.dropped})
+            self.dropped = 0
+            return event
+        if self._transitions:
+            return self._transitions.popleft()
+        if self._progress:
+            return self._progress.pop(next(iter(self._progress)))
+        return None
+
+    def __len__(self) -> int:
+        return len(self._transitions) + len(self._progress)
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> Event:
+        while True:
+            if (event := self.get_nowait()) is not None:
+                return event
+            if self._closed:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+
+    def close(self) -> None:
+        """
+        不再接收新事件，已经在队列里的还能读完
+        """
+        self._closed = True
+        self._ready.set()
+        self.hub.unsubscribe(self)
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+class EventHub:
+    def __init__(self, process: "CoreProcess"):
+        self.process = process
+        self.config = process.config
+        self.subscribers = set()  # type: Set[Subscription]
+        self._last = {}  # type: Dict[int, Tuple[float, int, Any]]
+        # taskid -> (上一次的时间, 剩余字节, 后处理进度)，没变的不发
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def subscribe(
+        self,
+        filter: Optional[Callable[[Event], bool]] = None,
+        taskids: Optional[Iterable[int]] = None,
+    ) -> Subscription:
+        subscription = Subscription(self, filter, taskids, self.config.event_queue_size)
+        self.subscribers.add(subscription)
+        if self._task is None:  # 有人订阅了才开始算进度
+            self._task = asyncio.create_task(self._progress())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscribers.discard(subscription)
+        if not self.subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._last.clear()
+
+    def publish(self, type: str, taskid: Optional[int], **data) -> None:
+        if not self.subscribers:
+            return
+        event = Event(type, taskid, time.time(), data)
+        for subscription in list(self.subscribers):
+            subscription.put(event)
+
+    def on_hook(self, funcname: str, args: tuple) -> None:
+        """
+        dispatch_nowait的时候顺便发出去
+        """
+        if (type := HOOK_EVENTS.get(funcname)) is None or not self.subscribers:
+            return
+        if type == "error":
+            self.publish(type, args[0], error=repr(args[1]))
+        else:
+            self.publish(type, args[0])
+
+    def snapshot(self) -> List[Event]:
+        """
+        正在下载和后处理的任务里，和上一次相比有变化的
+        """
+        now = time.monotonic()
+        collector = self.process.collector
+        pending = self.process._pending_tasks
+        events = []
+        last = {}  # type: Dict[int, Tuple[float, int, Any]]
+        for taskid, split_result in list(collector._active_tasks.items()):
+            if split_result == [[0, -1]] or taskid not in pending:
+                continue  # 还没开始下载，或者已经结束了只是还没写进数据库
+            data = {}  # type: Dict[str, Any]
+            if split_result[-1][-1] != -1:
+                remaining = get_remain_bytes(split_result)
+                data["remaining"] = remaining
+            else:  # 大小未知，只有一个block，用负的已下载字节数算速度
+                remaining = -split_result[0][0]
+                data["remaining"] = None
+            if (progress := collector.processing.get(taskid)) is not None:
+                data["processing"] = progress
+            previous = self._last.get(taskid)
+            last[taskid] = (now, remaining, progress)
+            if previous is not None:
+                if previous[1:] == (remaining, progress):
+                    last[taskid] = previous
+                    continue  # 没动静
+                data["speed"] = (previous[1] - remaining) / (now - previous[0])
+            events.append(Event("progress", taskid, time.time(), data))
+        self._last = last
+        return events
+
+    async def _progress(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.event_interval)
+            for event in self.snapshot():
+                for subscription in list(self.subscribers):
+                    subscription.put(event)
+
+    async def close(self) -> None:
+        for subscription in list(self.subscribers):
+            subscription.close()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+事件循环的选择和卡顿监控
+
+event_loop决定用哪个事件循环，要在创建事件循环之前装好，所以用run代替asyncio.run。
+LoopMonitor每隔loop_monitor_interval醒一次，实际醒来的时间比预定的晚多少就是lag；
+另开一个线程盯着心跳，心跳停了超过loop_slow_threshold就抓一次事件循环线程的调用栈，
+同步的pwrite、插件之类的卡住网络读取的时候能看到是谁
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import TYPE_CHECKING, Any, Coroutine, Deque, Dict, List, Optional, TypeVar
+
+from pygetex.config import Config
+from pygetex.utils.misc import load_object
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+T = TypeVar("T")
+
+LAG_WINDOW = 100  # stats里的平均值和最大值只看最近这么多次
+SLOW_RECORDS = 20  # 最多保留多少个卡顿的调用栈
+
+
+def install_event_loop(name: str) -> None:
+    """
+    :param name: asyncio，uvloop，或者EventLoopPolicy的路径
+    :return:
+    """
+    if name == "asyncio":
+        return
+    if name == "uvloop":
+        import uvloop  # type: ignore
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return
+    asyncio.set_event_loop_policy(load_object(name)())
+
+
+def run(main: Coroutine[Any, Any, T], config: Config) -> T:
+    """
+    按config.event_loop装好事件循环再asyncio.run
+    """
+    install_event_loop(config.event_loop)
+    return asyncio.run(main)
+
+
+class LoopMonitor:
+    def __init__(self, process: "CoreProcess"):
+        self.process = process
+        self.config = process.config
+        self.lags = deque(maxlen=LAG_WINDOW)  # type: Deque[float]
+        self.slow = deque(maxlen=SLOW_RECORDS)  # type: Deque[Dict[str, Any]]
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._reported = 0.0  # 这次心跳已经报告过卡顿了
+        self._thread_id = threading.get_ident()
+        self._task = None  # type: Optional[asyncio.Task]
+        self._watchdog = None  # type: Optional[threading.Thread]
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._tick())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="pygetex-loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    async def _tick(self) -> None:
+        interval = self.config.loop_monitor_interval
+        histogram = self.process.metrics.loop_lag.labels()
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval  # type: ignore
+            await asyncio.sleep(interval)  # type: ignore
+            lag = max(loop.time() - expected, 0.0)
+            self.lags.append(lag)
+            histogram.observe(lag)
+            self._heartbeat = time.monotonic()
+
+    def _watch(self) -> None:
+        """
+        watchdog线程，事件循环卡住的时候它还在跑
+        """
+        interval = self.config.loop_monitor_interval
+        threshold = self.config.loop_slow_threshold
+        counter = self.process.metrics.loop_stalls.labels()
+        while not self._stop.wait(threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - interval  # type: ignore
+            if stalled <= threshold or heartbeat == self._reported:
+                continue
+            self._reported = heartbeat
+            frame = sys._current_frames().get(self._thread_id)
+            self.stalls += 1
+            counter.inc()
+            self.slow.append(
+                {
+                    "time": time.time(),
+                    "stalled": stalled,  # 抓栈的时候已经卡了多久
+                    "stack": "".join(traceback.format_stack(frame)) if frame else "",
+                }
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        lags = list(self.lags)
+        return {
+            "lag": lags[-1] if lags else 0.0,
+            "lag_avg": sum(lags) / len(lags) if lags else 0.0,
+            "lag_max": max(lags, default=0.0),
+            "stalls": self.stalls,
+            "slow_callbacks": list(self.slow),
+        }
+
+    async def close(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
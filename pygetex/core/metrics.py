@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+指标收集，可以用get_metrics拉取，也可以开一个本地http端口给prometheus抓取(OpenMetrics文本格式)
+
+热路径上先用labels()拿到子指标，之后每个chunk只是一次加法
+"""
+
+import asyncio
+import math
+from bisect import bisect_left
+from time import perf_counter
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    math.inf,
+)
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # 非累积的，输出的时候再累加
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self) -> "_Timer":
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child: HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.child.observe(perf_counter() - self.start)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # type: Dict[Tuple[str, ...], object]
+
+    def _new_child(self):
+        ...
+
+    def labels(self, *values) -> object:
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        if (child := self._children.get(key)) is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """[(sample name, labels, value)]"""
+        ...
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def labels(self, *values) -> CounterChild:  # type: ignore
+        return super().labels(*values)  # type: ignore
+
+    def samples(self):
+        return [
+            (self.name + "_total", dict(zip(self.labelnames, key)), child.value)
+            for key, child in self._children.items()
+        ]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        func: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.func = func  # 不带label的gauge可以在收集的时候才计算
+
+    def _new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def labels(self, *values) -> GaugeChild:  # type: ignore
+        return super().labels(*values)  # type: ignore
+
+    def samples(self):
+        if self.func is not None:
+            return [(self.name, {}, float(self.func()))]
+        return [
+            (self.name, dict(zip(self.labelnames, key)), child.value)
+            for key, child in self._children.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        buckets = tuple(sorted(buckets))
+        if buckets[-1] != math.inf:
+            buckets += (math.inf,)
+        self.buckets = buckets
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def labels(self, *values) -> HistogramChild:  # type: ignore
+        return super().labels(*values)  # type: ignore
+
+    def samples(self):
+        ret = []
+        for key, child in self._children.items():
+            labels = dict(zip(self.labelnames, key))
+            total = 0
+            for bound, count in zip(self.buckets, child.counts):
+                total += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                ret.append((self.name + "_bucket", {**labels, "le": le}, total))
+            ret.append((self.name + "_count", labels, total))
+            ret.append((self.name + "_sum", labels, child.sum))
+        return ret
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}  # type: Dict[str, Metric]
+
+    def register(self, metric: M) -> M:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collect(self) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+        """
+        拉取的api，sample name -> [(labels, value)]
+        """
+        ret = {}  # type: Dict[str, List[Tuple[Dict[str, str], float]]]
+        for metric in self.metrics.values():
+            for name, labels, value in metric.samples():
+                ret.setdefault(name, []).append((labels, value))
+        return ret
+
+    def render(self) -> str:
+        """
+        OpenMetrics文本格式
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(
+                        f'{key}="{_escape(val)}"' for key, val in labels.items()
+                    )
+                    lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class CoreMetrics:
+    """
+    CoreProcess的所有指标，handler之类的通过process.metrics访问
+    """
+
+    def __init__(self, process: "CoreProcess"):
+        self.registry = registry = MetricsRegistry()
+        self.received_bytes = registry.register(
+            Counter(
+                "pygetex_received_bytes",
+                "Bytes received from remote",
+                ("protocol", "host"),
+            )
+        )
+        self.active_tasks = registry.register(
+            Gauge(
+                "pygetex_active_tasks",
+                "Tasks being downloaded",
+                func=lambda: len(process._pending_tasks),
+            )
+        )
+        self.pending_tasks = registry.register(
+            Gauge(
+                "pygetex_pending_tasks",
+                "Tasks waiting in the scheduler queue",
+                func=lambda: process.scheduler.num_waiting(),
+            )
+        )
+        self.connections = registry.register(
+            Gauge("pygetex_connections", "Open download connections", ("protocol",))
+        )
+        self.write_seconds = registry.register(
+            Histogram(
+                "pygetex_write_seconds",
+                "Latency of writing one chunk to disk",
+                ("fileio",),
+            )
+        )
+        self.db_seconds = registry.register(
+            Histogram("pygetex_db_seconds", "Duration of one database session")
+        )
+        self.plugin_seconds = registry.register(
+            Histogram(
+                "pygetex_plugin_hook_seconds",
+                "Duration of one plugin hook call",
+                ("plugin", "hook"),
+            )
+        )
+        self.errors = registry.register(
+            Counter(
+                "pygetex_download_errors",
+                "Failed block or task downloads",
+                ("protocol",),
+            )
+        )
+        self.coalesced = registry.register(
+            Counter(
+                "pygetex_coalesced_tasks",
+                "Duplicate tasks served from another download",
+                ("method",),
+            )
+        )
+        self.cache_hits = registry.register(
+            Counter(
+                "pygetex_cache_hits",
+                "Tasks served from the local content cache",
+                ("method",),
+            )
+        )
+        self.postprocess_seconds = registry.register(
+            Histogram(
+                "pygetex_postprocess_seconds",
+                "Duration of one post-processing step",
+                ("op",),
+            )
+        )
+        self.loop_lag = registry.register(
+            Histogram(
+                "pygetex_loop_lag_seconds",
+                "How late the event loop woke up a scheduled timer",
+            )
+        )
+        self.loop_stalls = registry.register(
+            Counter(
+                "pygetex_loop_stalls",
+                "Times the event loop was blocked longer than loop_slow_threshold",
+            )
+        )
+
+
+class MetricsServer:
+    """
+    极简http服务器，只回应GET /metrics，不想为了这个引入web框架
+    """
+
+    content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():  # 丢掉header
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] in ("/", "/metrics"):
+                status, content_type = "200 OK", self.content_type
+                body = self.registry.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+给新任务分配不重名的保存路径
+
+每个目录第一次用到时扫描一次，之后只在内存里查已占用的名字。分配过程中没有await，
+同一个事件循环里并发add_uri也不会拿到同一个路径
+"""
+import os
+import re
+from typing import Dict, Set, Tuple
+
+re_numbered = re.compile(r"^(.*)\(([0-9]+)\)$")
+
+
+class PathRegistry:
+    def __init__(self):
+        self._taken = {}  # type: Dict[str, Set[str]]
+        # 目录 -> 磁盘上已有的和已经分配出去的文件名
+        self._next = {}  # type: Dict[Tuple[str, str, str], int]
+        # (目录, 文件名, 后缀) -> 下一个要试的编号，同名文件很多的时候不用从1数起
+
+    def _scan(self, dir_: str) -> Set[str]:
+        if (taken := self._taken.get(dir_)) is None:
+            try:
+                with os.scandir(dir_) as it:
+                    taken = {entry.name for entry in it}
+            except (FileNotFoundError, NotADirectoryError):
+                taken = set()
+            self._taken[dir_] = taken
+        return taken
+
+    def reserve(self, dir_: str, filename: str) -> str:
+        """
+        分配dir_下的一个路径，重名了就依次试 a(1).zip a(2).zip ...
+        :param dir_: 保存目录
+        :param filename: 想要的文件名，可以带子目录
+        :return: 完整路径
+        """
+        subdir, filename = os.path.split(filename)
+        dir_ = os.path.join(dir_, subdir)
+        real_dir = os.path.abspath(dir_)
+        taken = self._scan(real_dir)
+        name = filename
+        if name not in taken and not os.path.exists(os.path.join(dir_, name)):
+            taken.add(name)
+            return os.path.join(dir_, name)
+        stem, ext = os.path.splitext(filename)
+        key = (real_dir, stem, ext)
+        n = self._next.get(key, 1)
+        while True:
+            name = f"{stem}({n}){ext}"
+            n += 1
+            if name in taken:
+                continue
+            if os.path.exists(os.path.join(dir_, name)):  # 扫描之后别的程序创建的
+                taken.add(name)
+                continue
+            break
+        self._next[key] = n
+        taken.add(name)
+        return os.path.join(dir_, name)
+
+    def claim(self, path: str) -> None:
+        """
+        占用一个确定的路径，比如镜像目录时必须和远端同名的文件
+        """
+        dir_, name = os.path.split(os.path.abspath(path))
+        self._scan(dir_).add(name)
+
+    def release(self, path: str) -> None:
+        """
+        任务删除或者中止之后归还路径，出错的任务还能unpause，不能归还，磁盘上还有文件的话reserve时照样会跳过
+        :param path: reserve或claim拿到的路径
+        """
+        dir_, name = os.path.split(os.path.abspath(path))
+        if (taken := self._taken.get(dir_)) is None:
+            return
+        taken.discard(name)
+        stem, ext = os.path.splitext(name)
+        if (m := re_numbered.match(stem)) is not None:  # a(3).zip空出来了，下次从3试起
+            key = (dir_, m.group(1), ext)
+            n = int(m.group(2))
+            if n < self._next.get(key, 1):
+                self._next[key] = n
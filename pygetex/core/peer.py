@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+局域网里的节点互相借数据，同一个机架上几十台机器下同一个文件的时候不用都去打源站
+
+开了peer_port的节点回应两种请求:
+- GET /have?uri=... 这个uri已经写好了哪些区间，{"filesize": n, "ranges": [[start, end], ...]}
+- GET /data?uri=...&start=...&end=... 这一段的内容，只给已经写好了的
+配了peers的节点下载每个block之前先问peers，block开头有peer有的部分就从peer拿，
+一个piece一个piece地按hash校验，对不上或者没人有就交给源站。
+hash从options里的pieces步骤来(比如metalink)，没有hash的任务只有peer_trust的时候才用peer
+
+peer_host默认只听127.0.0.1，要给别的机器用得显式设成局域网地址。
+不管听在哪里，都得配peer_token(请求带Authorization: Bearer <token>)或者peer_allow，
+不然不启动，两个都配了就两个都要满足
+"""
+
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from sqlmodel import select
+
+from pygetex.config import Config
+from pygetex.task import DownloadTask
+from pygetex.utils.dns import open_connection
+from pygetex.utils.misc import get_written_ranges
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+HAVE_TTL = 1.0  # 同一个uri的have缓存这么久，各个block不用都去问一遍
+READ_SIZE = 256 * 1024
+
+Ranges = List[List[int]]
+Holders = Dict[str, Tuple[int, Ranges]]  # peer -> (文件大小, 写好的区间)
+
+
+def covers(ranges: Ranges, start: int, end: int) -> bool:
+    return any(low <= start and end <= high for low, high in ranges)
+
+
+class PeerServer:
+    """
+    和MetricsServer一样的极简http服务器，一个请求一条连接
+    """
+
+    def __init__(self, process: "CoreProcess", host: str, port: int):
+        self.process = process
+        self.host = host
+        self.port = port
+        self.token = process.config.peer_token
+        self.allow = [
+            ipaddress.ip_network(network, strict=False)
+            for network in process.config.peer_allow
+        ]
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+
+    async def start(self) -> int:
+        if not self.token and not self.allow:
+            raise ValueError("peer_port needs peer_token or peer_allow")
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def authorized(self, address: Optional[str], authorization: str) -> bool:
+        """
+        :param address: 对方的ip
+        :param authorization: Authorization头
+        :return:
+        """
+        if self.token and not hmac.compare_digest(
+            authorization.encode(), f"Bearer {self.token}".encode()
+        ):
+            return False
+        if self.allow:
+            try:
+                ip = ipaddress.ip_address((address or "").split("%")[0])
+            except ValueError:
+                return False
+            return any(ip in network for network in self.allow)
+        return True
+
+    async def have(self, uri: str) -> Optional[Tuple[DownloadTask, Ranges]]:
+        """
+        :param uri:
+        :return: 写好的字节最多的那个任务和它写好的区间
+        """
+        async with self.process.session() as session:
+            download_tasks = (
+                await session.exec(
+                    select(DownloadTask).where(
+                        DownloadTask.uri == uri,
+                        DownloadTask.status.in_(("downloading", "complete")),  # type: ignore
+                        DownloadTask.filesize != None,  # type: ignore
+                    )
+                )
+            ).all()
+        best = None  # type: Optional[Tuple[DownloadTask, Ranges]]
+        best_size = 0
+        for download_task in download_tasks:
+            filesize = download_task.filesize  # type: int # type: ignore
+            if (download_task.options or {}).get("decompress"):
+                continue  # 磁盘上是解压之后的内容
+            if download_task.status == "complete":
+                try:
+                    if os.path.getsize(download_task.path) != filesize:  # type: ignore
+                        continue
+                except OSError:
+                    continue
+                ranges = [[0, filesize - 1]]
+            else:
+                split_result = self.process.collector._active_tasks.get(
+                    download_task.id  # type: ignore
+                )
+                if not split_result or split_result[-1][-1] == -1:
+                    continue
+                ranges = get_written_ranges(split_result, filesize)
+            size = sum(end - start + 1 for start, end in ranges)
+            if size > best_size:
+                best, best_size = (download_task, ranges), size
+        return best
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            authorization = ""
+            while line := (await reader.readline()).strip():  # 别的header不关心
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.lower() == "authorization":
+                    authorization = value.strip()
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] != "GET":
+                await self._respond(writer, "405 Method Not Allowed")
+                return
+            peername = writer.get_extra_info("peername")
+            if not self.authorized(peername and peername[0], authorization):
+                await self._respond(writer, "403 Forbidden")
+                return
+            url = urlsplit(parts[1])
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            found = await self.have(query.get("uri", ""))
+            if url.path == "/have":
+                body = {"filesize": None, "ranges": []}  # type: Dict[str, Any]
+                if found is not None:
+                    body = {"filesize": found[0].filesize, "ranges": found[1]}
+                await self._respond(
+                    writer, "200 OK", json.dumps(body).encode(), "application/json"
+                )
+            elif url.path == "/data":
+                start, end = int(query["start"]), int(query["end"])
+                if found is None or not covers(found[1], start, end):
+                    await self._respond(writer, "416 Range Not Satisfiable")
+                    return
+                await self._send_file(writer, found[0].path, start, end)  # type: ignore
+            else:
+                await self._respond(writer, "404 Not Found")
+        except (ConnectionError, KeyError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(
+        writer: asyncio.StreamWriter,
+        status: str,
+        body: bytes = b"",
+        content_type: str = "text/plain",
+    ) -> None:
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    @staticmethod
+    async def _send_file(
+        writer: asyncio.StreamWriter, path: str, start: int, end: int
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        writer.write(
+            "HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+            f"Content-Length: {end - start + 1}\r\nConnection: close\r\n\r\n".encode()
+        )
+        with open(path, "rb") as f:
+            f.seek(start)
+            remain = end - start + 1
+            while remain > 0:
+                data = await loop.run_in_executor(None, f.read, min(remain, READ_SIZE))
+                if not data:
+                    raise ConnectionError(f"{path} is shorter than expected")
+                writer.write(data)
+                await writer.drain()
+                remain -= len(data)
+
+
+class PeerClient:
+    def __init__(self, process: "CoreProcess"):
+        self.process = process
+        self.config = process.config
+        self._have = {}  # type: Dict[str, Tuple[float, asyncio.Future[Holders]]]
+
+    async def _get(self, peer: str, target: str) -> bytes:
+        host, port = peer.rsplit(":", 1)
+        reader, writer = await open_connection(host.strip("[]"), int(port))
+        try:
+            authorization = ""
+            if self.config.peer_token:
+                authorization = f"Authorization: Bearer {self.config.peer_token}\r\n"
+            writer.write(
+                f"GET {target} HTTP/1.1\r\nHost: {peer}\r\n{authorization}"
+                "Connection: close\r\n\r\n".encode()
+            )
+            status = (await reader.readline()).split()
+            length = None  # type: Optional[int]
+            while line := (await reader.readline()).strip():
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            if len(status) < 2 or status[1] != b"200":
+                raise ConnectionError(f"peer {peer} answered {status[1:]!r}")
+            if length is None:
+                return await reader.read()
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    async def _query(self, uri: str) -> Holders:
+        target = "/have?" + urlencode({"uri": uri})
+        results = await asyncio.gather(
+            *(
+                asyncio.wait_for(self._get(peer, target), self.config.peer_timeout)
+                for peer in self.config.peers
+            ),
+            return_exceptions=True,
+        )
+        holders = {}  # type: Holders
+        for peer, result in zip(self.config.peers, results):
+            if isinstance(result, BaseException):
+                continue  # 没开或者挂了的peer
+            body = json.loads(result)
+            if body["ranges"]:
+                holders[peer] = (body["filesize"], body["ranges"])
+        return holders
+
+    async def have(self, uri: str) -> Holders:
+        """
+        :param uri:
+        :return: 有这个uri的peer，和它的文件大小、写好的区间
+        """
+        now = time.monotonic()
+        for key, (created, future) in list(self._have.items()):
+            # 过期的扔掉，不然下过的每个uri都留一条
+            if now - created > HAVE_TTL and future.done():
+                del self._have[key]
+        cached = self._have.get(uri)
+        if cached is None:
+            cached = (now, asyncio.ensure_future(self._query(uri)))
+            self._have[uri] = cached
+        return await asyncio.shield(cached[1])
+
+    @staticmethod
+    def piece_layout(
+        task: DownloadTask, config: Config
+    ) -> Optional[Tuple[int, Optional[Tuple[str, List[str]]]]]:
+        """
+        :param task:
+        :param config:
+        :return: piece长度和(hash算法, 每个piece的hash)，不能用peer的时候是None
+        """
+        for step in (task.options or {}).get("postprocess") or ():
+            if step.get("op") == "pieces" and step.get("length"):
+                return step["length"], (step.get("algo", "sha1"), step["hashes"])
+        if config.peer_trust:
+            return config.peer_piece_size, None
+        return None
+
+    async def fetch(
+        self, task: DownloadTask, start: int, end: int, config: Config
+    ) -> Optional[bytes]:
+        """
+        从peer拿start开始的一段，最多到end，校验过了才返回
+        :param task:
+        :param start:
+        :param end:
+        :param config: 任务的config
+        :return: 从start开始的数据，没有peer能给的时候是None
+        """
+        layout = self.piece_layout(task, config)
+        if layout is None or not task.filesize:
+            return None
+        length, hashes = layout
+        index = start // length
+        piece_start = index * length
+        piece_end = min(piece_start + length, task.filesize) - 1
+        if hashes is None:  # 不校验就不用凑整个piece
+            piece_start, piece_end = start, min(piece_end, end)
+        elif index >= len(hashes[1]):
+            return None
+        holders = [
+            peer
+            for peer, (filesize, ranges) in (await self.have(task.uri)).items()
+            if filesize == task.filesize and covers(ranges, piece_start, piece_end)
+        ]
+        target = "/data?" + urlencode(
+            {"uri": task.uri, "start": piece_start, "end": piece_end}
+        )
+        loop = asyncio.get_running_loop()
+        for attempt in range(len(holders)):
+            peer = holders[(index + attempt) % len(holders)]  # piece分散到各个peer
+            try:
+                data = await asyncio.wait_for(
+                    self._get(peer, target), self.config.peer_timeout
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(
+                    f"fetch piece {index} of {task.uri} from peer {peer} failed: {e!r}"
+                )
+                continue
+            if len(data) != piece_end - piece_start + 1:
+                continue
+            if hashes is not None:
+                algo, digests = hashes
+                digest = await loop.run_in_executor(
+                    None, lambda: hashlib.new(algo, data).hexdigest()
+                )
+                if digest != digests[index].lower():
+                    print(f"piece {index} of {task.uri} from peer {peer} is corrupted")
+                    continue
+            return data[start - piece_start : end - piece_start + 1]
+        return None
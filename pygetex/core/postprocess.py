@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+下载完成之后按task.options["postprocess"]逐步处理文件
+
+每一步丢进进程池，同时跑的步骤不超过postprocess_workers，解压校验再慢也不会卡住事件循环。
+处理期间task的status是processing，collector.processing里有进度，
+全部成功之后才算complete，才通知on_download_complete。
+每做完一步就把路径和做完了几步(options里的postprocess_done)写进数据库，退出或者暂停之后从下一步接着做
+"""
+import asyncio
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
+
+from pygetex.fileio.postprocess import run_step
+from pygetex.task import DownloadTask
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+DONE_OPTION = "postprocess_done"  # 存在task.options里，有这个key说明已经下载完了
+
+
+class PostProcessor:
+    def __init__(self, process: "CoreProcess"):
+        self.process = process
+        self.config = process.config
+        self._executor = None  # type: Optional[ProcessPoolExecutor]
+        # 第一次用到的时候才启动进程
+        self._semaphore = asyncio.Semaphore(self.config.postprocess_workers)
+        self._running = set()  # type: Set[asyncio.Task]
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.config.postprocess_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def run(
+        self, task: DownloadTask, steps: List[Dict[str, Any]], done: int = 0
+    ) -> str:
+        """
+        :param task: 刚下载完的任务
+        :param steps: 见pygetex.fileio.postprocess
+        :param done: 重启之后接着处理的时候，前面已经做完了几步
+        :return: 处理之后的路径
+        """
+        collector = self.process.collector
+        metrics = self.process.metrics
+        self.process._cleanup_nowait([task.path])  # 下完了，断点续传文件没用了
+        options = {**(task.options or {}), DONE_OPTION: done}
+        await collector.task_processing(task.id, len(steps), options, done)  # type: ignore
+        loop = asyncio.get_running_loop()
+        path = task.path
+        aiotask = asyncio.current_task()  # type: asyncio.Task # type: ignore
+        self._running.add(aiotask)
+        try:
+            for index in range(done, len(steps)):
+                step = steps[index]
+                async with self._semaphore:
+                    with metrics.postprocess_seconds.labels(step.get("op")).time():
+                        future = loop.run_in_executor(
+                            self.executor, run_step, path, step
+                        )
+                        try:
+                            path = await asyncio.shield(future)
+                        except asyncio.CancelledError:
+                            # 进程池里这一步停不下来，等它做完把进度记下来，
+                            # 不然下次重做这一步的时候文件可能已经被它删掉或者移走了
+                            try:
+                                path = await future
+                            except Exception:
+                                raise asyncio.CancelledError
+                            options[DONE_OPTION] = index + 1
+                            await collector.step_complete(task.id, path, options)  # type: ignore
+                            raise
+                options[DONE_OPTION] = index + 1
+                await collector.step_complete(task.id, path, options)  # type: ignore
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.errors.labels("postprocess").inc()
+            await collector.task_error(task.id)  # type: ignore
+            self.process.dispatch_nowait(
+                "on_download_error", task.id, e, traceback.format_exc()
+            )
+            raise e
+        finally:
+            self._running.discard(aiotask)
+        return path
+
+    async def close(self) -> None:
+        for aiotask in self._running:  # 正在跑的那一步做完就停，重启之后接着做
+            aiotask.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        if self._executor is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self._executor.shutdown(cancel_futures=True)  # type: ignore
+            )
+            self._executor = None
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+决定排队的任务谁先开始下载
+
+同时下载的任务数不超过config.max_concurrent_downloads(0表示不限制)。有空位的时候：
+1. priority大的先下载
+2. 同一个priority里，按剩余字节和测到的速度估算会赶不上deadline的任务最先下载
+3. 否则在各个host之间轮流，不让一个host的几千个文件占满所有位置
+4. 同一个host里有deadline的按deadline先后，没有的按schedule_policy：
+   fifo按添加顺序，srpt剩余字节少的先下载
+
+更高priority的任务排队的时候，会抢占正在下载的低priority任务：
+被抢占的任务保存进度后重新排队，轮到它的时候断点续传
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import sys
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+from urllib.parse import urlsplit
+
+from pygetex.task import DownloadTask
+from pygetex.utils.misc import get_remain_bytes
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+SCHEDULE_OPTIONS = frozenset(("priority", "deadline"))  # 只影响先后，不影响下载内容
+
+
+class _Entry:
+    __slots__ = (
+        "task",
+        "host",
+        "priority",
+        "deadline",
+        "remaining",
+        "seq",
+        "key",
+        "grant",
+        "preempt",
+        "running",
+    )
+
+    def __init__(self, task: DownloadTask, seq: int):
+        options = task.options or {}
+        self.task = task
+        self.host = urlsplit(task.uri).hostname or ""
+        self.priority = int(options.get("priority", 0))  # type: int
+        self.deadline = options.get("deadline", None)  # type: Optional[float]
+        # unix时间戳
+        self.remaining = (
+            task.filesize if task.filesize is not None else sys.maxsize
+        )  # type: int
+        self.seq = seq
+        self.key = (
+            None
+        )  # type: Optional[tuple]  # 当前在堆里的key，堆里别的key都是过期的
+        self.grant = None  # type: Optional[asyncio.Future]  # 轮到它的时候set
+        self.preempt = None  # type: Optional[asyncio.Future]  # 被抢占的时候set
+        self.running = False
+
+
+class Scheduler:
+    def __init__(self, process: "CoreProcess"):
+        self.process = process
+        self.config = process.config
+        self._waiting = {}  # type: Dict[str, List[Tuple[tuple, int, _Entry]]]
+        # host -> 排队的任务，堆，(key, seq, entry)
+        self._entries = {}  # type: Dict[int, _Entry]
+        # taskid -> 排队或者正在下载的任务
+        self._running = set()  # type: Set[_Entry]  # 占着位置的任务
+        self._last_host = None  # type: Optional[str]  # 上一个开始下载的任务的host
+        self._seq = itertools.count()
+
+    @property
+    def limit(self) -> int:
+        return self.config.max_concurrent_downloads
+
+    def _sort_key(self, entry: _Entry) -> tuple:
+        return (
+            -entry.priority,
+            entry.deadline if entry.deadline is not None else math.inf,
+            entry.remaining if self.config.schedule_policy == "srpt" else 0,
+        )
+
+    def _push(self, entry: _Entry) -> None:
+        entry.key = self._sort_key(entry)
+        entry.running = False
+        entry.grant = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._waiting.setdefault(entry.host, []), (entry.key, entry.seq, entry)
+        )
+
+    def _peek(self, host: str) -> Optional[_Entry]:
+        heap = self._waiting[host]
+        while heap:
+            key, _, entry = heap[0]
+            if entry.key is key and not entry.running:
+                return entry
+            heapq.heappop(heap)  # 已经开始、取消或者改过priority了
+        del self._waiting[host]
+        return None
+
+    def _slack(self, entry: _Entry, now: float, speed: Optional[float]) -> float:
+        """
+        离deadline还剩多少秒的余量，负数表示现在开始也赶不上了
+        """
+        if entry.deadline is None:
+            return math.inf
+        eta = entry.remaining / speed if speed else 0.0
+        return entry.deadline - now - eta
+
+    def _task_speed(self) -> Optional[float]:
+        """
+        正在下载的任务的平均速度，估算排队任务要下载多久
+        """
+        speeds = [
+            speed
+            for entry in self._running
+            if (speed := self.process.collector.speed.get(entry.task.id))  # type: ignore
+        ]
+        if not speeds:
+            return None
+        return sum(speeds) / len(speeds)
+
+    def _select(self) -> Optional[_Entry]:
+        heads = []  # type: List[_Entry]
+        for host in list(self._waiting):
+            if (entry := self._peek(host)) is not None:
+                heads.append(entry)
+        if not heads:
+            return None
+        priority = max(entry.priority for entry in heads)
+        heads = [entry for entry in heads if entry.priority == priority]
+        now = time.time()
+        speed = self._task_speed()
+        urgent = min(heads, key=lambda entry: self._slack(entry, now, speed))
+        if self._slack(urgent, now, speed) <= 0:
+            return urgent  # 快赶不上deadline了，不管轮到哪个host
+        hosts = sorted(entry.host for entry in heads)
+        for host in hosts:
+            if self._last_host is None or host > self._last_host:
+                break
+        else:
+            host = hosts[0]  # 转了一圈
+        return next(entry for entry in heads if entry.host == host)
+
+    def _pump(self) -> None:
+        """
+        有空位就让排在最前面的任务开始
+        """
+        while not self.limit or len(self._running) < self.limit:
+            entry = self._select()
+            if entry is None:
+                break
+            entry.running = True
+            self._running.add(entry)
+            self._last_host = entry.host
+            entry.grant.set_result(None)  # type: ignore
+        self._rebalance()
+
+    def _rebalance(self) -> None:
+        """
+        排队的任务priority比正在下载的高，就抢占priority最低的那个
+        """
+        if not self.limit or len(self._running) < self.limit:
+            return
+        heads = [
+            entry
+            for host in list(self._waiting)
+            if (entry := self._peek(host)) is not None
+        ]
+        if not heads:
+            return
+        waiting = sorted((entry.priority for entry in heads), reverse=True)
+        victims = []  # type: List[_Entry]
+        preempting = 0  # 已经通知抢占但还没让出位置的
+        for entry in self._running:
+            if entry.preempt is None:
+                continue
+            if entry.preempt.done():
+                preempting += 1
+            elif entry.task.support_range:  # 不能断点续传的被抢占就白下载了
+                victims.append(entry)
+        victims.sort(key=lambda entry: (entry.priority, -entry.seq))
+        for priority, victim in zip(waiting[preempting:], victims):
+            if victim.priority >= priority:
+                break
+            victim.preempt.set_result(None)  # type: ignore
+
+    async def run(
+        self,
+        task: DownloadTask,
+        start: Callable[..., Coroutine[Any, Any, None]],
+        resume: bool = False,
+    ) -> None:
+        """
+        排队，轮到了再start(resume=resume)，被抢占的话保存进度重新排队。
+        cancel这个协程和cancel handler.handle一样，pause stop都不用改
+        :param task:
+        :param start: 一般是partial(handler.handle, task)
+        :param resume: 第一次开始的时候是不是断点续传
+        :return:
+        """
+        entry = _Entry(task, next(self._seq))
+        self._entries[task.id] = entry  # type: ignore
+        if task.id not in self.process.collector._active_tasks:
+            self.process.collector.task_add(task.id, [[0, -1]])  # type: ignore # 排队的时候也能暂停
+        try:
+            self._push(entry)
+            self._pump()
+            while True:
+                await entry.grant  # type: ignore
+                if not self.limit:
+                    await start(resume=resume)  # 不限制并发就不会被抢占
+                    return
+                entry.preempt = asyncio.get_running_loop().create_future()
+                aiotask = asyncio.create_task(start(resume=resume))
+                try:
+                    await asyncio.wait(
+                        [aiotask, entry.preempt], return_when=asyncio.FIRST_COMPLETED
+                    )
+                finally:
+                    if not aiotask.done():
+                        aiotask.cancel()
+                        await asyncio.wait([aiotask])
+                if not aiotask.cancelled():
+                    return aiotask.result()  # 完成了或者出错了，抢占晚了一步也算
+                split_result = self.process.collector._active_tasks.get(task.id)  # type: ignore
+                if split_result:
+                    self.process.collector.save_one(task)  # 下次轮到的时候断点续传
+                    entry.remaining = get_remain_bytes(split_result)
+                print(f"task {task.id} preempted")
+                resume = True
+                self._running.discard(entry)
+                self._push(entry)
+                self._pump()
+        finally:
+            del self._entries[task.id]  # type: ignore
+            entry.key = None
+            self._running.discard(entry)
+            self._pump()
+
+    def update(
+        self,
+        taskid: int,
+        priority: Optional[int] = None,
+        deadline: Optional[float] = None,
+    ) -> None:
+        """
+        修改排队中或者正在下载的任务的priority deadline，马上重新排序，必要时抢占
+        """
+        if (entry := self._entries.get(taskid)) is None:
+            return
+        if priority is not None:
+            entry.priority = priority
+        entry.deadline = deadline
+        if not entry.running:
+            entry.key = self._sort_key(entry)
+            heapq.heappush(
+                self._waiting.setdefault(entry.host, []),
+                (entry.key, entry.seq, entry),
+            )
+        self._pump()
+
+    def num_waiting(self) -> int:
+        """
+        排队中的任务数，给metrics用，不用排序
+        """
+        return sum(1 for entry in self._entries.values() if not entry.running)
+
+    def tell_waiting(self) -> List[int]:
+        """
+        排队中的任务，大致按开始的先后
+        """
+        return [
+            entry.task.id  # type: ignore
+            for entry in sorted(
+                (entry for entry in self._entries.values() if not entry.running),
+                key=lambda entry: (entry.key, entry.seq),
+            )
+        ]
@@ -3,11 +3,10 @@ import asyncio
 import os
 import pickle
 from datetime import datetime, timedelta, timezone
-from typing import TYPE_CHECKING, Dict, List, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 from sqlalchemy.exc import NoResultFound
-from sqlmodel import and_, func, or_, select
-from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import and_, func, or_, select, update
 
 from pygetex.config import Config
 from pygetex.task import DownloadTask
@@ -20,11 +19,16 @@ if TYPE_CHECKING:
 class StatsCollector:
     def __init__(self, process: "CoreProcess"):
         self.config = process.config  # type: Config
-        self.db = process.db
+        self.process = process
         self.speed = {}  # type: Dict[int, float]
         # task_id, speed bytes/second
         self._active_tasks = {}  # type: Dict[int, List[List[int]]]
         # task_id, 多线程的任务就是fileblocks，单线程的就是[[xxx, None]]只有一块，和handler引用同一个list对象
+        self.processing = {}  # type: Dict[int, Tuple[int, int]]
+        # task_id, (完成了几步, 一共几步) 下载完了正在后处理的任务
+        self._complete_queue = []  # type: List[Tuple[int, asyncio.Future]]
+        self._complete_flusher = None  # type: Optional[asyncio.Task]
+        # 等着一起写进数据库的完成事件
         self._background_task = asyncio.create_task(self._updating_task())
         # status是downloading的task Dict[int, int] id, received_bytes
 
@@ -38,32 +42,135 @@ class StatsCollector:
         self._active_tasks[taskid] = split_result
         # todo 重启进程后 CoreProcess负责查数据库，dispatch消息，调用handler.handle,传入resume=True参数，handler自己会调用task_add
 
+    def task_discard(self, taskid: int):
+        """
+        不碰数据库，只是不再追踪这个任务，批量删除的时候用
+        :param taskid:
+        :return:
+        """
+        self._active_tasks.pop(taskid, None)
+        self.speed.pop(taskid, None)
+        self.processing.pop(taskid, None)
+
+    async def task_processing(
+        self, taskid: int, steps: int, options: dict, done: int = 0
+    ):
+        """
+        下载完了，开始后处理。还留在_active_tasks里，处理完了再task_complete
+        :param taskid:
+        :param steps: 一共几步
+        :param options: 带上了后处理进度的options
+        :param done: 之前已经做完了几步
+        :return:
+        """
+        self.processing[taskid] = (done, steps)
+        self.speed.pop(taskid, None)
+        self.process.event_hub.publish("processing", taskid, steps=steps)
+        async with self.process.session() as session:
+            await session.exec(
+                update(DownloadTask)
+                .where(DownloadTask.id == taskid)  # type: ignore
+                .values(status="processing", options=options)
+            )
+            await session.commit()
+
+    async def step_complete(self, taskid: int, path: str, options: dict):
+        """
+        做完了一步，记下这一步之后的路径和进度，重启之后从下一步接着做
+        """
+        if (progress := self.processing.get(taskid)) is not None:
+            self.processing[taskid] = (progress[0] + 1, progress[1])
+        async with self.process.session() as session:
+            await session.exec(
+                update(DownloadTask)
+                .where(DownloadTask.id == taskid)  # type: ignore
+                .values(path=path, options=options)
+            )
+            await session.commit()
+
+    async def task_processed(self, taskid: int, path: str):
+        """
+        后处理移动或者解压了文件，记下最终的路径
+        """
+        async with self.process.session() as session:
+            await session.exec(
+                update(DownloadTask)
+                .where(DownloadTask.id == taskid)  # type: ignore
+                .values(path=path)
+            )
+            await session.commit()
+
     async def task_complete(self, taskid: int):
         """下载完成之后触发core，core会在之后调用这个"""
         print(f"task_complete {taskid}")
         if taskid not in self._active_tasks:
             raise ValueError(f"no active task with id {taskid}")
-        # assert isinstance(task, DownloadTask)
-        async with AsyncSession(self.db) as session:
-            task = (
+        future = asyncio.get_running_loop().create_future()
+        self._complete_queue.append((taskid, future))
+        if self._complete_flusher is None:
+            self._complete_flusher = asyncio.create_task(self._flush_complete())
+        await future
+
+    async def _flush_complete(self):
+        """
+        小文件多的时候每秒完成上千个任务，攒成一批一个事务标记完成
+        """
+        try:
+            while self._complete_queue:
+                batch, self._complete_queue = self._complete_queue, []
+                try:
+                    await self._complete_batch([taskid for taskid, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._complete_flusher = None
+
+    async def _complete_batch(self, taskids: List[int]):
+        end_time = datetime.now(
+            tz=timezone(timedelta(hours=self.config.timezone_offset))  # type: ignore
+        )
+        async with self.process.session() as session:
+            tasks = (
                 await session.exec(
-                    select(DownloadTask).where(DownloadTask.id == taskid)
+                    select(DownloadTask).where(DownloadTask.id.in_(taskids))  # type: ignore
                 )
-            ).one()
-            tempfile = task.path + self.config.tempfile_suffix  # type: ignore
-            if os.path.exists(tempfile):
-                os.remove(tempfile)  # 删除断点续传临时文件
-            task.status = "complete"
-            task.end_time = datetime.now(
-                tz=timezone(timedelta(hours=self.config.timezone_offset))  # type: ignore
-            )
-            # await session.merge(task)
-            session.add(
-                task
-            )  # 这个task对象可能并不是这个session查出来的，这样可以算update吗？还是变成insert然后说主键冲突？
+            ).all()
+            for task in tasks:
+                tempfile = task.path + self.config.tempfile_suffix  # type: ignore
+                if os.path.exists(tempfile):
+                    os.remove(tempfile)  # 删除断点续传临时文件
+                task.status = "complete"
+                task.end_time = end_time
+                options = dict(task.options or {})
+                if (
+                    self.process.cache is not None
+                    and not options.get("postprocess")
+                    and not options.get("no_cache")
+                ):  # commit之后属性就过期了，先存进缓存，后处理过的可能已经不是一个文件了
+                    start_time = task.start_time  # type: datetime # type: ignore
+                    if start_time.tzinfo is None:  # sqlite存的时候丢了时区
+                        start_time = start_time.replace(tzinfo=end_time.tzinfo)
+                    self.process.cache.put_nowait(
+                        self.process._coalesce_key(task.uri, options),
+                        task.path,
+                        task.support_range,
+                        self.config.cache_link,
+                        (task.uri, options, start_time.timestamp()),
+                    )
+                session.add(task)
             await session.commit()  # db层标识任务已完成
-        del self._active_tasks[taskid]
-        self.speed.pop(taskid, None)  # 删除speed都用pop 因为可能更新不及时 防止KeyError
+        for taskid in taskids:
+            self._active_tasks.pop(taskid, None)
+            self.speed.pop(
+                taskid, None
+            )  # 删除speed都用pop 因为可能更新不及时 防止KeyError
+            self.processing.pop(taskid, None)
 
     async def task_pause(self, taskid: int):
         """
@@ -74,7 +181,7 @@ class StatsCollector:
         print(f"task_pause {taskid}")
         if taskid not in self._active_tasks:
             raise ValueError(f"no active task with id {taskid}")
-        async with AsyncSession(self.db) as session:
+        async with self.process.session() as session:
             task = (
                 await session.exec(
                     select(DownloadTask).where(DownloadTask.id == taskid)
@@ -86,6 +193,7 @@ class StatsCollector:
             await session.commit()  # db层标识任务已暂停
         del self._active_tasks[taskid]
         self.speed.pop(taskid, None)
+        self.processing.pop(taskid, None)
 
     async def task_stop(
         self, taskid: int
@@ -93,7 +201,7 @@ class StatsCollector:
         # 不过因为外面是cancel掉handler.handle的，on_download_task_complete不会触发调用collector.task_complete，
         # 因此cancel后需要coreprocess调用这个取消collector的追踪。stop已经stop的任务是可以的，具有幂等性
         print(f"task_stop {taskid}")
-        async with AsyncSession(self.db) as session:
+        async with self.process.session() as session:
             try:
                 task = (
                     await session.exec(
@@ -109,16 +217,18 @@ class StatsCollector:
             task.end_time = datetime.now(  # type: ignore
                 tz=timezone(timedelta(hours=self.config.timezone_offset))  # type: ignore
             )
+            self.process.paths.release(task.path)  # type: ignore
             session.add(task)
             await session.commit()
         self._active_tasks.pop(taskid, None)  # type: ignore
         self.speed.pop(taskid, None)
+        self.processing.pop(taskid, None)
 
     async def task_error(self, taskid: int):
         # todo 只有handler知道何时下载出错，这个只能handler.process.collector.task_error这样调用，
         #  handler只可能知道正在下载的活跃任务有没有出错，一定是活跃的任务
         print(f"task_error {taskid}")
-        async with AsyncSession(self.db) as session:
+        async with self.process.session() as session:
             task = (
                 await session.exec(
                     select(DownloadTask).where(DownloadTask.id == taskid)
@@ -131,10 +241,12 @@ class StatsCollector:
             task.end_time = datetime.now(
                 tz=timezone(timedelta(hours=self.config.timezone_offset))  # type: ignore
             )
+            # 不release路径，unpause还会接着写这个路径
             session.add(task)
             await session.commit()
         del self._active_tasks[taskid]
         self.speed.pop(taskid, None)
+        self.processing.pop(taskid, None)
 
     # 启动进程的时候先读sql，status是downloading的全部调用task_add 恢复关闭进程之前的状态
     async def _updating_task(self) -> None:
@@ -152,11 +264,15 @@ class StatsCollector:
                 after_remains[download_taskid] = get_remain_bytes(split_result)  # type: ignore
             for taskid in after_remains:  # type: ignore
                 if taskid in previous_remains:
-                    self.speed[taskid] = previous_remains[taskid] - after_remains[taskid]  # type: ignore
+                    self.speed[taskid] = (previous_remains[taskid] - after_remains[taskid]) / self.config.update_interval  # type: ignore
 
     # 完成的块就别写入了
     def save_one(self, task: DownloadTask):
         split_result = self._active_tasks[task.id]  # type: ignore
+        if split_result == [[0, -1]]:
+            return  # 只是占坑，还没开始下载，没有进度可存
+        if task.id in self.processing:
+            return  # 已经下载完了，在做后处理
         tempfile = task.path + self.config.tempfile_suffix  # type: ignore
         with open(tempfile, "wb") as f:
             pickle.dump(get_unfinished_range(split_result), f)
@@ -166,13 +282,21 @@ class StatsCollector:
         把分块下载的进度结果dump进二进制文件，重启进程后方便读取了断点续传
         :return:
         """
-        async with AsyncSession(self.db) as session:
-            for taskid, split_result in self._active_tasks.items():
+        async with self.process.session() as session:
+            for taskid, split_result in list(
+                self._active_tasks.items()
+            ):  # await的时候task_complete可能会删掉_active_tasks里的东西
                 task = (
                     await session.exec(
                         select(DownloadTask).where(DownloadTask.id == taskid)
                     )
                 ).one()
+                if taskid not in self._active_tasks:
+                    continue  # 已经完成了，不需要断点续传
+                if split_result == [[0, -1]]:
+                    continue  # 还在排队，没有进度可存，存个[]下次启动会当成下载完了
+                if taskid in self.processing:
+                    continue  # 已经下载完了，重启之后接着做后处理
                 tempfile = task.path + self.config.tempfile_suffix
                 with open(tempfile, "wb") as f:
                     pickle.dump(get_unfinished_range(split_result), f)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+边下载边按顺序读一个任务的文件
+
+handler每写好一段就推进block[0]，所有没写完的block里最小的起点之前都是连续写好的，
+只读到那里，不会读到预分配出来还是0的部分。配合sequential选项，
+文件开头的piece先下载，消费者可以一边解压解析一边等后面的数据
+"""
+import asyncio
+import os
+from typing import IO, TYPE_CHECKING, Optional
+
+from sqlmodel import select
+
+from pygetex.task import DownloadTask
+from pygetex.utils.misc import get_contiguous_end
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+
+class TaskStream:
+    def __init__(
+        self,
+        process: "CoreProcess",
+        taskid: int,
+        offset: int = 0,
+        chunk_size: int = 1024 * 1024,
+    ):
+        self.process = process
+        self.taskid = taskid
+        self.position = offset  # 下一个要读的位置
+        self.chunk_size = chunk_size
+        self._path = None  # type: Optional[str]
+        self._filesize = None  # type: Optional[int]
+        self._file = None  # type: Optional[IO[bytes]]
+        self._finished = False  # 下载完了，读到_readable_end就结束
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._path is None:
+            task = await self._load()
+            self._path, self._filesize = task.path, task.filesize
+        while True:
+            end = await self._readable_end()
+            if end is not None and end > self.position:
+                data = await self._read(min(end - self.position, self.chunk_size))
+                if data:
+                    self.position += len(data)
+                    return data
+            if end is not None and self._finished:
+                await self.close()
+                raise StopAsyncIteration
+            await self._wait()
+
+    async def _load(self) -> DownloadTask:
+        async with self.process.session() as session:
+            task = (
+                await session.exec(
+                    select(DownloadTask).where(DownloadTask.id == self.taskid)
+                )
+            ).one_or_none()
+        if task is None:
+            raise ValueError(f"no task with id {self.taskid}")
+        return task
+
+    async def _readable_end(self) -> Optional[int]:
+        """
+        现在能读到哪里，None表示还不知道，要等
+        """
+        self._finished = False
+        split_result = self.process.collector._active_tasks.get(self.taskid)
+        if split_result is not None:
+            end = get_contiguous_end(split_result)
+            if end is not None:
+                return end
+        else:
+            status = (await self._load()).status
+            if status in ("error", "stopped"):
+                raise ValueError(f"task {self.taskid} is {status}")
+            if status != "complete":
+                return None  # 暂停了，等unpause
+        # 全部写完了
+        self._finished = True
+        if self._filesize is not None:
+            return self._filesize
+        try:
+            return os.path.getsize(self._path)  # type: ignore
+        except FileNotFoundError:
+            return None
+
+    def _read_at(self, count: int, offset: int) -> bytes:
+        """
+        windows没有os.pread，每个stream自己一个文件对象，seek再read
+        """
+        self._file.seek(offset)  # type: ignore
+        return self._file.read(count)  # type: ignore
+
+    async def _read(self, count: int) -> bytes:
+        if self._file is None:
+            try:
+                self._file = open(self._path, "rb", buffering=0)  # type: ignore
+            except FileNotFoundError:  # 小文件rename之前
+                return b""
+        if self.process.config.fileio_async:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._read_at, count, self.position
+            )
+        return self._read_at(count, self.position)
+
+    async def _wait(self) -> None:
+        interval = self.process.config.stream_poll_interval
+        aiotask = self.process._pending_tasks.get(self.taskid)
+        if aiotask is not None:
+            await asyncio.wait([aiotask], timeout=interval)  # 下载完了马上醒
+        else:
+            await asyncio.sleep(interval)
+
+    async def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+多进程下载，单个事件循环跑满一个核之后(TLS解密 chunk迭代 pwrite)就上不去了
+
+CoreProcess把支持分块的任务的block分给N个worker进程，每个worker有自己的事件循环和连接，
+直接写同一个文件的不同位置。worker只通过queue汇报写到哪了，handler那边把进度更新进
+同一个split_result，StatsCollector和数据库的逻辑完全不用变
+"""
+
+import asyncio
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+import traceback
+from mmap import mmap
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+from pygetex.config import Config, update_config
+from pygetex.core.loop import run
+from pygetex.fileio import pwrite, pwrite_async
+from pygetex.fileio.utils import open_fd_with_config
+from pygetex.utils.dns import get_resolver
+from pygetex.utils.misc import load_object
+
+if TYPE_CHECKING:
+    from pygetex.handler import HandlerBase
+
+PROGRESS_INTERVAL = 0.2  # worker最多每隔这么久汇报一次进度
+WATCH_INTERVAL = 0.5  # 看门线程每隔这么久换一次要等的进程，新拉起来的worker也能看到
+
+
+class WorkerError(Exception):
+    """worker进程里下载block出错"""
+
+    def __init__(self, message: str, tb: str):
+        super().__init__(message)
+        self.tb = tb
+
+
+class _Job:
+    __slots__ = ("block", "future", "worker", "on_progress")
+
+    def __init__(
+        self, block: List[int], future: asyncio.Future, worker: int, on_progress
+    ):
+        self.block = block
+        self.future = future
+        self.worker = worker
+        self.on_progress = on_progress
+
+
+class WorkerPool:
+    def __init__(self, config: Config, workers: int):
+        self.config = config
+        self.size = workers
+        self._ctx = multiprocessing.get_context("spawn")
+        self._processes = []  # type: List[Any]
+        self._job_queues = []  # type: List[Any]
+        self._results = self._ctx.Queue()
+        self._load = [0] * workers  # 每个worker正在下载的block数
+        self._jobs = {}  # type: Dict[int, _Job]
+        self._job_ids = itertools.count()
+        self._reader = None  # type: Optional[threading.Thread]
+        self._watcher = None  # type: Optional[threading.Thread]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._config_data = {}  # type: Dict[str, Any]
+        self._closing = False
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._config_data = self.config.model_dump()
+        for _ in range(self.size):
+            process, jobs = self._spawn()
+            self._processes.append(process)
+            self._job_queues.append(jobs)
+        self._reader = threading.Thread(
+            target=self._read_results, name="pygetex-workers", daemon=True
+        )
+        self._reader.start()
+        self._watcher = threading.Thread(
+            target=self._watch_processes, name="pygetex-workers-watch", daemon=True
+        )
+        self._watcher.start()
+
+    def _spawn(self) -> Tuple[Any, Any]:
+        jobs = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(self._config_data, jobs, self._results),
+            daemon=True,
+        )
+        process.start()
+        return process, jobs
+
+    def _watch_processes(self) -> None:
+        """
+        在线程里等worker进程的sentinel，被杀掉或者崩了的丢回事件循环处理
+        """
+        reported = set()  # type: Set[Any]
+        while not self._closing:
+            sentinels = {
+                process.sentinel: process
+                for process in list(self._processes)
+                if process not in reported
+            }
+            for sentinel in multiprocessing.connection.wait(
+                list(sentinels), WATCH_INTERVAL
+            ):
+                process = sentinels[sentinel]  # type: ignore
+                reported.add(process)
+                self._loop.call_soon_threadsafe(self._on_exit, process)  # type: ignore
+
+    def _on_exit(self, process: Any) -> None:
+        """
+        worker进程意外退出，它手上的block都算失败，再拉一个新的顶上
+        """
+        if self._closing or process not in self._processes:
+            return
+        worker = self._processes.index(process)
+        print(f"worker {worker} exited with code {process.exitcode}, respawn")
+        for job_id, job in list(self._jobs.items()):
+            if job.worker != worker:
+                continue
+            del self._jobs[job_id]
+            if not job.future.done():
+                job.future.set_exception(
+                    WorkerError(f"worker exited with code {process.exitcode}", "")
+                )
+        self._load[worker] = 0
+        self._processes[worker], self._job_queues[worker] = self._spawn()
+
+    async def close(self) -> None:
+        self._closing = True
+        for jobs in self._job_queues:
+            jobs.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, 5)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)  # 停掉读结果的线程
+        if self._reader is not None:
+            await loop.run_in_executor(None, self._reader.join)
+        if self._watcher is not None:
+            await loop.run_in_executor(None, self._watcher.join)
+        await asyncio.sleep(0)  # 让读线程最后丢过来的回调先跑完
+        for job in self._jobs.values():
+            if not job.future.done():
+                job.future.set_exception(WorkerError("worker pool closed", ""))
+        self._jobs.clear()
+
+    def _read_results(self) -> None:
+        """
+        在线程里阻塞读queue，再丢回事件循环
+        """
+        while (message := self._results.get()) is not None:
+            self._loop.call_soon_threadsafe(self._on_message, message)  # type: ignore
+
+    def _on_message(self, message: Tuple) -> None:
+        kind, job_id, offset = message[:3]
+        if (job := self._jobs.get(job_id)) is None:
+            return
+        if offset > job.block[0]:
+            job.on_progress(offset - job.block[0])
+            job.block[0] = offset  # 和collector引用同一个block
+        if kind == "progress":
+            return
+        del self._jobs[job_id]
+        self._load[job.worker] -= 1
+        if job.future.done():
+            return
+        if kind == "done":
+            job.future.set_result(None)
+        elif kind == "cancelled":
+            job.future.cancel()
+        else:
+            job.future.set_exception(WorkerError(message[3], message[4]))
+
+    async def download_block(
+        self,
+        handler: "HandlerBase",
+        uri: str,
+        path: str,
+        block: List[int],
+        options: dict,
+        config: Config,
+    ) -> None:
+        """
+        让负载最低的worker下载block，block[0]会随着worker的汇报往后推
+        :param handler: 发起的handler，worker按它的类来请求数据
+        :param uri:
+        :param path: 已经预分配好的文件
+        :param block: [start, end]
+        :param options: 任务的options，worker用它覆盖全局config
+        :param config: 合并好的config，只用来记指标
+        :return:
+        """
+        if block[0] > block[1]:
+            return  # 断点续传的时候这块已经下完了
+        metrics = handler.process.metrics
+        received = metrics.received_bytes.labels(handler.name, urlparse(uri).hostname)
+        worker = self._load.index(min(self._load))
+        job_id = next(self._job_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._jobs[job_id] = _Job(block, future, worker, received.inc)
+        self._load[worker] += 1
+        handler_path = f"{type(handler).__module__}.{type(handler).__qualname__}"
+        self._job_queues[worker].put(
+            (
+                "download",
+                job_id,
+                handler_path,
+                uri,
+                path,
+                block[0],
+                block[1],
+                dict(options),  # 数据库里取出来的是MutableDict，带着weakref没法pickle
+            )
+        )
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done():  # 暂停或者停止，等worker停下来拿到准确的进度再走
+                self._job_queues[worker].put(("cancel", job_id))
+                try:
+                    await asyncio.wait_for(future, 5)
+                except (asyncio.CancelledError, asyncio.TimeoutError, WorkerError):
+                    pass
+            raise
+
+
+def worker_main(config_data: dict, jobs, results) -> None:
+    """worker进程入口"""
+    config = Config(**config_data)
+    run(_worker_loop(config, jobs, results), config)
+
+
+async def _worker_loop(config: Config, jobs, results) -> None:
+    loop = asyncio.get_running_loop()
+    get_resolver().configure(config)
+    running = {}  # type: Dict[int, asyncio.Task]
+    while (message := await loop.run_in_executor(None, jobs.get)) is not None:
+        if message[0] == "cancel":
+            if (task := running.get(message[1])) is not None:
+                task.cancel()
+            continue
+        _, job_id, handler_path, uri, path, start, end, options = message
+        task = asyncio.create_task(
+            _run_job(
+                update_config(config, **options),
+                results,
+                job_id,
+                handler_path,
+                uri,
+                path,
+                [start, end],
+            )
+        )
+        running[job_id] = task
+        task.add_done_callback(lambda _, job_id=job_id: running.pop(job_id, None))
+    for task in list(running.values()):
+        task.cancel()
+    await asyncio.gather(*running.values(), return_exceptions=True)
+
+
+async def _run_job(
+    config: Config,
+    results,
+    job_id: int,
+    handler_path: str,
+    uri: str,
+    path: str,
+    block: List[int],
+) -> None:
+    handler_tp = load_object(handler_path)
+    downloader = load_object(getattr(config, handler_tp.downloader_option))(config)
+    raw_fd, wrapped_fd = open_fd_with_config(path, config)
+    try:
+        body_iter = await handler_tp.open_block(downloader, uri, block, config)
+        try:
+            last_report = time.monotonic()
+            async for chunk in body_iter:
+                if config.fileio_async:
+                    await pwrite_async(config, wrapped_fd, chunk, block[0])
+                else:
+                    pwrite(config, wrapped_fd, chunk, block[0])
+                block[0] += len(chunk)
+                if (now := time.monotonic()) - last_report >= PROGRESS_INTERVAL:
+                    results.put(("progress", job_id, block[0]))
+                    last_report = now
+        finally:
+            await body_iter.close()
+        if block[0] != block[1] + 1:
+            raise ValueError(f"block incomplete: got {block[0]}, expect {block[1] + 1}")
+        results.put(("done", job_id, block[0]))
+    except asyncio.CancelledError:
+        results.put(("cancelled", job_id, block[0]))
+        raise
+    except Exception as e:
+        results.put(("error", job_id, block[0], repr(e), traceback.format_exc()))
+    finally:
+        await downloader.close()
+        if isinstance(wrapped_fd, mmap):
+            wrapped_fd.close()
+        os.close(raw_fd)
@@ -2,7 +2,7 @@
 """
 Copyright (c) 2008-2024 synodriver <diguohuangjiajinweijun@gmail.com>
 """
-from typing import AsyncIterable, Mapping, Optional, Tuple
+from typing import Any, AsyncIterable, Callable, List, Mapping, Optional, Tuple
 
 from pygetex.config import Config
 
@@ -21,6 +21,8 @@ class DownloaderBase:
 
 
 class HTTPDownloaderBase(DownloaderBase):
+    direct_write = False  # 为True的时候分块下载走download_to_file，body不经过python
+
     async def download(self, uri, method="GET", headers: Optional[Mapping] = None, payload: Optional[bytes] = None) -> Tuple[int, Mapping, AsyncReader]:  # type: ignore
         """
 
@@ -32,6 +34,31 @@ class HTTPDownloaderBase(DownloaderBase):
         """
         ...
 
+    async def stream_limit(self, uri: str) -> Optional[int]:
+        """
+        同一个服务器最多能同时开多少个block请求，HTTP/2是连接数乘以每条连接的stream上限
+        :param uri:
+        :return: None表示不复用连接，每个block一个连接，没有限制
+        """
+        return None
+
+    async def download_to_file(
+        self,
+        uri: str,
+        path: str,
+        block: List[int],
+        on_progress: Callable[[int], Any],
+    ) -> None:
+        """
+        把block这一段直接写进已经预分配好的path，只有direct_write为True的时候才会调用
+        :param uri:
+        :param path:
+        :param block: [start, end]，block[0]要跟着写进去的字节数推进
+        :param on_progress: 每次推进了多少字节
+        :return:
+        """
+        ...
+
     async def close(self):
         ...
 
@@ -46,5 +73,13 @@ class FTPDownloaderBase(DownloaderBase):
     async def download(self, uri: str, offset: int, count: int) -> AsyncReader:  # type: ignore
         ...
 
+    async def list_tree(self, uri: str) -> List[Tuple[str, int, Optional[float]]]:
+        """
+        递归列出目录下的所有文件
+        :param uri: 目录，以/结尾
+        :return: [(相对于uri的路径, 大小, 修改时间戳或者None)]
+        """
+        ...
+
     async def close(self):
         ...
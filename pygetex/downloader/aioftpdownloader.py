@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import os
-from typing import Optional, Tuple
-from urllib.parse import urlparse
+from datetime import datetime, timezone
+from pathlib import PurePosixPath
+from typing import List, Optional, Tuple
+from urllib.parse import unquote, urlparse
 
 from aioftp import DataConnectionThrottleStreamIO  # type: ignore
 from aioftp import Client, StatusCodeError
@@ -9,6 +12,32 @@ from aioftp.common import DEFAULT_PASSWORD, DEFAULT_PORT, DEFAULT_USER  # type:
 
 from pygetex.config import Config
 from pygetex.downloader import AsyncReader, FTPDownloaderBase
+from pygetex.utils.dns import is_ip_address, open_connection
+
+
+class ResolvingClient(Client):
+    """
+    控制连接的域名走pygetex.utils.dns，PASV给的数据连接地址本来就是ip
+    """
+
+    def __init__(self, *, happy_eyeballs_delay: Optional[float] = 0.25, **kwargs):
+        super().__init__(**kwargs)
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+
+    async def _open_connection(
+        self, host: str, port: int
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if (
+            self._siosocks_asyncio_kwargs
+            or self._stream is not None
+            or is_ip_address(host)
+        ):
+            # 走代理，或者数据连接要复用控制连接的TLS会话
+            return await super()._open_connection(host, port)
+        return await asyncio.wait_for(
+            open_connection(host, port, self.happy_eyeballs_delay, ssl=self.ssl),
+            self.connection_timeout,
+        )
 
 
 class AIOFTPBodyReader(AsyncReader):
@@ -41,29 +70,50 @@ class AIOFTPBodyReader(AsyncReader):
         await self.ctx.__aexit__(None, None, None)
 
 
+def parse_modify(modify: Optional[str]) -> Optional[float]:
+    """
+    MLSD的modify是UTC时间 YYYYMMDDHHMMSS[.sss]
+    """
+    if not modify:
+        return None
+    try:
+        return (
+            datetime.strptime(modify[:14], "%Y%m%d%H%M%S")
+            .replace(tzinfo=timezone.utc)
+            .timestamp()
+        )
+    except ValueError:
+        return None
+
+
 class AIOFTPDownloader(FTPDownloaderBase):
     def __init__(self, config: Config):
         self.config = config
         self.username = getattr(config, "username", DEFAULT_USER)
         self.password = getattr(config, "password", DEFAULT_PASSWORD)
 
-    async def guess_file_metadata(self, uri: str) -> Tuple[Optional[int], str, bool]:
+    def _context(self, uri: str):
         parsed = urlparse(uri)
         host = parsed.netloc
-        support_range = True
         if ":" in host:
             host, portstr = host.split(":")
             port = int(portstr)
         else:
             port = DEFAULT_PORT
-        async with Client.context(
+        return ResolvingClient.context(
             host,
             port,
             self.username,
             self.password,
             ssl=getattr(self.config, "ssl", None),
             encoding=getattr(self.config, "encoding", "utf-8"),
-        ) as client:  # type: Client
+            happy_eyeballs_delay=getattr(self.config, "happy_eyeballs_delay", 0.25),
+        )
+
+    async def guess_file_metadata(self, uri: str) -> Tuple[Optional[int], str, bool]:
+        parsed = urlparse(uri)
+        support_range = True
+        async with self._context(uri) as client:  # type: Client
             code, info = await client.command(f"SIZE {parsed.path}", "213")
             try:
                 await client.command(
@@ -75,23 +125,62 @@ class AIOFTPDownloader(FTPDownloaderBase):
 
     async def download(self, uri: str, offset: int, count: int) -> AIOFTPBodyReader:
         parsed = urlparse(uri)
-        host = parsed.netloc
-        if ":" in host:
-            host, portstr = host.split(":")
-            port = int(portstr)
-        else:
-            port = DEFAULT_PORT
-        ctx = Client.context(
-            host,
-            port,
-            self.username,
-            self.password,
-            ssl=getattr(self.config, "ssl", None),
-            encoding=getattr(self.config, "encoding", "utf-8"),
-        )
+        ctx = self._context(uri)
         client = await ctx.__aenter__()  # type: Client
         stream = await client.download_stream(parsed.path, offset=offset)
         return AIOFTPBodyReader(stream, client, count, ctx, self.config)
 
+    async def list_tree(self, uri: str) -> List[Tuple[str, int, Optional[float]]]:
+        """
+        开ftp_list_connections个连接一起爬，每个连接从队列里取目录MLSD(不支持就LIST)，
+        列出来的子目录再放回队列
+        :param uri:
+        :return:
+        """
+        root = PurePosixPath(unquote(urlparse(uri).path) or "/")
+        queue = asyncio.Queue()  # type: asyncio.Queue[PurePosixPath]
+        queue.put_nowait(root)
+        files = []  # type: List[Tuple[str, int, Optional[float]]]
+
+        async def crawl():
+            async with self._context(uri) as client:  # type: Client
+                while True:
+                    directory = await queue.get()
+                    try:
+                        for path, info in await client.list(directory):
+                            if info["type"] == "dir":
+                                queue.put_nowait(path)
+                            elif info["type"] == "file":
+                                files.append(
+                                    (
+                                        str(path.relative_to(root)),
+                                        int(info["size"]),
+                                        parse_modify(info.get("modify")),
+                                    )
+                                )
+                    finally:
+                        queue.task_done()
+
+        crawlers = [
+            asyncio.create_task(crawl())
+            for _ in range(getattr(self.config, "ftp_list_connections", 4))
+        ]
+        finished = asyncio.create_task(queue.join())
+        try:
+            done, _ = await asyncio.wait(
+                [finished, *crawlers], return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for task in crawlers:
+                task.cancel()
+            finished.cancel()
+            results = await asyncio.gather(*crawlers, return_exceptions=True)
+        if finished in done:
+            return files
+        for result in results:  # 有连接出错了，队列永远不会清空
+            if isinstance(result, Exception):
+                raise result
+        raise RuntimeError(f"failed to list {uri}")
+
     async def close(self) -> None:
         pass
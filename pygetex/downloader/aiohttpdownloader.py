@@ -1,10 +1,37 @@
 # -*- coding: utf-8 -*-
-from typing import AsyncIterable, Mapping, Optional, Tuple
+import socket
+from typing import AsyncIterable, List, Mapping, Optional, Tuple
 
 import aiohttp
+from aiohttp.abc import AbstractResolver, ResolveResult
 
 from pygetex.config import Config
 from pygetex.downloader import AsyncReader, HTTPDownloaderBase
+from pygetex.utils.dns import get_resolver
+
+
+class CachedResolver(AbstractResolver):
+    """
+    aiohttp的解析交给pygetex.utils.dns，Happy Eyeballs还是aiohttp自己做
+    """
+
+    async def resolve(
+        self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET
+    ) -> List[ResolveResult]:
+        return [
+            ResolveResult(
+                hostname=host,
+                host=sockaddr[0],
+                port=sockaddr[1],
+                family=af,
+                proto=socket.IPPROTO_TCP,
+                flags=socket.AI_NUMERICHOST,
+            )
+            for af, sockaddr in await get_resolver().resolve(host, port, family)
+        ]
+
+    async def close(self) -> None:
+        pass
 
 
 class AIOHTTPBodyReader(AsyncReader):
@@ -34,7 +61,14 @@ class AIOHTTPBodyReader(AsyncReader):
 class AIOHTTPDownloader(HTTPDownloaderBase):
     def __init__(self, config: Config):
         self.config = config
-        self.session = aiohttp.ClientSession(headers=getattr(config, "headers", None))
+        self.session = aiohttp.ClientSession(
+            headers=getattr(config, "headers", None),
+            connector=aiohttp.TCPConnector(
+                resolver=CachedResolver(),
+                use_dns_cache=False,  # 缓存在CachedResolver里，进程内共用
+                happy_eyeballs_delay=getattr(config, "happy_eyeballs_delay", 0.25),
+            ),
+        )
 
     async def download(
         self,
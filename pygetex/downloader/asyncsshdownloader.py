@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import os
-from typing import Optional, Tuple
-from urllib.parse import urlparse
+import posixpath
+import stat
+from typing import List, Optional, Tuple
+from urllib.parse import unquote, urlparse
 
 import asyncssh
 
 from pygetex.config import Config
 from pygetex.downloader import AsyncReader, FTPDownloaderBase
+from pygetex.utils.dns import connect_socket
 
 
 class SFTPBodyReader(AsyncReader):
@@ -56,29 +60,98 @@ class SFTPBodyReader(AsyncReader):
 class SFTPDownloader(FTPDownloaderBase):
     def __init__(self, config: Config):
         self.config = config
+        self._conn = None  # type: Optional[asyncssh.SSHClientConnection]
+        self._sftp = None  # type: Optional[asyncssh.SFTPClient]
+        self._lock = asyncio.Lock()
+
+    async def _client(self, uri: str) -> asyncssh.SFTPClient:
+        """
+        stat readdir之类的小请求共用一个sftp会话，不用每次都握手
+        一个downloader只连一个服务器，下载block还是各自开连接
+        """
+        async with self._lock:
+            if self._sftp is None:
+                parsed = urlparse(uri)
+                port = parsed.port or asyncssh.DEFAULT_PORT
+                self._conn = await asyncssh.connect(
+                    parsed.hostname,
+                    port,
+                    sock=await connect_socket(
+                        parsed.hostname,  # type: ignore
+                        port,
+                        getattr(self.config, "happy_eyeballs_delay", 0.25),
+                    ),
+                    options=asyncssh.SSHClientConnectionOptions(
+                        username=getattr(self.config, "username", None),
+                        password=getattr(self.config, "password", None),
+                        known_hosts=getattr(self.config, "known_hosts", ()),
+                    ),
+                )
+                self._sftp = await self._conn.start_sftp_client()
+        return self._sftp
 
     async def guess_file_metadata(self, uri: str) -> Tuple[Optional[int], str, bool]:
         parsed = urlparse(uri)
-        host = parsed.netloc
-        support_range = True
-        if ":" in host:
-            host, portstr = host.split(":")
-            port = int(portstr)
-        else:
-            port = asyncssh.DEFAULT_PORT
-        async with asyncssh.connect(
-            host,
-            port,
-            options=asyncssh.SSHClientConnectionOptions(
-                username=getattr(self.config, "username", None),
-                password=getattr(self.config, "password", None),
-            ),
-        ) as conn:
-            async with conn.start_sftp_client() as sftp:
-                stat = await sftp.stat(parsed.path)
-                return stat.size, os.path.split(parsed.path)[-1], support_range
-                # async with sftp.open(parsed.path) as f:
-                #     await f.read()
+        sftp = await self._client(uri)
+        attrs = await sftp.stat(parsed.path)
+        return attrs.size, os.path.split(parsed.path)[-1], True
+
+    async def list_tree(self, uri: str) -> List[Tuple[str, int, Optional[float]]]:
+        """
+        sftp_list_concurrency个协程在同一个会话上一起readdir，请求是流水线发出去的
+        :param uri:
+        :return:
+        """
+        sftp = await self._client(uri)
+        root = unquote(urlparse(uri).path) or "/"
+        queue = asyncio.Queue()  # type: asyncio.Queue[str]
+        queue.put_nowait("")
+        files = []  # type: List[Tuple[str, int, Optional[float]]]
+
+        async def crawl():
+            while True:
+                relpath = await queue.get()
+                try:
+                    for name in await sftp.readdir(posixpath.join(root, relpath)):
+                        if name.filename in (".", ".."):
+                            continue
+                        child = posixpath.join(relpath, name.filename)
+                        mode = name.attrs.permissions or 0
+                        if stat.S_ISDIR(mode):
+                            queue.put_nowait(child)
+                        elif stat.S_ISREG(mode):  # 符号链接不跟，可能有环
+                            files.append((child, name.attrs.size, name.attrs.mtime))
+                finally:
+                    queue.task_done()
+
+        crawlers = [
+            asyncio.create_task(crawl())
+            for _ in range(getattr(self.config, "sftp_list_concurrency", 8))
+        ]
+        finished = asyncio.create_task(queue.join())
+        try:
+            done, _ = await asyncio.wait(
+                [finished, *crawlers], return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for task in crawlers:
+                task.cancel()
+            finished.cancel()
+            results = await asyncio.gather(*crawlers, return_exceptions=True)
+        if finished in done:
+            return files
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        raise RuntimeError(f"failed to list {uri}")
+
+    async def read(self, uri: str, offset: int, count: int) -> bytes:
+        """
+        读一小段，比较本地文件是不是远端的前缀
+        """
+        sftp = await self._client(uri)
+        async with sftp.open(urlparse(uri).path, "rb") as f:
+            return await f.read(count, offset)
 
     async def download(self, uri: str, offset: int, count: int) -> SFTPBodyReader:
         parsed = urlparse(uri)
@@ -91,18 +164,28 @@ class SFTPDownloader(FTPDownloaderBase):
         ctx = asyncssh.connect(
             host,
             port,
+            sock=await connect_socket(
+                host, port, getattr(self.config, "happy_eyeballs_delay", 0.25)
+            ),
             options=asyncssh.SSHClientConnectionOptions(
                 username=getattr(self.config, "username", None),
                 password=getattr(self.config, "password", None),
+                known_hosts=getattr(self.config, "known_hosts", ()),
             ),
         )
         conn = await ctx.__aenter__()
         sftpctx = conn.start_sftp_client()
         sftp = await sftpctx.__aenter__()
-        f = await sftp.open(
-            parsed.path, "rb", block_size=self.config.chunk_size
-        )  # type: asyncssh.SFTPClientFile
+        # block_size用默认值，read的时候会按服务器的包长上限拆成多个并发请求
+        f = await sftp.open(parsed.path, "rb")  # type: asyncssh.SFTPClientFile
         return SFTPBodyReader(ctx, sftpctx, f, offset, count, self.config)
 
     async def close(self) -> None:
-        pass
+        if self._sftp is not None:
+            self._sftp.exit()
+            await self._sftp.wait_closed()
+            self._sftp = None
+        if self._conn is not None:
+            self._conn.close()
+            await self._conn.wait_closed()
+            self._conn = None
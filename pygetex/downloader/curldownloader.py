@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
-from typing import AsyncIterable, Mapping, Optional, Tuple
+import asyncio
+from typing import Any, AsyncIterable, Callable, Dict, List, Mapping, Optional, Tuple
+from weakref import WeakKeyDictionary
 
+import cycurl._curl as m  # type: ignore
 from cycurl.requests import AsyncSession, Response  # type: ignore
 
 from pygetex.config import Config
@@ -52,3 +55,147 @@ class CURLDownloader(HTTPDownloaderBase):
 
     async def close(self) -> None:
         await self.session.close()
+
+
+PROGRESS_INTERVAL = 0.2  # 多久读一次各个transfer的进度
+
+
+class CurlMultiEngine:
+    """
+    一个事件循环一个multi handle，所有任务的所有block都挂在上面
+
+    body由libcurl直接调用文件对象的write(C实现的FileIO.write)写进预分配好的文件，
+    不经过python的协程和chunk迭代，python这边只是定时读一下每个transfer收了多少字节
+    """
+
+    def __init__(self):
+        self.acurl = m.AsyncCurl()
+        self.transfers = {}  # type: Dict[m.Curl, Tuple[List[int], int, Callable]]
+        self.refs = 0
+        self._poller = None  # type: Optional[asyncio.Task]
+
+    @classmethod
+    def acquire(cls) -> "CurlMultiEngine":
+        loop = asyncio.get_running_loop()
+        if (engine := _engines.get(loop)) is None:
+            engine = _engines[loop] = cls()
+        engine.refs += 1
+        return engine
+
+    async def release(self) -> None:
+        self.refs -= 1
+        if self.refs == 0:
+            _engines.pop(asyncio.get_running_loop(), None)
+            await self.acurl.close()
+
+    @staticmethod
+    def _update(curl: m.Curl, block: List[int], start: int, on_progress: Callable):
+        offset = start + curl.getinfo(m.CURLINFO_SIZE_DOWNLOAD_T)
+        if offset > block[0]:
+            on_progress(offset - block[0])
+            block[0] = offset
+
+    async def _poll(self) -> None:
+        while self.transfers:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            for curl, (block, start, on_progress) in list(self.transfers.items()):
+                self._update(curl, block, start, on_progress)
+        self._poller = None
+
+    async def perform(
+        self, curl: m.Curl, block: List[int], on_progress: Callable
+    ) -> None:
+        """
+        跑完一个transfer，block[0]跟着写进文件的字节数推进
+        :param curl: 设置好的easy handle
+        :param block: [start, end]，和collector共用
+        :param on_progress: 每次推进多少字节
+        :return:
+        """
+        start = block[0]
+        self.transfers[curl] = (block, start, on_progress)
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+        future = self.acurl.add_handle(curl)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self.acurl.remove_handle(curl)
+            raise
+        finally:
+            del self.transfers[curl]
+            self._update(curl, block, start, on_progress)  # 停下来的时候拿准确的进度
+
+
+_engines = WeakKeyDictionary()  # type: WeakKeyDictionary  # loop -> CurlMultiEngine
+
+
+class CURLMultiDownloader(CURLDownloader):
+    """
+    分块下载走CurlMultiEngine，libcurl直接写文件，其余请求和CURLDownloader一样
+    不走config.fileio，文件必须已经预分配好
+    """
+
+    direct_write = True
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self._engine = None  # type: Optional[CurlMultiEngine]
+
+    def _setup_curl(self, curl: m.Curl, uri: str, block: List[int]) -> None:
+        curl.setopt(m.CURLOPT_URL, uri.encode())
+        curl.setopt(m.CURLOPT_RANGE, f"{block[0]}-{block[1]}".encode())
+        curl.setopt(m.CURLOPT_FOLLOWLOCATION, 1)
+        curl.setopt(m.CURLOPT_FAILONERROR, 1)  # 4xx 5xx不写body
+        curl.setopt(m.CURLOPT_MAXFILESIZE_LARGE, block[1] - block[0] + 1)
+        if impersonate := getattr(self.config, "impersonate", None):
+            curl.impersonate(impersonate)
+        headers = getattr(self.config, "headers", None) or {}
+        if headers:
+            curl.setopt(
+                m.CURLOPT_HTTPHEADER,
+                [f"{key}: {value}".encode() for key, value in headers.items()],
+            )
+        method = getattr(self.config, "method", "GET")
+        if method != "GET":
+            curl.setopt(m.CURLOPT_CUSTOMREQUEST, method.encode())
+        if payload := getattr(self.config, "payload", None):
+            curl.setopt(m.CURLOPT_POSTFIELDS, payload)
+            curl.setopt(m.CURLOPT_POSTFIELDSIZE, len(payload))
+
+    async def download_to_file(
+        self,
+        uri: str,
+        path: str,
+        block: List[int],
+        on_progress: Callable[[int], Any],
+    ) -> None:
+        if self._engine is None:
+            self._engine = CurlMultiEngine.acquire()
+        start = block[0]
+
+        def check_status(line: bytes) -> int:
+            # 服务器没理Range返回了200，写进去就把别的block覆盖了
+            if line.startswith(b"HTTP/"):
+                status = int(line.split()[1])
+                if start != 0 and 200 <= status < 300 and status != 206:
+                    return m.CURL_WRITEFUNC_ERROR
+            return len(line)
+
+        curl = m.Curl()
+        file = open(path, "r+b", buffering=0)
+        try:
+            file.seek(start)
+            self._setup_curl(curl, uri, block)
+            curl.setopt(m.CURLOPT_HEADERFUNCTION, check_status)  # 每行header一次
+            curl.setopt(m.CURLOPT_WRITEDATA, file)  # body直接file.write
+            await self._engine.perform(curl, block, on_progress)
+        finally:
+            file.close()
+            curl.close()
+
+    async def close(self) -> None:
+        await super().close()
+        if self._engine is not None:
+            await self._engine.release()
+            self._engine = None
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+基于h2的HTTP/2下载器，同一个origin的所有block复用一两条连接，每个block是一个stream
+
+流控窗口只有在数据被handler取走之后才归还给服务器，窗口大小就是每个stream最多缓存的字节数
+https没协商出h2，或者明文http没开http2_prior_knowledge的时候，退回AIOHTTPDownloader
+"""
+
+import asyncio
+import ssl
+from typing import Dict, List, Mapping, Optional, Set, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.exceptions
+import h2.settings
+
+from pygetex.config import Config
+from pygetex.downloader import AsyncReader, HTTPDownloaderBase
+from pygetex.downloader.aiohttpdownloader import AIOHTTPDownloader
+from pygetex.utils.dns import open_connection
+
+DEFAULT_WINDOW = 16 * 1024 * 1024  # 每个stream的接收窗口
+DEFAULT_CONNECTION_WINDOW = 64 * 1024 * 1024  # 整条连接的接收窗口
+MAX_WINDOW = 2**31 - 1
+MAX_STREAMS = 100  # 服务器没限制的时候自己最多开这么多stream
+MAX_REDIRECTS = 10
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+HOP_HEADERS = frozenset(
+    (
+        "host",
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "transfer-encoding",
+        "upgrade",
+    )
+)
+
+Origin = Tuple[str, str, int]
+
+
+class H2StreamReader(AsyncReader):
+    def __init__(self, connection: "H2Connection", stream_id: int, config: Config):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.config = config
+        # bytes，None表示结束，或者异常
+        self.queue = asyncio.Queue()  # type: asyncio.Queue
+        loop = asyncio.get_running_loop()
+        self.response = loop.create_future()  # type: asyncio.Future
+        self.buffered = 0  # queue里还没被取走的字节数
+        self.ended = False
+        self.closed = False
+        self._error = None  # type: Optional[BaseException]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._error is not None:
+            raise self._error
+        if self.ended:
+            raise StopAsyncIteration
+        item = await self.queue.get()
+        chunks = []  # type: List[bytes]
+        size = 0
+        while True:  # 把已经到了的frame拼起来，免得每16k就pwrite一次
+            if item is None:
+                self.ended = True
+                break
+            if isinstance(item, BaseException):
+                self._error = item
+                break
+            chunks.append(item)
+            size += len(item)
+            if size >= self.config.chunk_size or self.queue.empty():  # type: ignore
+                break
+            item = self.queue.get_nowait()
+        if size:
+            self.buffered -= size
+            self.connection.acknowledge(self.stream_id, size)  # 取走了才归还窗口
+            return b"".join(chunks)
+        if self._error is not None:
+            raise self._error
+        raise StopAsyncIteration
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.connection.release(self)
+
+
+class H2Connection:
+    """
+    一条HTTP/2连接，后台任务读frame分发给各个stream
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        authority: str,
+        scheme: str,
+        config: Config,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.authority = authority
+        self.scheme = scheme
+        self.config = config
+        self.h2 = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=True, header_encoding="utf-8")
+        )
+        self.streams = {}  # type: Dict[int, H2StreamReader]
+        self.active = 0
+        self.max_streams = MAX_STREAMS
+        self.error = None  # type: Optional[BaseException]
+        self.closing = False  # 收到GOAWAY之后不再开新的stream
+        self._changed = asyncio.Event()  # stream数或者上限变了
+        self._window_updated = asyncio.Event()
+        self._settings_received = asyncio.Event()
+        self._read_task = None  # type: Optional[asyncio.Task]
+
+    @property
+    def available(self) -> bool:
+        return self.error is None and not self.closing
+
+    async def start(self) -> None:
+        window = min(getattr(self.config, "http2_window", DEFAULT_WINDOW), MAX_WINDOW)
+        connection_window = min(
+            getattr(self.config, "http2_connection_window", DEFAULT_CONNECTION_WINDOW),
+            MAX_WINDOW,
+        )
+        # 直接赋值，不然h2会先发默认值再发一次SETTINGS
+        self.h2.local_settings = h2.settings.Settings(
+            client=True,
+            initial_values={
+                h2.settings.SettingCodes.ENABLE_PUSH: 0,
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: window,
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: MAX_STREAMS,
+            },
+        )
+        del self.h2.local_settings[h2.settings.SettingCodes.ENABLE_CONNECT_PROTOCOL]
+        self.h2.initiate_connection()
+        if connection_window > 65535:
+            self.h2.increment_flow_control_window(connection_window - 65535)
+        self._flush()
+        self._read_task = asyncio.create_task(self._read_loop())
+        await self._settings_received.wait()  # 拿到服务器的stream上限再开始
+        if self.error is not None:
+            raise self.error
+
+    def _flush(self) -> None:
+        if data := self.h2.data_to_send():
+            self.writer.write(data)
+
+    async def _read_loop(self) -> None:
+        try:
+            while data := await self.reader.read(256 * 1024):
+                for event in self.h2.receive_data(data):
+                    self._handle_event(event)
+                self._flush()
+            raise ConnectionError("connection closed by server")
+        except asyncio.CancelledError:
+            self._fail(ConnectionError("connection closed"))
+            raise
+        except Exception as e:
+            self._fail(e)
+
+    def _handle_event(self, event) -> None:
+        if isinstance(event, h2.events.DataReceived):
+            if (stream := self.streams.get(event.stream_id)) is not None:
+                stream.queue.put_nowait(event.data)
+                stream.buffered += len(event.data)
+                padding = event.flow_controlled_length - len(event.data)
+            else:  # 已经关掉的stream，直接归还窗口
+                padding = event.flow_controlled_length
+            if padding:
+                self.acknowledge(event.stream_id, padding)
+        elif isinstance(event, h2.events.ResponseReceived):
+            if (stream := self.streams.get(event.stream_id)) is not None:
+                headers = dict(event.headers)
+                status = int(headers.pop(":status"))
+                if not stream.response.done():
+                    stream.response.set_result((status, headers))
+        elif isinstance(event, h2.events.StreamEnded):
+            if (stream := self.streams.get(event.stream_id)) is not None:
+                stream.queue.put_nowait(None)
+        elif isinstance(event, h2.events.StreamReset):
+            if (stream := self.streams.get(event.stream_id)) is not None:
+                self._fail_stream(
+                    stream, ConnectionError(f"stream reset: {event.error_code!r}")
+                )
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            self._settings_received.set()
+            self.max_streams = max(
+                min(self.h2.remote_settings.max_concurrent_streams, MAX_STREAMS), 1
+            )
+            self._changed.set()
+        elif isinstance(event, h2.events.WindowUpdated):
+            self._window_updated.set()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.closing = True
+            error = ConnectionError(f"connection terminated: {event.error_code!r}")
+            for stream_id, stream in list(self.streams.items()):
+                if event.last_stream_id is None or stream_id > event.last_stream_id:
+                    self._fail_stream(stream, error)
+            self._changed.set()
+
+    @staticmethod
+    def _fail_stream(stream: H2StreamReader, error: BaseException) -> None:
+        if not stream.response.done():
+            stream.response.set_exception(error)
+        stream.queue.put_nowait(error)
+
+    def _fail(self, error: BaseException) -> None:
+        if self.error is not None:
+            return
+        self.error = error
+        for stream in self.streams.values():
+            self._fail_stream(stream, error)
+        self._settings_received.set()
+        self._changed.set()
+        self._window_updated.set()
+
+    def acknowledge(self, stream_id: int, size: int) -> None:
+        if self.error is not None:
+            return
+        self.h2.acknowledge_received_data(size, stream_id)
+        self._flush()
+
+    def release(self, stream: H2StreamReader) -> None:
+        if self.streams.pop(stream.stream_id, None) is None:
+            return
+        self.active -= 1
+        self._changed.set()
+        if not stream.ended and self.error is None:  # 没读完就关，告诉服务器别再发了
+            try:
+                self.h2.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+            except h2.exceptions.StreamClosedError:
+                pass
+            self._flush()
+        if stream.buffered:  # 还在queue里没被取走的数据也要归还窗口
+            self.acknowledge(stream.stream_id, stream.buffered)
+            stream.buffered = 0
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        headers: Mapping,
+        payload: Optional[bytes] = None,
+    ) -> H2StreamReader:
+        while self.active >= self.max_streams and self.available:
+            self._changed.clear()
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+        if self.closing:
+            raise ConnectionError("connection is closing")
+        self.active += 1
+        stream_id = self.h2.get_next_available_stream_id()
+        stream = self.streams[stream_id] = H2StreamReader(self, stream_id, self.config)
+        request_headers = [
+            (":method", method),
+            (":authority", self.authority),
+            (":scheme", self.scheme),
+            (":path", path),
+        ] + [
+            (key.lower(), str(value))
+            for key, value in headers.items()
+            if key.lower() not in HOP_HEADERS
+        ]
+        try:
+            self.h2.send_headers(stream_id, request_headers, end_stream=not payload)
+            self._flush()
+            if payload:
+                await self._send_body(stream_id, payload)
+            await self.writer.drain()
+        except BaseException:
+            await stream.close()
+            raise
+        return stream
+
+    async def _send_body(self, stream_id: int, payload: bytes) -> None:
+        view = memoryview(payload)
+        while view:
+            if self.error is not None:
+                raise self.error
+            size = min(
+                self.h2.local_flow_control_window(stream_id),
+                self.h2.max_outbound_frame_size,
+                len(view),
+            )
+            if size <= 0:
+                self._window_updated.clear()
+                await self._window_updated.wait()
+                continue
+            self.h2.send_data(stream_id, bytes(view[:size]))
+            self._flush()
+            view = view[size:]
+        self.h2.end_stream(stream_id)
+        self._flush()
+
+    async def close(self) -> None:
+        if self.error is None:
+            try:
+                self.h2.close_connection()
+                self._flush()
+            except h2.exceptions.ProtocolError:
+                pass
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+
+class H2Downloader(HTTPDownloaderBase):
+    def __init__(self, config: Config):
+        self.config = config
+        self._connections = {}  # type: Dict[Origin, List[H2Connection]]
+        self._locks = {}  # type: Dict[Origin, asyncio.Lock]
+        self._http1_origins = set()  # type: Set[Origin]
+        self._fallback = None  # type: Optional[AIOHTTPDownloader]
+
+    @staticmethod
+    def _origin(uri: str) -> Origin:
+        parts = urlsplit(uri)
+        default_port = 443 if parts.scheme == "https" else 80
+        return parts.scheme, parts.hostname or "", parts.port or default_port
+
+    async def _open_connection(self, origin: Origin) -> Optional[H2Connection]:
+        scheme, host, port = origin
+        if scheme == "https":
+            context = ssl.create_default_context()
+            if not getattr(self.config, "verify_ssl", True):
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            context.set_alpn_protocols(["h2", "http/1.1"])
+            reader, writer = await open_connection(
+                host,
+                port,
+                getattr(self.config, "happy_eyeballs_delay", 0.25),
+                ssl=context,
+                server_hostname=host,
+            )
+            if writer.get_extra_info("ssl_object").selected_alpn_protocol() != "h2":
+                writer.close()
+                return None
+        elif getattr(self.config, "http2_prior_knowledge", False):  # h2c
+            reader, writer = await open_connection(
+                host, port, getattr(self.config, "happy_eyeballs_delay", 0.25)
+            )
+        else:
+            return None
+        default_port = 443 if scheme == "https" else 80
+        authority = host if port == default_port else f"{host}:{port}"
+        connection = H2Connection(reader, writer, authority, scheme, self.config)
+        try:
+            await connection.start()
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def _get_connection(self, origin: Origin) -> Optional[H2Connection]:
+        """
+        挑stream最少的连接，都在用并且没到http2_connections的时候再开一条
+        :return: None表示这个origin只能用HTTP/1.1
+        """
+        if origin in self._http1_origins:
+            return None
+        async with self._locks.setdefault(origin, asyncio.Lock()):
+            connections = [c for c in self._connections.get(origin, []) if c.available]
+            limit = getattr(self.config, "http2_connections", 1)
+            if connections:
+                connection = min(connections, key=lambda c: c.active / c.max_streams)
+                if connection.active == 0 or len(connections) >= limit:
+                    self._connections[origin] = connections
+                    return connection
+            connection = await self._open_connection(origin)
+            if connection is None:
+                self._http1_origins.add(origin)
+                return None
+            connections.append(connection)
+            self._connections[origin] = connections
+            return connection
+
+    def _get_fallback(self) -> AIOHTTPDownloader:
+        if self._fallback is None:
+            self._fallback = AIOHTTPDownloader(self.config)
+        return self._fallback
+
+    async def stream_limit(self, uri: str) -> Optional[int]:
+        if (connection := await self._get_connection(self._origin(uri))) is None:
+            return None
+        return connection.max_streams * getattr(self.config, "http2_connections", 1)
+
+    async def download(
+        self,
+        uri,
+        method="GET",
+        headers: Optional[Mapping] = None,
+        payload: Optional[bytes] = None,
+    ) -> Tuple[int, Mapping, AsyncReader]:
+        request_headers = dict(getattr(self.config, "headers", None) or {})
+        request_headers.update(headers or {})
+        for _ in range(MAX_REDIRECTS + 1):
+            connection = await self._get_connection(self._origin(uri))
+            if connection is None:
+                return await self._get_fallback().download(
+                    uri, method, request_headers, payload
+                )
+            parts = urlsplit(uri)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            body = await connection.request(method, path, request_headers, payload)
+            try:
+                status, response_headers = await body.response
+            except BaseException:
+                await body.close()
+                raise
+            if status not in REDIRECT_STATUS or "location" not in response_headers:
+                return status, response_headers, body
+            await body.close()
+            uri = urljoin(uri, response_headers["location"])
+            if status == 303:
+                method, payload = "GET", None
+        raise ConnectionError(f"too many redirects: {uri}")
+
+    async def close(self) -> None:
+        for connections in self._connections.values():
+            for connection in connections:
+                await connection.close()
+        self._connections.clear()
+        if self._fallback is not None:
+            await self._fallback.close()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+边下载边解压，压缩数据按顺序喂进来，解压出来的内容直接写进输出文件
+
+解压器的内部状态没法存下来，只能在一个gzip member、xz stream、zstd frame结束的地方断点续传，
+每到这样的边界就把(输出路径, 用掉的压缩字节, 写出的字节)存进检查点文件。
+单个member的文件断点续传就从头解压，range下载的压缩数据还在磁盘上，不用重新下载
+"""
+import lzma
+import os
+import pickle
+import zlib
+from typing import Any, Optional, Tuple
+
+from pygetex.fileio.utils import write_file_atomic
+
+SUFFIXES = {
+    ".gz": "gzip",
+    ".tgz": "gzip",
+    ".xz": "xz",
+    ".txz": "xz",
+    ".zst": "zstd",
+    ".tzst": "zstd",
+}
+
+
+def detect_format(path: str, fmt: str = "auto") -> Optional[str]:
+    """
+    :param path: 压缩文件路径
+    :param fmt: gzip xz zstd，auto按后缀猜
+    :return: 猜不出来是None
+    """
+    if fmt != "auto":
+        return fmt
+    return SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def output_name(path: str) -> str:
+    """
+    a.tar.gz -> a.tar, a.tgz -> a.tar, 不认识的后缀加上.out
+    """
+    stem, ext = os.path.splitext(path)
+    ext = ext.lower()
+    if ext in (".tgz", ".txz", ".tzst"):
+        return stem + ".tar"
+    if ext in SUFFIXES and stem and not stem.endswith(os.sep):
+        return stem
+    return path + ".out"
+
+
+def new_decoder(fmt: str) -> Any:
+    if fmt == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if fmt == "xz":
+        return lzma.LZMADecompressor()
+    if fmt == "zstd":
+        import zstandard  # type: ignore
+
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"unknown compression format {fmt}")
+
+
+def load_checkpoint(path: str) -> Optional[Tuple[str, int, int]]:
+    """
+    :param path: 检查点文件
+    :return: (输出路径, 用掉的压缩字节, 写出的字节)
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+class StreamingDecompressor:
+    """
+    feed和finish会阻塞，在线程里调用，同一时间只能有一个线程调用
+    """
+
+    def __init__(
+        self,
+        fmt: str,
+        out_path: str,
+        checkpoint_path: str,
+        consumed: int = 0,
+        produced: int = 0,
+    ):
+        """
+        :param fmt: gzip xz zstd
+        :param out_path: 解压出来的文件
+        :param checkpoint_path: 检查点文件
+        :param consumed: 从压缩数据的这个位置开始，必须是边界
+        :param produced: 输出文件已经写好的长度
+        """
+        self.fmt = fmt
+        self.out_path = out_path
+        self.checkpoint_path = checkpoint_path
+        self.consumed = consumed
+        self.produced = produced
+        self._decoder = new_decoder(fmt)
+        self._boundary = consumed  # 最近一个边界，consumed比它大说明正在解压一个member
+        self._file = open(out_path, "r+b" if os.path.exists(out_path) else "wb")
+        self._file.truncate(produced)  # 丢掉上次边界之后写的
+        self._file.seek(produced)
+        self.save_checkpoint()
+
+    def save_checkpoint(self) -> None:
+        self._file.flush()
+        write_file_atomic(
+            self.checkpoint_path,
+            pickle.dumps((self.out_path, self._boundary, self.produced)),
+        )
+
+    def feed(self, data: bytes) -> None:
+        """
+        喂一段紧接着上一段的压缩数据
+        """
+        while data:
+            out = self._decoder.decompress(data)
+            self._file.write(out)
+            self.produced += len(out)
+            if not self._decoder.eof:
+                self.consumed += len(data)
+                return
+            rest = self._decoder.unused_data
+            self.consumed += len(data) - len(rest)
+            self._boundary = self.consumed
+            self.save_checkpoint()
+            self._decoder = new_decoder(self.fmt)  # 多个member拼起来的文件
+            data = rest
+
+    def finish(self) -> None:
+        """
+        压缩数据都喂完了，最后一个member必须是完整的
+        """
+        self.close()
+        if self.consumed != self._boundary:
+            raise ValueError(f"truncated {self.fmt} stream")
+        os.remove(self.checkpoint_path)
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
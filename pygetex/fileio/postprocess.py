@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+下载完成之后对文件做的处理，每一步都在进程池里跑，不能依赖事件循环
+
+每一步是一个能存进task.options的dict，op决定做什么，返回处理之后的路径交给下一步:
+{"op": "checksum", "algo": "sha256", "digest": "..."}  校验，不一致就报错
+{"op": "pieces", "algo": "sha1", "length": 262144, "hashes": [...]}  按piece校验，报告哪些piece坏了
+{"op": "gunzip"}  a.gz -> a，删掉压缩包
+{"op": "zstd"}  a.zst -> a，删掉压缩包，需要zstandard
+{"op": "untar", "dest": "/path", "remove": false}  解压到dest，默认是和压缩包同名的目录
+{"op": "move", "to": "/path"}  to是已有的目录就移进去
+{"op": "call", "func": "pkg.mod.func", "kwargs": {}}  func(path, **kwargs)，返回None就还是原来的路径
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import tarfile
+from typing import Any, BinaryIO, Callable, Dict, List, Optional
+
+from pygetex.utils.misc import load_object
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _strip_suffix(path: str, suffixes: tuple) -> str:
+    for suffix in suffixes:
+        if path.endswith(suffix) and len(path) > len(suffix):
+            return path[: -len(suffix)]
+    return path + ".out"
+
+
+def _decompress(path: str, out: str, open_: Callable[[BinaryIO], BinaryIO]) -> str:
+    tmp = out + ".part"
+    try:
+        with open(path, "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(open_(src), dst, CHUNK_SIZE)
+        os.replace(tmp, out)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(path)
+    return out
+
+
+def checksum(path: str, digest: str, algo: str = "sha256", **kwargs) -> Optional[str]:
+    hasher = hashlib.new(algo)
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    if hasher.hexdigest() != digest.lower():
+        raise ValueError(f"{algo} mismatch for {path}: {hasher.hexdigest()}")
+    return None
+
+
+def pieces(
+    path: str, length: int, hashes: List[str], algo: str = "sha1", **kwargs
+) -> Optional[str]:
+    bad = []
+    with open(path, "rb") as f:
+        for index, digest in enumerate(hashes):
+            hasher = hashlib.new(algo)
+            remain = length
+            while remain and (chunk := f.read(min(remain, CHUNK_SIZE))):
+                hasher.update(chunk)
+                remain -= len(chunk)
+            if hasher.hexdigest() != digest.lower():
+                bad.append(index)
+        if f.read(1):
+            raise ValueError(f"{path} is longer than {len(hashes)} pieces")
+    if bad:
+        raise ValueError(f"{algo} mismatch for {path}, bad pieces {bad}")
+    return None
+
+
+def gunzip(path: str, **kwargs) -> str:
+    return _decompress(
+        path,
+        _strip_suffix(path, (".gz", ".gzip")),
+        lambda f: gzip.GzipFile(fileobj=f),  # type: ignore
+    )
+
+
+def zstd(path: str, **kwargs) -> str:
+    import zstandard  # type: ignore
+
+    return _decompress(
+        path,
+        _strip_suffix(path, (".zst", ".zstd")),
+        zstandard.ZstdDecompressor().stream_reader,
+    )
+
+
+def untar(path: str, dest: Optional[str] = None, remove: bool = False, **kwargs) -> str:
+    if dest is None:
+        for suffix in (".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar"):
+            if path.endswith(suffix):
+                dest = path[: -len(suffix)]
+                break
+        else:
+            dest = path + ".d"
+    with tarfile.open(path) as tar:
+        tar.extractall(dest, filter="data")  # 不许解压到dest外面
+    if remove:
+        os.remove(path)
+    return dest
+
+
+def move(path: str, to: str, **kwargs) -> str:
+    if os.path.isdir(to):
+        to = os.path.join(to, os.path.basename(path))
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(to)), exist_ok=True)
+    return shutil.move(path, to)
+
+
+def call(path: str, func: str, kwargs: Optional[Dict[str, Any]] = None, **_):
+    return load_object(func)(path, **(kwargs or {}))
+
+
+STEPS = {
+    "checksum": checksum,
+    "pieces": pieces,
+    "gunzip": gunzip,
+    "zstd": zstd,
+    "untar": untar,
+    "move": move,
+    "call": call,
+}  # type: Dict[str, Callable[..., Optional[str]]]
+
+
+def run_step(path: str, step: Dict[str, Any]) -> str:
+    """
+    进程池里执行一步
+    :param path: 上一步的结果
+    :param step: {"op": ..., 参数...}
+    :return: 这一步之后文件的路径
+    """
+    step = dict(step)
+    op = step.pop("op")
+    if op not in STEPS:
+        raise ValueError(f"unknown postprocess op {op}")
+    return STEPS[op](path, **step) or path
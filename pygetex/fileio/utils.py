@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
 from mmap import ACCESS_WRITE, mmap
+from typing import Iterable
 
 if os.name == "nt":
     import msvcrt
     from ctypes import wintypes
+else:
+    import fcntl
 
 from pygetex.config import Config
 
+FICLONE = 0x40049409  # linux ioctl，btrfs xfs之类的文件系统支持
+
 
 def pre_alloc_file(path: str, length: int, mode=0o666, exist_ok=True):
     if exist_ok:
@@ -55,3 +61,84 @@ def open_fd_with_config(path: str, config: Config, mode: int = 0o777):
             return fd, fd
     elif config.fileio == "generalio":
         return fd, fd
+
+
+def remove_tempfiles(paths: Iterable[str], suffix: str) -> int:
+    """
+    删除一批下载任务的断点续传临时文件，不存在的跳过
+    :param paths: 下载文件的路径
+    :param suffix: 临时文件后缀
+    :return: 删除的文件数
+    """
+    count = 0
+    for path in paths:
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            continue
+        count += 1
+    return count
+
+
+def prepare_paths(paths: Iterable[str]) -> None:
+    """
+    给要覆盖的文件腾地方: 创建上级目录，删掉旧文件，pre_alloc_file不会截断已有的文件
+    :param paths:
+    :return:
+    """
+    dirs = set()
+    for path in paths:
+        if (dir_ := os.path.dirname(path)) not in dirs:
+            os.makedirs(dir_ or ".", exist_ok=True)
+            dirs.add(dir_)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def write_file_atomic(path: str, data: bytes, suffix: str = ".part") -> None:
+    """
+    小文件一次写进临时文件再rename，别人不会看到写了一半的文件
+    :param path:
+    :param data:
+    :param suffix: 临时文件后缀
+    :return:
+    """
+    tmp = path + suffix
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if os.name == "nt":
+        flags |= os.O_BINARY
+    fd = os.open(tmp, flags, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+def clone_file(src: str, dst: str, mode: str = "reflink") -> str:
+    """
+    把下载好的src复制一份到dst，失败了就退回普通复制
+    :param src:
+    :param dst:
+    :param mode: reflink 写时复制，hardlink 硬链接，两个路径共用同一份数据，copy 普通复制
+    :return: 实际用的方式
+    """
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:  # 跨设备之类的
+            pass
+    elif mode == "reflink" and os.name != "nt":
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:  # 文件系统不支持
+            pass
+    shutil.copyfile(src, dst)  # 会用copy_file_range/sendfile
+    return "copy"
@@ -1,12 +1,57 @@
 # -*- coding: utf-8 -*-
-from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Type
+import os
+from importlib.metadata import entry_points
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple, Type
+from urllib.parse import urlparse
 
+from pygetex.config import Config
+from pygetex.downloader import AsyncReader
+from pygetex.fileio import pwrite, pwrite_async
 from pygetex.task import DownloadTask
 
 if TYPE_CHECKING:
     from pygetex.core import CoreProcess
 
 
+class ExpandedFile(NamedTuple):
+    """目录之类的uri展开后的一个文件，元数据在列目录的时候就拿到了"""
+
+    uri: str
+    filesize: Optional[int]
+    path: str  # 相对于下载目录的路径，会原样保留，不再改名
+    support_range: bool
+    options: dict
+    offset: int = 0  # 本地文件的前offset字节和远端一样，只下载后面的部分，不删除旧文件
+
+
+MIN_SPLIT_SIZE = 1024 * 1024
+# 展开目录的时候小于这个的文件不分块，ftp sftp的每个block都要单独登录一次
+
+
+def changed_files(
+    dir_: str, files: List[Tuple[str, int, Optional[float]]]
+) -> List[Tuple[str, int, Optional[float], Optional[int]]]:
+    """
+    本地已经有的文件大小和修改时间都一样就跳过
+    :param dir_: 本地目录
+    :param files: [(/分隔的相对路径, 大小, 修改时间戳)]
+    :return: 需要下载的 [(相对路径, 大小, 修改时间戳, 本地文件的大小或者None)]
+    """
+    result = []
+    for relpath, filesize, mtime in files:
+        try:
+            stat = os.stat(os.path.join(dir_, *relpath.split("/")))
+        except FileNotFoundError:
+            result.append((relpath, filesize, mtime, None))
+            continue
+        if stat.st_size != filesize or (
+            mtime is not None and abs(stat.st_mtime - mtime) >= 1
+        ):
+            result.append((relpath, filesize, mtime, stat.st_size))
+    return result
+
+
 class HandlerMeta(type):
     handlers = {}  # type: Dict[str, Type[HandlerBase]]
 
@@ -18,11 +63,39 @@ class HandlerMeta(type):
         return tp
 
 
+builtin_handlers = {
+    "http": "pygetex.handler.http.HTTPHandler",
+    "https": "pygetex.handler.http.HTTPHandler",
+    "ftp": "pygetex.handler.ftp.FTPHandler",
+    "ftps": "pygetex.handler.ftp.FTPHandler",
+    "sftp": "pygetex.handler.sftp.SFTPHandler",
+}  # scheme -> handler，用到的时候才import
+
+
+def get_lazy_handlers() -> Dict[str, str]:
+    """
+    内置handler加上第三方包通过entry point注册的handler
+    entry point的group是pygetex.handlers，name是scheme，value是handler类
+
+        [project.entry-points."pygetex.handlers"]
+        magnet = "mypackage.handler:MagnetHandler"
+
+    :return: scheme -> 导入路径
+    """
+    handlers = dict(builtin_handlers)
+    for ep in entry_points(group="pygetex.handlers"):
+        handlers[ep.name.lower()] = ep.value.replace(":", ".")
+    return handlers
+
+
 class HandlerBase(metaclass=HandlerMeta):
     """
     建议只识别http ftp之类的基础协议，其余的给plugin完成
     """
 
+    name: str
+    downloader_option: str  # config里面downloader类的导入路径是哪一项
+
     def __init__(self, process: "CoreProcess"):
         self.process = process
         self.config = process.config
@@ -48,3 +121,92 @@ class HandlerBase(metaclass=HandlerMeta):
         :return:
         """
         return None, "", False  # make mypy happy
+
+    async def get_validators(
+        self, uri: str, since: float, **options
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        下载完成之后给内容缓存用，以后过期了拿它们做条件请求
+        :param uri:
+        :param since: 开始下载的时间戳，之后又改过的话返回的validator对不上下好的文件
+        :return: ETag, Last-Modified，不支持或者不可信的时候是None
+        """
+        return None, None
+
+    async def revalidate(
+        self, uri: str, etag: Optional[str], last_modified: Optional[str], **options
+    ) -> bool:
+        """
+        问源站缓存的内容还是不是最新的
+        :param uri:
+        :param etag:
+        :param last_modified:
+        :return: 没变是True，变了或者问不了是False
+        """
+        return False
+
+    async def expand(self, uri: str, **options) -> Optional[List[ExpandedFile]]:
+        """
+        uri代表一批文件(比如ftp目录)的时候展开，core直接用返回的元数据批量创建任务，
+        不再对每个文件调用get_file_metadata
+        :param uri:
+        :param options:
+        :return: None表示uri就是单个文件
+        """
+        return None
+
+    @classmethod
+    async def open_block(
+        cls, downloader: Any, uri: str, block: List[int], config: Config
+    ) -> AsyncReader:
+        """
+        支持分块下载的handler实现这个，返回[block[0], block[1]]这一段的body
+        :param downloader:
+        :param uri:
+        :param block:
+        :param config:
+        :return:
+        """
+        ...
+
+    async def close(self) -> None:
+        """
+        CoreProcess关闭的时候调用，释放handler自己持有的连接之类的
+        :return:
+        """
+
+    async def write_body(
+        self,
+        uri: str,
+        body_iter: AsyncReader,
+        file: Any,
+        block: List[int],
+        config: Config,
+    ) -> None:
+        """
+        把body_iter的内容写进file，block[0]是下一个要写的位置，每写一个chunk就往后推
+        collector和handler引用同一个block，靠这个统计进度
+        :param uri:
+        :param body_iter:
+        :param file: 文件句柄，特定于系统
+        :param block: [start, end]
+        :param config:
+        :return:
+        """
+        metrics = self.process.metrics
+        received = metrics.received_bytes.labels(self.name, urlparse(uri).hostname)
+        write_seconds = metrics.write_seconds.labels(config.fileio)
+        connections = metrics.connections.labels(self.name)
+        connections.inc()
+        try:
+            async for chunk in body_iter:
+                start = perf_counter()
+                if config.fileio_async:
+                    await pwrite_async(config, file, chunk, block[0])
+                else:
+                    pwrite(config, file, chunk, block[0])
+                write_seconds.observe(perf_counter() - start)
+                block[0] += len(chunk)
+                received.inc(len(chunk))
+        finally:
+            connections.dec()
@@ -5,12 +5,12 @@ import pickle
 import re
 import traceback
 from typing import TYPE_CHECKING, Any, List, Optional, Tuple, Type, cast
+from urllib.parse import quote, unquote, urljoin, urlparse
 
 from pygetex.config import Config, update_config
-from pygetex.downloader import FTPDownloaderBase
-from pygetex.fileio import pwrite, pwrite_async
+from pygetex.downloader import AsyncReader, FTPDownloaderBase
 from pygetex.fileio.utils import open_fd_with_config, pre_alloc_file
-from pygetex.handler import HandlerBase
+from pygetex.handler import MIN_SPLIT_SIZE, ExpandedFile, HandlerBase, changed_files
 from pygetex.task import DownloadTask
 from pygetex.utils.misc import get_divisional_range, load_object
 
@@ -19,6 +19,9 @@ if TYPE_CHECKING:
 
 
 class FTPHandler(HandlerBase):
+    name = "ftp"
+    downloader_option = "ftp_downloader"
+
     def __init__(self, process: "CoreProcess"):
         super().__init__(process)
         self.scope = re.compile(r"^ftps??://\S+")
@@ -53,17 +56,13 @@ class FTPHandler(HandlerBase):
                 split_result = [[0, task.filesize or -1]]
                 self.process.collector.task_add(task.id, split_result)  # type: ignore
                 try:
-                    async for chunk in body_iter:
-                        if temp_config.fileio_async:
-                            await pwrite_async(
-                                temp_config, wrapped_fd, chunk, split_result[0][0]
-                            )
-                        else:
-                            pwrite(temp_config, wrapped_fd, chunk, split_result[0][0])
-                        split_result[0][0] += len(chunk)
+                    await self.write_body(
+                        task.uri, body_iter, wrapped_fd, split_result[0], temp_config
+                    )
                 except asyncio.CancelledError:
                     raise
                 except Exception as e:
+                    self.process.metrics.errors.labels(self.name).inc()
                     await self.process.collector.task_error(task.id)  # type: ignore
                     self.process.dispatch_nowait(
                         "on_download_error", task.id, e, traceback.format_exc()
@@ -88,28 +87,38 @@ class FTPHandler(HandlerBase):
                 self.process.collector.task_add(task.id, split_result)  # type: ignore
                 tasks = []
                 for block_index in range(len(split_result)):
-                    tasks.append(
-                        asyncio.create_task(
-                            self.block_download(
-                                task,
-                                wrapped_fd,
-                                split_result,
-                                block_index,
-                                downloader,
-                                temp_config,
-                            )
+                    if self.process.workers is not None:  # 多进程模式，block交给worker
+                        block_coro = self.process.workers.download_block(
+                            self,
+                            task.uri,
+                            task.path,
+                            split_result[block_index],
+                            cast(dict, task.options),
+                            temp_config,
                         )
-                    )
+                    else:
+                        block_coro = self.block_download(
+                            task,
+                            wrapped_fd,
+                            split_result,
+                            block_index,
+                            downloader,
+                            temp_config,
+                        )
+                    tasks.append(asyncio.create_task(block_coro))
                 try:
                     await asyncio.gather(*tasks)
                 except asyncio.CancelledError:
                     raise
                 except Exception as e:
+                    self.process.metrics.errors.labels(self.name).inc()
                     await self.process.collector.task_error(task.id)  # type: ignore
                     self.process.dispatch_nowait(
                         "on_download_error", task.id, e, traceback.format_exc()
                     )
                     raise e
+            if (mtime := cast(dict, task.options).get("mtime")) is not None:
+                os.utime(path, (mtime, mtime))  # 下次镜像的时候靠它判断文件有没有变
         finally:
             await downloader.close()
             os.close(raw_fd)
@@ -129,6 +138,60 @@ class FTPHandler(HandlerBase):
         finally:
             await downloader.close()
 
+    async def expand(self, uri: str, **options) -> Optional[List[ExpandedFile]]:
+        """
+        以/结尾的uri当成目录递归镜像到 dir/目录名/ 下，本地没变的文件跳过
+        :param uri:
+        :param options:
+        :return:
+        """
+        parsed = urlparse(uri)
+        if not parsed.path.endswith("/"):
+            return None
+        temp_config = update_config(self.config, **options)
+        downloader_cls: Type = load_object(temp_config.ftp_downloader)
+        downloader = downloader_cls(temp_config)  # type: FTPDownloaderBase
+        try:
+            files = await downloader.list_tree(uri)
+        finally:
+            await downloader.close()
+        top = os.path.basename(unquote(parsed.path).rstrip("/")) or parsed.hostname
+        files = await asyncio.get_running_loop().run_in_executor(
+            self.process._cleanup_executor,
+            changed_files,
+            os.path.join(options.get("dir", None) or self.config.dir, top),  # type: ignore
+            files,
+        )  # 几万个文件的stat放到线程里
+        split = temp_config.split
+        return [
+            ExpandedFile(
+                uri=urljoin(uri, quote(relpath)),
+                filesize=filesize,
+                path=os.path.join(top, *relpath.split("/")),  # type: ignore
+                support_range=split > 1 and filesize >= max(split, MIN_SPLIT_SIZE),
+                options={**options, "mtime": mtime},
+            )
+            for relpath, filesize, mtime, _ in files
+        ]
+
+    @classmethod
+    async def open_block(
+        cls,
+        downloader: FTPDownloaderBase,
+        uri: str,
+        block: List[int],
+        config: Config,
+    ) -> AsyncReader:
+        """
+        请求block这一段，worker进程也会用到，所以不能依赖self
+        :param downloader:
+        :param uri:
+        :param block: [start, end]
+        :param config:
+        :return: body_iter
+        """
+        return await downloader.download(uri, block[0], block[1] - block[0] + 1)
+
     async def block_download(
         self,
         task: DownloadTask,
@@ -148,18 +211,13 @@ class FTPHandler(HandlerBase):
         :param config:
         :return:
         """
-        body_iter = await downloader.download(
-            task.uri,
-            ranges[block_index][0],
-            ranges[block_index][1] - ranges[block_index][0] + 1,
+        body_iter = await self.open_block(
+            downloader, task.uri, ranges[block_index], config
         )
         try:
-            async for chunk in body_iter:
-                if config.fileio_async:
-                    await pwrite_async(config, file, chunk, ranges[block_index][0])
-                else:
-                    pwrite(config, file, chunk, ranges[block_index][0])
-                ranges[block_index][0] += len(chunk)
+            await self.write_body(
+                task.uri, body_iter, file, ranges[block_index], config
+            )
             assert ranges[block_index][0] == ranges[block_index][1] + 1  # 确保这个block是完整的
         finally:
             await body_iter.close()
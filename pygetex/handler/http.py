@@ -4,25 +4,92 @@ import os
 import pickle
 import re
 import traceback
-from typing import TYPE_CHECKING, Any, List, Optional, Tuple, Type, cast
+from time import perf_counter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Coroutine,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    cast,
+)
+from urllib.parse import urlparse
 
 from pygetex.config import Config, update_config
-from pygetex.downloader.aiohttpdownloader import HTTPDownloaderBase
+from pygetex.downloader import AsyncReader, HTTPDownloaderBase
 from pygetex.fileio import pwrite, pwrite_async
-from pygetex.fileio.utils import open_fd_with_config, pre_alloc_file
+from pygetex.fileio.decompress import (
+    StreamingDecompressor,
+    detect_format,
+    load_checkpoint,
+    output_name,
+)
+from pygetex.fileio.utils import (
+    open_fd_with_config,
+    pre_alloc_file,
+    write_file_atomic,
+)
 from pygetex.handler import HandlerBase
 from pygetex.task import DownloadTask
-from pygetex.utils.http import guess_file_metadata
+from pygetex.utils.http import (
+    get_validators,
+    guess_file_metadata,
+    re_content_range_start_compiled,
+    revalidate,
+)
 from pygetex.utils.misc import get_divisional_range, load_object
 
 if TYPE_CHECKING:
     from pygetex.core import CoreProcess
 
+LOCAL_OPTIONS = frozenset(
+    (
+        "dir",
+        "out",
+        "priority",
+        "deadline",
+        "sequential",
+        "decompress",
+        "postprocess",
+        "postprocess_done",
+        "mirrors",
+        "peer_trust",
+        "no_cache",
+    )
+)  # 只影响保存和排队，不影响请求的options
+DECOMPRESS_CHUNK = 1024 * 1024  # 攒够这么多压缩数据再丢给线程解压
+
 
 class HTTPHandler(HandlerBase):
+    name = "http"
+    downloader_option = "http_downloader"
+
     def __init__(self, process: "CoreProcess"):
         super().__init__(process)
         self.scope = re.compile(r"^https??://\S+")
+        self._downloader = None  # type: Optional[HTTPDownloaderBase]
+        # 用全局config的任务共用这个downloader，连接池不用每次重新建
+
+    def get_downloader(self, options: dict) -> Tuple[Config, HTTPDownloaderBase, bool]:
+        """
+        options不影响请求的时候直接用全局config和共用的downloader，不用新建session
+        :param options: 任务的options
+        :return: config, downloader, 用完之后要不要close
+        """
+        if options.keys() <= LOCAL_OPTIONS:
+            if self._downloader is None:
+                self._downloader = load_object(self.config.http_downloader)(self.config)
+            return self.config, self._downloader, False  # type: ignore
+        temp_config = update_config(self.config, **options)
+        downloader_cls: Type = load_object(temp_config.http_downloader)  # type: ignore
+        return temp_config, downloader_cls(temp_config), True
+
+    async def close(self) -> None:
+        if self._downloader is not None:
+            await self._downloader.close()
+            self._downloader = None
 
     async def check_scope(self, uri: str) -> bool:
         if self.scope.match(uri):
@@ -38,6 +105,17 @@ class HTTPHandler(HandlerBase):
         """
         self.process.collector.task_add(task.id, [[0, -1]])  # type: ignore # 占坑，防止后面报错时删除无门
         temp_config = update_config(self.config, **cast(dict, task.options))
+        if (
+            not resume
+            and not temp_config.decompress
+            and task.filesize is not None
+            and task.filesize <= self.config.small_file_size
+        ):
+            await self.small_download(task)
+            return
+        if temp_config.decompress and not task.support_range:
+            await self.decompress_download(task, temp_config)
+            return
         downloader_cls: Type = load_object(temp_config.http_downloader)  # type: ignore
         downloader = downloader_cls(temp_config)
         path = task.path
@@ -48,6 +126,8 @@ class HTTPHandler(HandlerBase):
         if task.filesize and not resume:
             pre_alloc_file(path, task.filesize)
         raw_fd, wrapped_fd = open_fd_with_config(path, temp_config)
+        decompressor = None  # type: Optional[StreamingDecompressor]
+        follower = None  # type: Optional[asyncio.Task]
         try:
             if not task.support_range:
                 status, headers, body_iter = await downloader.download(
@@ -61,17 +141,13 @@ class HTTPHandler(HandlerBase):
                 self.process.collector.task_add(task.id, split_result)  # type: ignore
                 # collector和自己引用同一个split_result对象，利用下浅拷贝的性质
                 try:
-                    async for chunk in body_iter:
-                        if temp_config.fileio_async:
-                            await pwrite_async(
-                                temp_config, wrapped_fd, chunk, split_result[0][0]
-                            )
-                        else:
-                            pwrite(temp_config, wrapped_fd, chunk, split_result[0][0])
-                        split_result[0][0] += len(chunk)
+                    await self.write_body(
+                        task.uri, body_iter, wrapped_fd, split_result[0], temp_config
+                    )
                 except asyncio.CancelledError:
                     raise
                 except Exception as e:
+                    self.process.metrics.errors.labels(self.name).inc()
                     await self.process.collector.task_error(task.id)  # type: ignore
                     self.process.dispatch_nowait(
                         "on_download_error", task.id, e, traceback.format_exc()
@@ -81,6 +157,12 @@ class HTTPHandler(HandlerBase):
                     await body_iter.close()
             else:
                 assert task.filesize is not None
+                split = await self.get_split(task.uri, downloader, temp_config)
+                pieces = split
+                if temp_config.sequential:
+                    pieces = max(
+                        split, -(-task.filesize // temp_config.stream_piece_size)
+                    )
                 tempfile = task.path + self.config.tempfile_suffix  # type: ignore
                 if resume and os.path.exists(tempfile):
                     with open(tempfile, "rb") as f:
@@ -88,55 +170,341 @@ class HTTPHandler(HandlerBase):
                             split_result = pickle.load(f)
                         except pickle.UnpicklingError:
                             split_result = get_divisional_range(
-                                task.filesize, temp_config.split
+                                task.filesize, pieces
                             )  # 交给statcollector处理
                 else:
                     split_result = get_divisional_range(
-                        task.filesize, temp_config.split
+                        task.filesize, pieces
                     )  # 交给statcollector处理
                 self.process.collector.task_add(task.id, split_result)  # type: ignore
-                tasks = []
-                for block_index in range(len(split_result)):
-                    tasks.append(
-                        asyncio.create_task(
-                            self.block_download(
-                                task,
-                                wrapped_fd,
-                                split_result,
-                                block_index,
-                                downloader,
-                                temp_config,
-                            )
+                if temp_config.decompress:  # 连续写好的部分一边下载一边解压
+                    try:
+                        decompressor = self.open_decompressor(task, temp_config, resume)
+                    except Exception as e:  # 猜不出格式，不然任务一直停在downloading
+                        self.process.metrics.errors.labels(self.name).inc()
+                        await self.process.collector.task_error(task.id)  # type: ignore
+                        self.process.dispatch_nowait(
+                            "on_download_error", task.id, e, traceback.format_exc()
                         )
+                        raise e
+                    follower = asyncio.create_task(
+                        self.decompress_stream(task, decompressor)
                     )
+
+                uris = self.mirror_uris(task)
+
+                def block_coro(block_index: int) -> Coroutine[Any, Any, None]:
+                    if self.process.workers is not None:  # 多进程模式，block交给worker
+                        return self.process.workers.download_block(
+                            self,
+                            uris[block_index % len(uris)],
+                            task.path,
+                            split_result[block_index],
+                            cast(dict, task.options),
+                            temp_config,
+                        )
+                    return self.block_download(
+                        task,
+                        wrapped_fd,
+                        split_result,
+                        block_index,
+                        downloader,
+                        temp_config,
+                    )
+
+                if temp_config.sequential:
+                    # 切成很多小piece，split条连接谁空了谁去拿最靠前的那个，
+                    # 文件开头连续的部分涨得最快，open_stream可以边下边读
+                    indexes = iter(range(len(split_result)))
+
+                    async def pull() -> None:
+                        for block_index in indexes:
+                            await block_coro(block_index)
+
+                    tasks = [
+                        asyncio.create_task(pull())
+                        for _ in range(min(split, len(split_result)))
+                    ]
+                else:
+                    tasks = [
+                        asyncio.create_task(block_coro(block_index))
+                        for block_index in range(len(split_result))
+                    ]
                 try:
                     await asyncio.gather(*tasks)
+                    if follower is not None:
+                        await follower
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, decompressor.finish  # type: ignore
+                        )
                 except asyncio.CancelledError:
                     raise
                 except Exception as e:
+                    self.process.metrics.errors.labels(self.name).inc()
                     await self.process.collector.task_error(task.id)  # type: ignore
                     self.process.dispatch_nowait(
                         "on_download_error", task.id, e, traceback.format_exc()
                     )
                     raise e
         finally:
+            if follower is not None and not follower.done():
+                follower.cancel()
+                await asyncio.wait([follower])
+            if decompressor is not None:
+                decompressor.close()
             await downloader.close()
             os.close(raw_fd)
+        if decompressor is not None:
+            await self.finish_decompress(task, decompressor)
+
+    def open_decompressor(
+        self, task: DownloadTask, config: Config, resume: Optional[bool]
+    ) -> StreamingDecompressor:
+        """
+        检查点文件记着解压到哪里了，断点续传的时候从那个边界接着解压
+        :param task:
+        :param config:
+        :param resume: range下载的断点续传，压缩数据还在磁盘上
+        :return:
+        """
+        fmt = detect_format(task.path, config.decompress)  # type: ignore
+        if fmt is None:
+            raise ValueError(f"can not guess compression format of {task.path}")
+        checkpoint_path = task.path + self.config.tempfile_suffix + ".z"  # type: ignore
+        consumed = produced = 0
+        if (checkpoint := load_checkpoint(checkpoint_path)) is not None:
+            out_path = checkpoint[0]  # 不能换名字，不然上次写了一半的文件就没人管了
+            if resume and task.support_range:
+                consumed, produced = checkpoint[1:]
+        else:
+            out_path = self.process.paths.reserve(
+                os.path.dirname(task.path), os.path.basename(output_name(task.path))
+            )
+        return StreamingDecompressor(fmt, out_path, checkpoint_path, consumed, produced)
+
+    async def decompress_stream(
+        self, task: DownloadTask, decompressor: StreamingDecompressor
+    ) -> None:
+        """
+        跟着range下载连续写好的部分读压缩数据，在线程里解压
+        """
+        loop = asyncio.get_running_loop()
+        async for chunk in self.process.open_stream(
+            task.id, decompressor.consumed, DECOMPRESS_CHUNK  # type: ignore
+        ):
+            await loop.run_in_executor(None, decompressor.feed, chunk)
+
+    async def finish_decompress(
+        self, task: DownloadTask, decompressor: StreamingDecompressor
+    ) -> None:
+        """
+        解压完了，压缩文件没用了，任务的path换成解压出来的文件
+        """
+        for path in (task.path, task.path + self.config.tempfile_suffix):  # type: ignore
+            if os.path.exists(path):
+                os.remove(path)
+        task.path = decompressor.out_path
+        await self.process.collector.task_processed(task.id, task.path)  # type: ignore
+
+    async def decompress_download(self, task: DownloadTask, config: Config) -> None:
+        """
+        不支持range的下载，收到的数据直接解压写进输出文件，压缩数据不落盘。
+        不能断点续传，所以每次都从头解压
+        :param task:
+        :param config: 合并好options的config
+        :return:
+        """
+        request_config, downloader, owned = self.get_downloader(
+            cast(dict, task.options)
+        )
+        block = [0, task.filesize or -1]
+        self.process.collector.task_add(task.id, [block])  # type: ignore
+        metrics = self.process.metrics
+        received = metrics.received_bytes.labels(self.name, urlparse(task.uri).hostname)
+        connections = metrics.connections.labels(self.name)
+        connections.inc()
+        loop = asyncio.get_running_loop()
+        decompressor = None  # type: Optional[StreamingDecompressor]
+        try:
+            decompressor = self.open_decompressor(task, config, False)
+            status, headers, body_iter = await downloader.download(
+                task.uri,
+                getattr(request_config, "method", "GET"),
+                getattr(request_config, "headers", None),
+                getattr(request_config, "payload", None),
+            )
+            try:
+                data = bytearray()
+                async for chunk in body_iter:
+                    data += chunk
+                    received.inc(len(chunk))
+                    if len(data) >= DECOMPRESS_CHUNK:
+                        await loop.run_in_executor(None, decompressor.feed, bytes(data))
+                        block[0] += len(data)
+                        data.clear()
+                if data:
+                    await loop.run_in_executor(None, decompressor.feed, bytes(data))
+                    block[0] += len(data)
+            finally:
+                await body_iter.close()
+            await loop.run_in_executor(None, decompressor.finish)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.errors.labels(self.name).inc()
+            await self.process.collector.task_error(task.id)  # type: ignore
+            self.process.dispatch_nowait(
+                "on_download_error", task.id, e, traceback.format_exc()
+            )
+            raise e
+        finally:
+            if decompressor is not None:
+                decompressor.close()
+            connections.dec()
+            if owned:
+                await downloader.close()
+        await self.finish_decompress(task, decompressor)
+
+    async def small_download(self, task: DownloadTask) -> None:
+        """
+        小文件一个请求下载完，不分块不预分配不mmap，也没有断点续传，
+        攒在内存里一次写进临时文件再rename
+        :param task:
+        :return:
+        """
+        config, downloader, owned = self.get_downloader(cast(dict, task.options))
+        block = [0, task.filesize - 1]  # type: ignore
+        self.process.collector.task_add(task.id, [block])  # type: ignore
+        metrics = self.process.metrics
+        received = metrics.received_bytes.labels(self.name, urlparse(task.uri).hostname)
+        connections = metrics.connections.labels(self.name)
+        connections.inc()
+        try:
+            status, headers, body_iter = await downloader.download(
+                task.uri,
+                getattr(config, "method", "GET"),
+                getattr(config, "headers", None),
+                getattr(config, "payload", None),
+            )
+            try:
+                if status not in (200, 206):  # 错误页不能当成文件内容
+                    raise ValueError(f"{task.uri} answered {status}")
+                data = bytearray()
+                async for chunk in body_iter:
+                    data += chunk
+                    received.inc(len(chunk))
+            finally:
+                await body_iter.close()
+            if len(data) != task.filesize:
+                raise ValueError(f"got {len(data)} bytes, expect {task.filesize}")
+            start = perf_counter()
+            if config.fileio_async:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, write_file_atomic, task.path, data
+                )
+            else:
+                write_file_atomic(task.path, data)
+            metrics.write_seconds.labels("atomic").observe(perf_counter() - start)
+            block[0] += len(data)  # rename之后才算写好，open_stream靠block判断能读到哪
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.errors.labels(self.name).inc()
+            await self.process.collector.task_error(task.id)  # type: ignore
+            self.process.dispatch_nowait(
+                "on_download_error", task.id, e, traceback.format_exc()
+            )
+            raise e
+        finally:
+            connections.dec()
+            if owned:
+                await downloader.close()
 
     async def get_file_metadata(
         self, uri: str, **options
     ) -> Tuple[Optional[int], str, bool]:
-        temp_config = update_config(self.config, **options)
-        downloader_cls: Type = load_object(temp_config.http_downloader)
-        downloader = downloader_cls(temp_config)
+        temp_config, downloader, owned = self.get_downloader(options)
         try:
             filesize, filename, support_range = await guess_file_metadata(
                 downloader, uri, temp_config
             )
-            filename = temp_config.out or filename
+            filename = options.get("out", None) or temp_config.out or filename
             return filesize, filename, support_range
         finally:
-            await downloader.close()
+            if owned:
+                await downloader.close()
+
+    async def get_validators(
+        self, uri: str, since: float, **options
+    ) -> Tuple[Optional[str], Optional[str]]:
+        temp_config, downloader, owned = self.get_downloader(options)
+        try:
+            return await get_validators(downloader, uri, temp_config, since)
+        finally:
+            if owned:
+                await downloader.close()
+
+    async def revalidate(
+        self, uri: str, etag: Optional[str], last_modified: Optional[str], **options
+    ) -> bool:
+        temp_config, downloader, owned = self.get_downloader(options)
+        try:
+            return await revalidate(downloader, uri, temp_config, etag, last_modified)
+        finally:
+            if owned:
+                await downloader.close()
+
+    @staticmethod
+    async def get_split(
+        uri: str, downloader: HTTPDownloaderBase, config: Config
+    ) -> int:
+        """
+        HTTP/2的时候block都在一两条连接上复用，超过服务器允许的stream数只会排队
+        :param uri:
+        :param downloader:
+        :param config:
+        :return: 分多少块
+        """
+        split = config.split
+        if (limit := await downloader.stream_limit(uri)) is not None:
+            split = min(split, limit)
+        return split
+
+    @classmethod
+    async def open_block(
+        cls,
+        downloader: HTTPDownloaderBase,
+        uri: str,
+        block: List[int],
+        config: Config,
+    ) -> AsyncReader:
+        """
+        请求block这一段，worker进程也会用到，所以不能依赖self
+        :param downloader:
+        :param uri:
+        :param block: [start, end]
+        :param config:
+        :return: body_iter
+        """
+        headers = dict(
+            getattr(config, "headers", None) or {}
+        )  # 复制一份，各个block并发请求，不能改同一个dict
+        headers["Range"] = f"bytes={block[0]}-{block[1]}"
+        status, headers, body_iter = await downloader.download(
+            uri,
+            method=getattr(config, "method", "GET"),
+            headers=headers,
+            payload=getattr(config, "payload", None),
+        )
+        content_range = headers.get("Content-Range") or headers.get("content-range")
+        m = re_content_range_start_compiled.match(content_range or "")
+        if status != 206 or m is None or int(m.group(1)) != block[0]:
+            # 镜像挂了返回的错误页、忽略Range给的整个文件，都不能写进这个block
+            await body_iter.close()
+            raise ValueError(
+                f"{uri} answered {status} {content_range!r} for range {block[0]}-{block[1]}"
+            )
+        return body_iter
 
     async def block_download(
         self,
@@ -157,28 +525,91 @@ class HTTPHandler(HandlerBase):
         :param config:
         :return:
         """
-        headers = getattr(config, "headers", None)
-        if headers is None:
-            headers = {
-                "Range": f"bytes={ranges[block_index][0]}-{ranges[block_index][1]}"
-            }
-        else:
-            headers.update(
-                {"Range": f"bytes={ranges[block_index][0]}-{ranges[block_index][1]}"}
-            )
-        status, headers, body_iter = await downloader.download(
-            task.uri,
-            method=getattr(config, "method", "GET"),
-            headers=headers,
-            payload=getattr(config, "payload", None),
-        )
+        if self.process.peers is not None and not downloader.direct_write:
+            await self.peer_download(task, file, ranges[block_index], config)
+            if ranges[block_index][0] > ranges[block_index][1]:
+                return  # 整个block都从peer拿到了
+        uris = self.mirror_uris(task)
+        for attempt in range(len(uris)):
+            uri = uris[(block_index + attempt) % len(uris)]  # block分散到各个镜像
+            try:
+                if downloader.direct_write:  # 比如libcurl直接写文件，这边只管统计
+                    await self.direct_block_download(
+                        uri, task.path, ranges[block_index], downloader
+                    )
+                    return
+                body_iter = await self.open_block(
+                    downloader, uri, ranges[block_index], config
+                )
+                try:
+                    await self.write_body(
+                        uri, body_iter, file, ranges[block_index], config
+                    )
+                    assert ranges[block_index][0] == ranges[block_index][1] + 1  # 确保这个block是完整的
+                finally:
+                    await body_iter.close()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == len(uris) - 1:
+                    raise
+                print(f"block {block_index} failed on {uri}: {e!r}, try next mirror")
+                # block[0]已经推进到写好的地方，下一个镜像接着下载剩下的
+
+    async def peer_download(
+        self, task: DownloadTask, file: Any, block: List[int], config: Config
+    ) -> None:
+        """
+        block开头peer有的部分先从peer拿，拿不到了剩下的再交给源站
+        :param task:
+        :param file: 文件句柄，特定于系统
+        :param block: [start, end]
+        :param config:
+        :return:
+        """
+        peers = self.process.peers
+        assert peers is not None
+        metrics = self.process.metrics
+        received = metrics.received_bytes.labels(self.name, "peer")
+        write_seconds = metrics.write_seconds.labels(config.fileio)
+        while block[0] <= block[1]:
+            data = await peers.fetch(task, block[0], block[1], config)
+            if not data:
+                return
+            start = perf_counter()
+            if config.fileio_async:
+                await pwrite_async(config, file, data, block[0])
+            else:
+                pwrite(config, file, data, block[0])
+            write_seconds.observe(perf_counter() - start)
+            block[0] += len(data)
+            received.inc(len(data))
+
+    @staticmethod
+    def mirror_uris(task: DownloadTask) -> List[str]:
+        """
+        task.uri加上options里的mirrors，按优先级排好了
+        """
+        return [task.uri, *(task.options or {}).get("mirrors", ())]  # type: ignore
+
+    async def direct_block_download(
+        self, uri: str, path: str, block: List[int], downloader: HTTPDownloaderBase
+    ):
+        """
+        downloader自己写文件，handler只统计进度
+        :param uri:
+        :param path: 预分配好的文件
+        :param block: [start, end]
+        :param downloader:
+        :return:
+        """
+        metrics = self.process.metrics
+        received = metrics.received_bytes.labels(self.name, urlparse(uri).hostname)
+        connections = metrics.connections.labels(self.name)
+        connections.inc()
         try:
-            async for chunk in body_iter:
-                if config.fileio_async:
-                    await pwrite_async(config, file, chunk, ranges[block_index][0])
-                else:
-                    pwrite(config, file, chunk, ranges[block_index][0])
-                ranges[block_index][0] += len(chunk)
-            assert ranges[block_index][0] == ranges[block_index][1] + 1  # 确保这个block是完整的
+            await downloader.download_to_file(uri, path, block, received.inc)
         finally:
-            await body_iter.close()
+            connections.dec()
+        assert block[0] == block[1] + 1  # 确保这个block是完整的
@@ -5,21 +5,33 @@ import pickle
 import re
 import traceback
 from typing import TYPE_CHECKING, Any, List, Optional, Tuple, Type, cast
+from urllib.parse import quote, unquote, urljoin, urlparse
 
 from pygetex.config import Config, update_config
-from pygetex.downloader import FTPDownloaderBase
-from pygetex.fileio import pwrite, pwrite_async
+from pygetex.downloader import AsyncReader, FTPDownloaderBase
 from pygetex.fileio.utils import open_fd_with_config, pre_alloc_file
-from pygetex.handler import HandlerBase
+from pygetex.handler import MIN_SPLIT_SIZE, ExpandedFile, HandlerBase, changed_files
 from pygetex.task import DownloadTask
 from pygetex.utils.misc import get_divisional_range, load_object
 
 if TYPE_CHECKING:
     from pygetex.core import CoreProcess
 
+APPEND_CHECK_SIZE = 64 * 1024
+# 比较本地文件末尾这么多字节，和远端一样就认为远端只是追加了内容
+
+
+def read_tail(path: str, offset: int, count: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(count)
+
 
 # todo 这个很像ftphandler，要不要合并？直接继承？
 class SFTPHandler(HandlerBase):
+    name = "sftp"
+    downloader_option = "sftp_downloader"
+
     def __init__(self, process: "CoreProcess"):
         super().__init__(process)
         self.scope = re.compile(r"^sftp??://\S+")
@@ -45,26 +57,30 @@ class SFTPHandler(HandlerBase):
         #     while os.path.exists(path):
         #         dir_, ext = os.path.splitext(path)
         #         path = dir_ + "(1)" + ext
+        offset = cast(dict, task.options).get("resume_offset", 0)  # 只下载追加的部分
         if task.filesize and not resume:  # ftp一般是可以知道文件大小的
-            pre_alloc_file(path, task.filesize)
+            if offset:
+                os.truncate(path, task.filesize)  # 保留前面已有的内容
+            else:
+                pre_alloc_file(path, task.filesize)
         raw_fd, wrapped_fd = open_fd_with_config(path, temp_config)
         try:
             if not task.support_range:
-                body_iter = await downloader.download(task.uri, 0, task.filesize)
-                split_result = [[0, task.filesize or -1]]
+                body_iter = await downloader.download(
+                    task.uri,
+                    offset,
+                    task.filesize - offset if task.filesize else task.filesize,
+                )
+                split_result = [[offset, task.filesize or -1]]
                 self.process.collector.task_add(task.id, split_result)  # type: ignore
                 try:
-                    async for chunk in body_iter:
-                        if temp_config.fileio_async:
-                            await pwrite_async(
-                                temp_config, wrapped_fd, chunk, split_result[0][0]
-                            )
-                        else:
-                            pwrite(temp_config, wrapped_fd, chunk, split_result[0][0])
-                        split_result[0][0] += len(chunk)
+                    await self.write_body(
+                        task.uri, body_iter, wrapped_fd, split_result[0], temp_config
+                    )
                 except asyncio.CancelledError:
                     raise
                 except Exception as e:
+                    self.process.metrics.errors.labels(self.name).inc()
                     await self.process.collector.task_error(task.id)  # type: ignore
                     self.process.dispatch_nowait(
                         "on_download_error", task.id, e, traceback.format_exc()
@@ -79,42 +95,60 @@ class SFTPHandler(HandlerBase):
                         try:
                             split_result = pickle.load(f)
                         except pickle.UnpicklingError:
-                            split_result = get_divisional_range(
-                                task.filesize, temp_config.split  # type: ignore
-                            )  # 交给statcollector处理
+                            split_result = self.split_range(task, offset, temp_config)
                 else:
-                    split_result = get_divisional_range(
-                        task.filesize, temp_config.split  # type: ignore
-                    )  # 交给statcollector处理
+                    split_result = self.split_range(task, offset, temp_config)
                 self.process.collector.task_add(task.id, split_result)  # type: ignore
                 tasks = []
                 for block_index in range(len(split_result)):
-                    tasks.append(
-                        asyncio.create_task(
-                            self.block_download(
-                                task,
-                                wrapped_fd,
-                                split_result,
-                                block_index,
-                                downloader,
-                                temp_config,
-                            )
+                    if self.process.workers is not None:  # 多进程模式，block交给worker
+                        block_coro = self.process.workers.download_block(
+                            self,
+                            task.uri,
+                            task.path,
+                            split_result[block_index],
+                            cast(dict, task.options),
+                            temp_config,
                         )
-                    )
+                    else:
+                        block_coro = self.block_download(
+                            task,
+                            wrapped_fd,
+                            split_result,
+                            block_index,
+                            downloader,
+                            temp_config,
+                        )
+                    tasks.append(asyncio.create_task(block_coro))
                 try:
                     await asyncio.gather(*tasks)
                 except asyncio.CancelledError:
                     raise
                 except Exception as e:
+                    self.process.metrics.errors.labels(self.name).inc()
                     await self.process.collector.task_error(task.id)  # type: ignore
                     self.process.dispatch_nowait(
                         "on_download_error", task.id, e, traceback.format_exc()
                     )
                     raise e
+            if (mtime := cast(dict, task.options).get("mtime")) is not None:
+                os.utime(path, (mtime, mtime))  # 下次同步的时候靠它判断文件有没有变
         finally:
             await downloader.close()
             os.close(raw_fd)
 
+    @staticmethod
+    def split_range(task: DownloadTask, offset: int, config: Config) -> List[List[int]]:
+        """
+        把[offset, filesize)分块，交给statcollector处理
+        """
+        return [
+            [start + offset, end + offset]
+            for start, end in get_divisional_range(
+                task.filesize - offset, config.split  # type: ignore
+            )
+        ]
+
     async def get_file_metadata(
         self, uri: str, **options
     ) -> Tuple[Optional[int], str, bool]:
@@ -130,6 +164,97 @@ class SFTPHandler(HandlerBase):
         finally:
             await downloader.close()
 
+    async def expand(self, uri: str, **options) -> Optional[List[ExpandedFile]]:
+        """
+        以/结尾的uri当成目录同步到 dir/目录名/ 下，没变的文件跳过，
+        本地文件是远端的前缀的话只下载追加的部分
+        :param uri:
+        :param options:
+        :return:
+        """
+        parsed = urlparse(uri)
+        if not parsed.path.endswith("/"):
+            return None
+        temp_config = update_config(self.config, **options)
+        downloader_cls: Type = load_object(temp_config.sftp_downloader)
+        downloader = downloader_cls(temp_config)
+        loop = asyncio.get_running_loop()
+        top = os.path.basename(unquote(parsed.path).rstrip("/")) or parsed.hostname
+        local_dir = os.path.join(options.get("dir", None) or self.config.dir, top)  # type: ignore
+        try:
+            files = await downloader.list_tree(uri)
+            files = await loop.run_in_executor(
+                self.process._cleanup_executor, changed_files, local_dir, files
+            )  # 几万个文件的stat放到线程里
+
+            semaphore = asyncio.Semaphore(
+                getattr(temp_config, "sftp_list_concurrency", 8)
+            )
+
+            async def append_offset(relpath: str, local_size: int) -> int:
+                count = min(APPEND_CHECK_SIZE, local_size)
+                async with semaphore:
+                    local, remote = await asyncio.gather(
+                        loop.run_in_executor(
+                            self.process._cleanup_executor,
+                            read_tail,
+                            os.path.join(local_dir, *relpath.split("/")),
+                            local_size - count,
+                            count,
+                        ),
+                        downloader.read(
+                            urljoin(uri, quote(relpath)), local_size - count, count
+                        ),
+                    )
+                return local_size if local == remote else 0
+
+            offsets = [0] * len(files)
+            candidates = [
+                i
+                for i, (_, filesize, _, local_size) in enumerate(files)
+                if local_size and local_size < filesize  # 可能只是追加了内容
+            ]
+            for i, offset in zip(
+                candidates,
+                await asyncio.gather(
+                    *(append_offset(files[i][0], files[i][3]) for i in candidates)
+                ),
+            ):
+                offsets[i] = offset
+        finally:
+            await downloader.close()
+        split = temp_config.split
+        return [
+            ExpandedFile(
+                uri=urljoin(uri, quote(relpath)),
+                filesize=filesize,
+                path=os.path.join(top, *relpath.split("/")),  # type: ignore
+                support_range=split > 1
+                and filesize - offset >= max(split, MIN_SPLIT_SIZE),
+                options={**options, "mtime": mtime},
+                offset=offset,
+            )
+            for (relpath, filesize, mtime, _), offset in zip(files, offsets)
+        ]
+
+    @classmethod
+    async def open_block(
+        cls,
+        downloader: FTPDownloaderBase,
+        uri: str,
+        block: List[int],
+        config: Config,
+    ) -> AsyncReader:
+        """
+        请求block这一段，worker进程也会用到，所以不能依赖self
+        :param downloader:
+        :param uri:
+        :param block: [start, end]
+        :param config:
+        :return: body_iter
+        """
+        return await downloader.download(uri, block[0], block[1] - block[0] + 1)
+
     async def block_download(
         self,
         task: DownloadTask,
@@ -149,18 +274,13 @@ class SFTPHandler(HandlerBase):
         :param config:
         :return:
         """
-        body_iter = await downloader.download(
-            task.uri,
-            ranges[block_index][0],
-            ranges[block_index][1] - ranges[block_index][0] + 1,
+        body_iter = await self.open_block(
+            downloader, task.uri, ranges[block_index], config
         )
         try:
-            async for chunk in body_iter:
-                if config.fileio_async:
-                    await pwrite_async(config, file, chunk, ranges[block_index][0])
-                else:
-                    pwrite(config, file, chunk, ranges[block_index][0])
-                ranges[block_index][0] += len(chunk)
+            await self.write_body(
+                task.uri, body_iter, file, ranges[block_index], config
+            )
             assert ranges[block_index][0] == ranges[block_index][1] + 1  # 确保这个block是完整的
         finally:
             await body_iter.close()
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
-from typing import TYPE_CHECKING, Dict, List, Optional, Type
+from typing import TYPE_CHECKING, Dict, List, Optional, Type, Union
+
+from pygetex.handler import ExpandedFile
 
 if TYPE_CHECKING:
     from pygetex.core import CoreProcess
@@ -20,6 +22,7 @@ class PluginBase(metaclass=PluginMeta):
     enabled: bool = True
     name: str
     description: str
+    timeout: Optional[float] = None  # hook超时时间，None则使用config.plugin_timeout
 
     def __init__(self, core: "CoreProcess"):
         ...
@@ -30,5 +33,11 @@ class PluginBase(metaclass=PluginMeta):
     async def on_shutdown(self):
         ...
 
-    async def on_add_uri(self, uri: str, **options) -> List[str]:
+    async def on_add_uri(self, uri: str, **options) -> List[Union[str, ExpandedFile]]:
+        """
+        :param uri: 用户添加的uri
+        :param options:
+        :return: 换成这些uri下载，都返回空的话下载uri本身。
+            ExpandedFile带着大小之类的元数据，core直接创建任务，不再探测
+        """
         return []
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Metalink(RFC 5854)清单，import这个模块就启用
+
+uri以.meta4 .metalink结尾或者带metalink=True的时候，边下载清单边解析，
+每个file直接变成带大小的任务，不再逐个探测:
+- url按priority排好，第一个是task.uri，是http的话其余http镜像放进options["mirrors"]，block分散到各个镜像
+- 有pieces就加一步pieces校验，没有就用整个文件的hash加一步checksum，放在用户的postprocess前面
+"""
+import asyncio
+import os
+import posixpath
+import xml.etree.ElementTree as ET
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from pygetex.handler import ExpandedFile
+from pygetex.plugin import PluginBase
+
+if TYPE_CHECKING:
+    from pygetex.core import CoreProcess
+
+READ_SIZE = 1024 * 1024
+HASH_PREFERENCE = ("sha-512", "sha-384", "sha-256", "sha-1", "md5")
+# 有好几个hash的时候用最强的那个
+MIRROR_SCHEMES = ("http", "https")  # 只有HTTPHandler会用mirrors
+
+
+class MetalinkFile(NamedTuple):
+    name: str  # /分隔的相对路径
+    size: Optional[int]
+    urls: List[str]  # 按priority排好
+    hash: Optional[Tuple[str, str]]  # (hashlib的算法名, hex)
+    pieces: Optional[Tuple[str, int, List[str]]]  # (算法名, piece长度, hex列表)
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _algo(hash_type: str) -> str:
+    """sha-256 -> sha256"""
+    return hash_type.lower().replace("-", "")
+
+
+def safe_name(name: str) -> Optional[str]:
+    """
+    RFC 5854 4.1.2.1，不能是绝对路径，不能有..
+    """
+    name = name.replace("\\", "/")
+    parts = name.split("/")
+    if not name or name.startswith("/") or ".." in parts or ":" in parts[0]:
+        return None
+    return posixpath.normpath(name)
+
+
+class MetalinkParser:
+    """
+    增量解析，feed多少解析多少，每个file解析完就清掉，上千个文件的清单也不会全留在内存里
+    """
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=("end",))
+
+    def feed(self, data: bytes) -> List[MetalinkFile]:
+        self._parser.feed(data)
+        return self._files()
+
+    def close(self) -> List[MetalinkFile]:
+        self._parser.close()
+        return self._files()
+
+    def _files(self) -> List[MetalinkFile]:
+        files = []
+        for _, elem in self._parser.read_events():
+            if _local(elem.tag) == "file":
+                if (file := self._parse_file(elem)) is not None:
+                    files.append(file)
+                elem.clear()
+        return files
+
+    @staticmethod
+    def _parse_file(elem: ET.Element) -> Optional[MetalinkFile]:
+        name = safe_name(elem.get("name", ""))
+        if name is None:
+            print(f"skip metalink file with unsafe name {elem.get('name')!r}")
+            return None
+        size = None  # type: Optional[int]
+        urls = []  # type: List[Tuple[int, int, str]]
+        hashes = {}  # type: Dict[str, str]
+        pieces = None  # type: Optional[Tuple[str, int, List[str]]]
+        for child in elem:
+            tag = _local(child.tag)
+            text = (child.text or "").strip()
+            if tag == "size" and text:
+                size = int(text)
+            elif tag == "url" and text:
+                # 没有priority的排在最后，同priority的保持原来的顺序
+                urls.append((int(child.get("priority", 999999)), len(urls), text))
+            elif tag == "hash" and text:
+                hashes[child.get("type", "").lower()] = text.lower()
+            elif tag == "pieces":
+                pieces = (
+                    _algo(child.get("type", "sha-1")),
+                    int(child.get("length", 0)),
+                    [
+                        (h.text or "").strip().lower()
+                        for h in child
+                        if _local(h.tag) == "hash"
+                    ],
+                )
+        if not urls:
+            print(f"skip metalink file {name} without url")
+            return None
+        digest = None  # type: Optional[Tuple[str, str]]
+        for hash_type in HASH_PREFERENCE:
+            if hash_type in hashes:
+                digest = (_algo(hash_type), hashes[hash_type])
+                break
+        return MetalinkFile(
+            name, size, [url for _, _, url in sorted(urls)], digest, pieces
+        )
+
+
+class MetalinkPlugin(PluginBase):
+    name = "metalink"
+    description = "create tasks from Metalink (RFC 5854) manifests"
+
+    def __init__(self, core: "CoreProcess"):
+        self.core = core
+        self.config = core.config
+
+    @staticmethod
+    def is_metalink(uri: str, options: dict) -> bool:
+        if options.get("metalink"):
+            return True
+        return urlparse(uri).path.lower().endswith((".meta4", ".metalink"))
+
+    async def on_add_uri(self, uri: str, **options) -> List[Any]:
+        if not self.is_metalink(uri, options):
+            return []
+        options.pop("metalink", None)
+        parser = MetalinkParser()
+        files = []  # type: List[ExpandedFile]
+        async for data in self._read(uri, options):
+            files.extend(self._expand(file, options) for file in parser.feed(data))
+        files.extend(self._expand(file, options) for file in parser.close())
+        print(f"metalink {uri}: {len(files)} files")
+        return files
+
+    async def _read(self, uri: str, options: dict):
+        """
+        清单可以是本地文件，也可以在服务器上，边下载边交给parser
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme in ("", "file"):
+            path = unquote(parsed.path) if parsed.scheme else uri
+            loop = asyncio.get_running_loop()
+            with open(path, "rb") as f:
+                while data := await loop.run_in_executor(None, f.read, READ_SIZE):
+                    yield data
+            return
+        handlers = await self.core._check_handler(uri)
+        if not handlers or not hasattr(handlers[0], "get_downloader"):
+            raise ValueError(f"can not fetch metalink {uri}")
+        config, downloader, owned = handlers[0].get_downloader(options)  # type: ignore
+        try:
+            status, headers, body_iter = await downloader.download(
+                uri, "GET", getattr(config, "headers", None)
+            )
+            try:
+                if status >= 400:
+                    raise ValueError(f"fetch metalink {uri}: HTTP {status}")
+                async for data in body_iter:
+                    yield data
+            finally:
+                await body_iter.close()
+        finally:
+            if owned:
+                await downloader.close()
+
+    def _expand(self, file: MetalinkFile, options: dict) -> ExpandedFile:
+        primary = file.urls[0]
+        mirrors = []  # type: List[str]
+        if urlparse(primary).scheme.lower() in MIRROR_SCHEMES:
+            mirrors = [
+                url
+                for url in file.urls[1:]
+                if urlparse(url).scheme.lower() in MIRROR_SCHEMES
+            ][: max(self.config.metalink_mirrors - 1, 0)]
+        steps = []  # type: List[Dict[str, Any]]
+        if file.pieces is not None and file.pieces[1] > 0 and file.pieces[2]:
+            algo, length, hashes = file.pieces
+            steps.append(
+                {"op": "pieces", "algo": algo, "length": length, "hashes": hashes}
+            )
+        elif file.hash is not None:
+            steps.append(
+                {"op": "checksum", "algo": file.hash[0], "digest": file.hash[1]}
+            )
+        task_options = dict(options)
+        if mirrors:
+            task_options["mirrors"] = mirrors
+        if steps:
+            task_options["postprocess"] = steps + list(options.get("postprocess") or ())
+        return ExpandedFile(
+            uri=primary,
+            filesize=file.size,
+            path=os.path.join(*file.name.split("/")),
+            support_range=file.size is not None,  # 镜像站都支持range
+            options=task_options,
+        )
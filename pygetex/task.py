@@ -80,3 +80,13 @@ class DownloadTask(SQLModel, table=True):
         "downloading", description="download status"
     )  # Literal["downloading", "paused", "stopped", "complete", "error"]
     speed: Optional[float] = Field(0.0, description="download speed")
+
+
+class TaskLease(SQLModel, table=True):
+    # 集群模式下哪个节点在下载这个任务，过期了别的节点可以抢过来
+    __tablename__ = "task_lease"
+    task_id: int = Field(..., primary_key=True)
+    owner: Optional[str] = Field(None, description="node_id of the owner")
+    expires: float = Field(0.0, description="unix time when the lease expires")
+    remaining: Optional[int] = Field(None, description="bytes left to download")
+    speed: float = Field(0.0, description="download speed")
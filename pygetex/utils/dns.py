@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+进程内所有downloader共用的DNS缓存，建连接之前从这里拿地址
+
+- 查到的地址缓存dns_ttl秒，查不到的缓存dns_negative_ttl秒，同一个host同时只查一次
+- dns_hosts把host钉在给定的ip上，不查DNS
+- dns_spread打开之后每次返回的地址轮换一下，一个文件的多个block连到不同的A记录上
+- connect_socket按RFC 8305交替IPv6和IPv4，每隔happy_eyeballs_delay多开一个连接，先连上的用
+"""
+import asyncio
+import ipaddress
+import socket
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+Address = Tuple[int, tuple]  # (family, sockaddr)
+CacheKey = Tuple[str, int, int]  # (host, port, family)
+
+
+def is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def literal_address(ip: str, port: int) -> Address:
+    if ipaddress.ip_address(ip).version == 6:
+        return socket.AF_INET6, (ip, port, 0, 0)
+    return socket.AF_INET, (ip, port)
+
+
+def interleave(addresses: List[Address]) -> List[Address]:
+    """
+    第一个地址的family打头，然后两种family交替
+    """
+    if not addresses:
+        return addresses
+    first = [a for a in addresses if a[0] == addresses[0][0]]
+    rest = [a for a in addresses if a[0] != addresses[0][0]]
+    result = []  # type: List[Address]
+    for i in range(max(len(first), len(rest))):
+        result.extend(first[i : i + 1])
+        result.extend(rest[i : i + 1])
+    return result
+
+
+class Resolver:
+    def __init__(self):
+        self.ttl = 60.0
+        self.negative_ttl = 5.0
+        self.spread = False
+        self.hosts = {}  # type: Dict[str, List[str]]
+        self.lookups = 0  # 真正调用getaddrinfo的次数
+        self._cache = (
+            {}
+        )  # type: Dict[CacheKey, Tuple[float, Union[List[Address], OSError]]]
+        self._inflight = {}  # type: Dict[CacheKey, asyncio.Task]
+        self._turn = {}  # type: Dict[CacheKey, int]
+
+    def configure(self, config: Any) -> None:
+        self.ttl = getattr(config, "dns_ttl", 60.0)
+        self.negative_ttl = getattr(config, "dns_negative_ttl", 5.0)
+        self.spread = getattr(config, "dns_spread", False)
+        self.hosts = {
+            host.lower(): list(ips)
+            for host, ips in (getattr(config, "dns_hosts", None) or {}).items()
+        }
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._turn.clear()
+
+    async def resolve(
+        self, host: str, port: int, family: int = socket.AF_UNSPEC
+    ) -> List[Address]:
+        """
+        :param host: 域名或者ip
+        :param port:
+        :param family: AF_UNSPEC AF_INET AF_INET6
+        :return: [(family, sockaddr)]，解析失败抛OSError
+        """
+        if is_ip_address(host):
+            return [literal_address(host, port)]
+        key = (host.lower(), port, family)
+        if key[0] in self.hosts:
+            addresses = [
+                address
+                for address in (literal_address(ip, port) for ip in self.hosts[key[0]])
+                if family in (socket.AF_UNSPEC, address[0])
+            ]
+        else:
+            addresses = await self._lookup(key)
+        if self.spread and len(addresses) > 1:
+            turn = self._turn.get(key, 0)
+            self._turn[key] = turn + 1
+            turn %= len(addresses)
+            addresses = addresses[turn:] + addresses[:turn]
+        return addresses
+
+    async def _lookup(self, key: CacheKey) -> List[Address]:
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            if isinstance(entry[1], OSError):
+                raise socket.gaierror(*entry[1].args)
+            return entry[1]
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not loop:
+            task = self._inflight[key] = loop.create_task(self._query(key))
+        # 一个调用者被取消了，别的调用者还在等同一个查询
+        return await asyncio.shield(task)
+
+    async def _query(self, key: CacheKey) -> List[Address]:
+        host, port, family = key
+        self.lookups += 1
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                host, port, family=family, type=socket.SOCK_STREAM
+            )
+        except OSError as e:
+            self._cache[key] = (time.monotonic() + self.negative_ttl, e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        addresses = []  # type: List[Address]
+        for info in infos:
+            if (info[0], info[4]) not in addresses:
+                addresses.append((info[0], info[4]))
+        self._cache[key] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+
+_resolver = Resolver()
+
+
+def get_resolver() -> Resolver:
+    return _resolver
+
+
+async def _attempt(address: Address) -> socket.socket:
+    sock = socket.socket(address[0], socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    try:
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, address[1])
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def connect_socket(
+    host: str, port: int, delay: Optional[float] = 0.25
+) -> socket.socket:
+    """
+    Happy Eyeballs，前一个连接delay秒还没连上或者已经失败了就开下一个
+    :param host:
+    :param port:
+    :param delay: None表示一个一个试
+    :return: 连上的非阻塞socket
+    """
+    remaining = interleave(await _resolver.resolve(host, port))
+    pending = set()  # type: set
+    errors = []  # type: List[BaseException]
+    try:
+        while remaining or pending:
+            if remaining:
+                pending.add(asyncio.create_task(_attempt(remaining.pop(0))))
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            winner = None  # type: Optional[socket.socket]
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()  # 同时连上了好几个
+            if winner is not None:
+                return winner
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, socket.socket):
+                result.close()  # 取消之前就连上了
+    if len(errors) == 1:
+        raise errors[0]
+    raise OSError(f"failed to connect to {host}:{port}: {errors}")
+
+
+async def open_connection(
+    host: str, port: int, delay: Optional[float] = 0.25, **kwargs
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """
+    和asyncio.open_connection一样，地址走缓存，连接走Happy Eyeballs
+    """
+    sock = await connect_socket(host, port, delay)
+    if kwargs.get("ssl") and kwargs.get("server_hostname") is None:
+        kwargs["server_hostname"] = host
+    try:
+        return await asyncio.open_connection(sock=sock, **kwargs)
+    except BaseException:
+        sock.close()
+        raise
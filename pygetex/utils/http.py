@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import re
+from email.utils import parsedate_to_datetime
 from typing import Mapping, Optional, Tuple, Type
 from urllib.parse import unquote, urlparse
 
@@ -35,8 +36,17 @@ def guess_support_range(headers) -> bool:
     return False
 
 
+def guess_validators(headers: Mapping) -> Tuple[Optional[str], Optional[str]]:
+    """ETag, Last-Modified"""
+    return (
+        headers.get("ETag") or headers.get("etag"),
+        headers.get("Last-Modified") or headers.get("last-modified"),
+    )
+
+
 # todo retry on 4xx?
 re_content_range_compiled = re.compile(r"bytes [^/]+/([0-9]+)")
+re_content_range_start_compiled = re.compile(r"bytes ([0-9]+)-")
 
 
 async def guess_file_metadata(
@@ -54,7 +64,7 @@ async def guess_file_metadata(
     status, headers, body = await downloader.download(
         url,
         getattr(config, "method", "GET"),
-        headers=getattr(config, "headers", {}).update({"Range": "bytes=0-0"}),
+        headers={**(getattr(config, "headers", None) or {}), "Range": "bytes=0-0"},
     )
     await body.close()
     if status == 206:
@@ -68,8 +78,8 @@ async def guess_file_metadata(
     status, headers, body = await downloader.download(
         url,
         "HEAD",
-        headers=getattr(config, "headers", {}).update({"Range": "bytes=0-0"}),
-    )
+        headers=getattr(config, "headers", None),
+    )  # 不带Range，Content-Length才是整个文件的大小
     await body.close()  # close body stream
     if "Content-Length" in headers:
         return (
@@ -85,3 +95,62 @@ async def guess_file_metadata(
         )
     else:
         return None, guess_filename(url, headers), guess_support_range(headers)
+
+
+async def get_validators(
+    downloader: HTTPDownloaderBase, url, config: Config, since: float
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+
+    :param downloader:
+    :param url:
+    :param config:
+    :param since: 开始下载的时间戳
+    :return: etag, last_modified
+    """
+    status, headers, body = await downloader.download(
+        url, "HEAD", headers=getattr(config, "headers", None)
+    )
+    await body.close()
+    if status != 200:
+        return None, None
+    etag, last_modified = guess_validators(headers)
+    if last_modified is not None:
+        try:
+            if parsedate_to_datetime(last_modified).timestamp() > since:
+                return None, None  # 下载的时候又改过了，下好的文件不一定是这个版本
+        except (TypeError, ValueError):
+            last_modified = None
+    return etag, last_modified
+
+
+async def revalidate(
+    downloader: HTTPDownloaderBase,
+    url,
+    config: Config,
+    etag: Optional[str],
+    last_modified: Optional[str],
+) -> bool:
+    """
+    条件请求，304就是没变，不认条件请求的服务器比一下validator
+    :param downloader:
+    :param url:
+    :param config:
+    :param etag:
+    :param last_modified:
+    :return: 缓存的内容还能用
+    """
+    headers = dict(getattr(config, "headers", None) or {})
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    status, headers, body = await downloader.download(url, "HEAD", headers=headers)
+    await body.close()
+    if status == 304:
+        return True
+    if status != 200:
+        return False
+    if etag is not None:
+        return guess_validators(headers)[0] == etag
+    return last_modified is not None and guess_validators(headers)[1] == last_modified
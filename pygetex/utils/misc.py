@@ -5,6 +5,7 @@ from contextvars import copy_context
 from functools import partial, wraps
 from importlib import import_module
 from typing import Any, Callable, Coroutine, List, Optional, Union
+from urllib.parse import urlsplit, urlunsplit
 
 from typing_extensions import ParamSpec, TypeVar
 
@@ -31,13 +32,10 @@ def run_sync(call: Callable[P, R]) -> Callable[P, Coroutine[None, None, R]]:
 
 
 def get_divisional_range(filesize: int, split=10) -> List[List[int]]:
+    split = max(1, min(split, filesize))  # 文件比split还小的时候每块至少1字节
     step = filesize // split
-    arr = list(range(0, filesize, step))
-    result = []
-    for i in range(len(arr) - 1):  # n-1 0-(n-2)
-        s_pos, e_pos = arr[i], arr[i + 1] - 1
-        result.append([s_pos, e_pos])
-    result[-1][-1] = filesize - 1
+    result = [[i * step, (i + 1) * step - 1] for i in range(split)]
+    result[-1][-1] = filesize - 1  # 除不尽的部分给最后一块
     return result
 
 
@@ -45,6 +43,35 @@ def get_unfinished_range(result: List[List[int]]) -> List[List[int]]:
     return list(filter(lambda x: x[0] <= x[1], result))
 
 
+def get_written_ranges(split_result: List[List[int]], filesize: int) -> List[List[int]]:
+    """
+    已经写好的区间，不在没写完的block里的字节都是写好了的
+    :param split_result:
+    :param filesize:
+    :return: 按顺序排好的[start, end]
+    """
+    written = []  # type: List[List[int]]
+    position = 0
+    for start, end in sorted(get_unfinished_range(split_result)):
+        if start > position:
+            written.append([position, start - 1])
+        position = max(position, end + 1)
+    if position < filesize:
+        written.append([position, filesize - 1])
+    return written
+
+
+def get_contiguous_end(split_result: List[List[int]]) -> Optional[int]:
+    """
+    从文件开头开始连续写好了多少字节。没写完的block里最小的起点之前都已经写好了，
+    断点续传的时候不在split_result里的部分也是写好了的
+    :param split_result:
+    :return: None表示全部写完了
+    """
+    starts = [start for start, end in split_result if start <= end or end == -1]
+    return min(starts) if starts else None
+
+
 def get_remain_bytes(split_result: List[List[int]]) -> int:
     if split_result[-1][-1] == -1:
         if len(split_result) == 1:
@@ -88,4 +115,28 @@ def load_object(path: Union[str, Callable]) -> Any:
     return obj
 
 
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21, "ftps": 990, "sftp": 22}
+
+
+def normalize_uri(uri: str) -> str:
+    """
+    同一个资源的不同写法归一化: scheme和host小写，去掉默认端口和fragment，空path补成/
+    query不动，参数顺序可能有意义
+    """
+    parts = urlsplit(uri)
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ""
+    if ":" in host:  # ipv6
+        host = f"[{host}]"
+    netloc = host
+    if parts.port is not None and DEFAULT_PORTS.get(scheme) != parts.port:
+        netloc += f":{parts.port}"
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ":" + parts.password
+        netloc = userinfo + "@" + netloc
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
 # todo unitest them
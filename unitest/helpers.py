@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from typing import Tuple
+
+from aiohttp import web
+
+from pygetex.config import Config
+
+
+def make_config(tmp: str, **kwargs) -> Config:
+    """
+    每个测试自己的数据库，默认下载到同一个临时目录
+    :param tmp: 临时目录
+    :param kwargs: 其余的config
+    :return:
+    """
+    kwargs.setdefault("dir", tmp)
+    kwargs.setdefault("fileio", "sysio")
+    return Config(database=f"sqlite+aiosqlite:///{tmp}/pyget.db", **kwargs)
+
+
+async def start_app(app: web.Application) -> Tuple[web.AppRunner, str]:
+    """
+    在127.0.0.1的随机端口上起一个测试用的http服务器，用完了runner.cleanup()
+    :param app:
+    :return: runner, http://127.0.0.1:port
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from pygetex.config import Config
+from pygetex.core import CoreProcess
+
+from helpers import make_config, start_app
+
+
+class TestContentCache(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(1024 * 1024)
+        self.requests = 0
+
+        async def handle(request: web.Request) -> web.Response:
+            self.requests += 1
+            return web.Response(body=self.data)
+
+        app = web.Application()
+        app.router.add_get("/file.bin", handle)
+        app.router.add_get("/other.bin", handle)
+        self.runner, self.base = await start_app(app)
+        self.dirs = []
+        for name in ("a", "b", "c"):
+            self.dirs.append(os.path.join(self.tmp.name, name))
+            os.mkdir(self.dirs[-1])
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    def make_config(self, **kwargs) -> Config:
+        return make_config(
+            self.tmp.name,
+            dir=self.dirs[0],
+            cache_dir=os.path.join(self.tmp.name, "cache"),
+            **kwargs,
+        )
+
+    async def download(self, process: CoreProcess, uri: str, dir_: str):
+        tasks = await process.add_uri(uri, dir=dir_)
+        await process.wait()
+        await asyncio.gather(*process._dispatch_tasks)  # 数据库状态和缓存都是后台更新的
+        await process.cache.close()  # type: ignore
+        return tasks[0]
+
+    async def test_hit(self):
+        async with CoreProcess(self.make_config()) as process:
+            await self.download(process, self.base + "/file.bin", self.dirs[0])
+            requests = self.requests
+            task = await self.download(process, self.base + "/file.bin", self.dirs[1])
+            self.assertEqual(self.requests, requests)  # 没有碰网络
+            with open(task.path, "rb") as f:
+                self.assertEqual(f.read(), self.data)
+            self.assertEqual((await process.tell_status(task.id)).status, "complete")
+            self.assertEqual(
+                sum(v for _, v in process.get_metrics()["pygetex_cache_hits_total"]), 1
+            )
+
+    async def test_evict(self):
+        async with CoreProcess(self.make_config(cache_size=1024 * 1024)) as process:
+            await self.download(process, self.base + "/file.bin", self.dirs[0])
+            self.data = os.urandom(1024 * 1024)  # 内容不同，放不下两份
+            await self.download(process, self.base + "/other.bin", self.dirs[1])
+            requests = self.requests
+            await self.download(process, self.base + "/file.bin", self.dirs[2])
+            self.assertGreater(self.requests, requests)  # 最早的被淘汰了，重新下载
+
+
+class TestRevalidate(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(64 * 1024)
+        self.version = 1
+        self.requests = []  # (method, If-None-Match)
+
+        async def handle(request: web.Request) -> web.Response:
+            self.requests.append((request.method, request.headers.get("If-None-Match")))
+            headers = {
+                "ETag": f'"v{self.version}"',
+                "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+            }
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                return web.Response(status=304, headers=headers)
+            return web.Response(body=self.data, headers=headers)
+
+        app = web.Application()
+        app.router.add_route("*", "/file.bin", handle)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/file.bin"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def download(self, process: CoreProcess, name: str, **options) -> bytes:
+        dir_ = os.path.join(self.tmp.name, name)
+        os.mkdir(dir_)
+        self.requests.clear()
+        (task,) = await process.add_uri(self.uri, dir=dir_, **options)
+        await process.wait()
+        await asyncio.gather(*process._dispatch_tasks)
+        await process.cache.close()  # type: ignore
+        self.assertEqual((await process.tell_status(task.id)).status, "complete")
+        with open(task.path, "rb") as f:  # type: ignore
+            return f.read()
+
+    def gets(self) -> int:
+        return sum(method == "GET" for method, _ in self.requests)
+
+    async def test_revalidate(self):
+        config = make_config(
+            self.tmp.name, cache_dir=os.path.join(self.tmp.name, "cache"), cache_ttl=0
+        )
+        async with CoreProcess(config) as process:
+            await self.download(process, "a")
+            self.assertEqual(await self.download(process, "b"), self.data)
+            self.assertEqual(self.requests, [("HEAD", '"v1"')])  # 304，用缓存
+
+            self.version, self.data = 2, os.urandom(64 * 1024)  # 源站更新了
+            self.assertEqual(await self.download(process, "c"), self.data)
+            self.assertEqual(self.requests[0], ("HEAD", '"v1"'))
+            self.assertGreater(self.gets(), 0)
+            self.assertEqual(await self.download(process, "d"), self.data)
+            self.assertEqual(self.requests, [("HEAD", '"v2"')])  # 新下载的存进去了
+
+    async def test_no_cache(self):
+        config = make_config(
+            self.tmp.name, cache_dir=os.path.join(self.tmp.name, "cache")
+        )
+        async with CoreProcess(config) as process:
+            await self.download(process, "a")
+            await self.download(process, "b")
+            self.assertEqual(self.requests, [])  # 没有ttl，一直用缓存
+            for name in ("c", "d"):
+                self.assertEqual(
+                    await self.download(process, name, no_cache=True), self.data
+                )
+                self.assertGreater(self.gets(), 0)
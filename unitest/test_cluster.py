@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+import time
+from collections import Counter
+from unittest import IsolatedAsyncioTestCase, mock
+
+from aiohttp import web
+
+from pygetex.config import Config
+from pygetex.core import CoreProcess
+from pygetex.task import TaskLease
+
+from helpers import make_config, start_app
+
+
+class TestCluster(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = {f"f{i}.bin": os.urandom(64 * 1024 + i) for i in range(4)}
+        self.requests = []  # (method, path, range)
+        self.gate = asyncio.Event()  # clear了下载就卡住
+        self.gate.set()
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            self.requests.append(
+                (request.method, request.path, request.headers.get("Range"))
+            )
+            data = self.files[request.path[1:]]
+            start = request.http_range.start or 0
+            stop = min(request.http_range.stop or len(data), len(data))
+            if request.method == "GET" and stop - start > 1:
+                await asyncio.sleep(0.5)  # 下得慢一点，另一个节点才有机会领任务
+                await self.gate.wait()
+            return web.Response(
+                status=206 if request.http_range.start is not None else 200,
+                body=data[start:stop],
+                headers={
+                    "Accept-Ranges": "bytes",
+                    "Content-Range": f"bytes {start}-{stop - 1}/{len(data)}",
+                },
+            )
+
+        app = web.Application()
+        app.router.add_route("*", "/{name}", handle)
+        self.runner, self.base = await start_app(app)
+
+    async def asyncTearDown(self):
+        self.gate.set()
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    def config(self, **kwargs) -> Config:
+        return make_config(
+            self.tmp.name,
+            split=1,
+            small_file_size=0,
+            lease_heartbeat=0.1,
+            **kwargs,
+        )
+
+    async def wait_complete(self, process: CoreProcess, taskids) -> None:
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            statuses = [(await process.tell_status(i)).status for i in taskids]
+            if all(status == "complete" for status in statuses):
+                return
+            await asyncio.sleep(0.05)
+        self.fail(f"tasks not complete: {statuses}")
+
+    def downloads(self) -> Counter:
+        return Counter(
+            path
+            for method, path, range_ in self.requests
+            if method == "GET" and range_ != "bytes=0-0"
+        )
+
+    async def test_share_tasks(self):
+        async with CoreProcess(
+            self.config(node_id="a", cluster_max_tasks=2)
+        ) as a, CoreProcess(self.config(node_id="b", cluster_max_tasks=2)) as b:
+            tasks = [await a.submit_uri(f"{self.base}/{name}") for name in self.files]
+            taskids = [task.id for task in tasks]
+            await self.wait_complete(a, taskids)
+            owners = {
+                lease["task_id"]: lease["owner"] for lease in await b.cluster_status()
+            }
+            self.assertEqual(set(owners), set(taskids))
+            self.assertEqual(set(owners.values()), {"a", "b"})
+            for process in (a, b):
+                await asyncio.gather(*process._dispatch_tasks)
+        self.assertEqual(self.downloads(), {f"/{name}": 1 for name in self.files})
+        for name, data in self.files.items():
+            with open(os.path.join(self.tmp.name, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    async def test_steal_expired(self):
+        async with CoreProcess(self.config()) as standalone:
+            task = await standalone.submit_uri(f"{self.base}/f0.bin")
+            async with standalone.session() as session:
+                # 下到一半挂掉的节点
+                session.add(
+                    TaskLease(task_id=task.id, owner="dead", expires=time.time() + 0.3)
+                )
+                await session.commit()
+        self.assertEqual(self.downloads(), Counter())  # 单机模式submit_uri不下载
+
+        async with CoreProcess(self.config(node_id="b", lease_ttl=5)) as b:
+            self.assertFalse(await b.cluster.acquire(task.id))  # type: ignore
+            await self.wait_complete(b, [task.id])
+            await asyncio.gather(*b._dispatch_tasks)
+            (lease,) = await b.cluster_status()
+            self.assertEqual(lease["owner"], "b")
+        with open(os.path.join(self.tmp.name, "f0.bin"), "rb") as f:
+            self.assertEqual(f.read(), self.files["f0.bin"])
+
+    async def test_heartbeat_failed(self):
+        """连不上数据库续不了约，租约过期之前停掉本地的下载"""
+        self.gate.clear()
+        config = self.config(node_id="a", lease_ttl=0.5)
+        async with CoreProcess(config) as a:
+            task = await a.submit_uri(f"{self.base}/f0.bin")
+            while task.id not in a._pending_tasks:
+                await asyncio.sleep(0.02)
+            with mock.patch.object(
+                a.cluster, "heartbeat", side_effect=ConnectionError("db is down")
+            ):
+                deadline = time.monotonic() + 5
+                while task.id in a._pending_tasks and time.monotonic() < deadline:
+                    await asyncio.sleep(0.02)
+                dropped = time.time()
+                self.assertNotIn(task.id, a._pending_tasks)
+                self.assertEqual(a.cluster.owned, set())  # type: ignore
+                (lease,) = await a.cluster_status()
+                self.assertGreater(lease["expires"], dropped)  # 别的节点还抢不到
+            self.assertEqual((await a.tell_status(task.id)).status, "downloading")
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+from pygetex.fileio.utils import clone_file
+from pygetex.utils.misc import normalize_uri
+
+from helpers import make_config, start_app
+
+
+class TestNormalize(TestCase):
+    def test_normalize_uri(self):
+        self.assertEqual(
+            normalize_uri("HTTP://Example.com:80/a?x=1#frag"),
+            "http://example.com/a?x=1",
+        )
+        self.assertEqual(
+            normalize_uri("https://example.com"), normalize_uri("https://example.com/")
+        )
+        self.assertNotEqual(
+            normalize_uri("https://example.com:8443/"),
+            normalize_uri("https://example.com/"),
+        )
+
+    def test_clone_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src")
+            with open(src, "wb") as f:
+                f.write(b"data")
+            for mode in ("reflink", "hardlink", "copy"):
+                dst = os.path.join(tmp, mode)
+                self.assertIn(
+                    clone_file(src, dst, mode), ("reflink", "hardlink", "copy")
+                )
+                with open(dst, "rb") as f:
+                    self.assertEqual(f.read(), b"data")
+
+
+class TestCoalesce(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(1024 * 1024)
+        self.requests = 0
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            resp = web.StreamResponse()  # 不支持Range，单连接下载
+            resp.content_length = len(self.data)
+            await resp.prepare(request)
+            if request.method == "GET":
+                self.requests += 1
+                for offset in range(0, len(self.data), 256 * 1024):
+                    await asyncio.sleep(0.05)  # 慢一点，第二次add_uri的时候还在下载
+                    await resp.write(self.data[offset : offset + 256 * 1024])
+            return resp
+
+        app = web.Application()
+        app.router.add_get("/file.bin", handle)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/file.bin"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_duplicate_uri(self):
+        config = make_config(
+            self.tmp.name,
+        )
+        async with CoreProcess(config) as process:
+            first = await process.add_uri(self.uri)
+            second = await process.add_uri(self.uri + "#fragment")
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)  # 数据库里的状态是后台更新的
+            self.assertNotEqual(first[0].path, second[0].path)
+            for task in first + second:
+                with open(task.path, "rb") as f:
+                    self.assertEqual(f.read(), self.data)
+                self.assertEqual(
+                    (await process.tell_status(task.id)).status, "complete"
+                )
+            self.assertEqual(self.requests, 2)  # 一次获取元数据，一次下载
+            self.assertEqual(
+                sum(
+                    v for _, v in process.get_metrics()["pygetex_coalesced_tasks_total"]
+                ),
+                1,
+            )
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import pickle
+from unittest import TestCase
+
+from pygetex.config import Config, update_config
+
+
+class TestConfigView(TestCase):
+    def test_layers(self):
+        config = Config(split=16)
+        task_config = update_config(config, split=4, headers={"a": "b"})
+        block_config = update_config(task_config, split=1)
+        self.assertEqual(task_config.split, 4)
+        self.assertEqual(block_config.split, 1)
+        self.assertEqual(block_config.headers, {"a": "b"})
+        self.assertEqual(config.split, 16)
+        self.assertFalse(hasattr(config, "headers"))
+        self.assertIs(update_config(config), config)
+
+    def test_live_update(self):
+        config = Config()
+        task_config = update_config(config, split=4)
+        config.chunk_size = 1024  # change_global_option
+        self.assertEqual(task_config.chunk_size, 1024)
+        self.assertEqual(task_config.model_dump()["chunk_size"], 1024)
+        self.assertEqual(task_config.model_dump()["split"], 4)
+
+    def test_read_only(self):
+        task_config = update_config(Config(), split=4)
+        with self.assertRaises(AttributeError):
+            task_config.split = 2
+
+    def test_pickle(self):
+        config = Config(split=16)
+        block_config = update_config(update_config(config, split=4), headers={"a": "b"})
+        loaded = pickle.loads(pickle.dumps(block_config))
+        self.assertEqual(loaded.split, 4)
+        self.assertEqual(loaded.headers, {"a": "b"})
+        self.assertEqual(loaded.chunk_size, config.chunk_size)
+        with self.assertRaises(AttributeError):
+            loaded._missing
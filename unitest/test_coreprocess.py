@@ -1,25 +1,52 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from datetime import timedelta
 from unittest import IsolatedAsyncioTestCase
 
+from sqlmodel import select
+
 from pygetex.config import Config
 from pygetex.core import CoreProcess
-from pygetex.handler import HandlerBase
-from pygetex.plugin import PluginBase
+from pygetex.handler import HandlerBase, HandlerMeta
+from pygetex.plugin import PluginBase, PluginMeta
+from pygetex.task import DownloadTask
 
 
 class A(PluginBase):
     name = "a"
 
+    def __init__(self, core: "CoreProcess"):
+        self.events = []
+
     async def on_test(self):
         return "A on_test"
 
+    async def on_event(self, value):
+        self.events.append([value])
+
+    async def on_event_batch(self, events):
+        self.events.append([value for value, in events])
+
 
 class B(PluginBase):
     name = "b"
+    timeout = 0.1
+
+    def __init__(self, core: "CoreProcess"):
+        self.events = []
 
     async def on_test(self):
         return "B on_test"
 
+    async def on_event(self, value):
+        self.events.append(value)
+
+    async def on_slow(self):
+        await asyncio.sleep(10)
+        return "B on_slow"
+
 
 class C(HandlerBase):
     name = "c"
@@ -35,7 +62,24 @@ class D(HandlerBase):
         return False
 
 
+# 只在TestCoreProcess里注册，C什么uri都认，留着会抢走别的测试的http任务
+REGISTERED = ((PluginMeta.plugins, (A, B)), (HandlerMeta.handlers, (C, D)))
+for registry, classes in REGISTERED:
+    for tp in classes:
+        registry.pop(tp.name)
+
+
 class TestCoreProcess(IsolatedAsyncioTestCase):
+    def setUp(self):
+        for registry, classes in REGISTERED:
+            for tp in classes:
+                registry[tp.name] = tp
+
+    def tearDown(self):
+        for registry, classes in REGISTERED:
+            for tp in classes:
+                registry.pop(tp.name)
+
     async def test_coreprocess(self):
         config = Config()
         async with CoreProcess(config) as process:
@@ -53,6 +97,21 @@ class TestCoreProcess(IsolatedAsyncioTestCase):
             self.assertEqual(results["a"], "A on_test")
             self.assertEqual(results["b"], "B on_test")
 
+    async def test_dispatch_table(self):
+        config = Config()
+        async with CoreProcess(config) as process:
+            self.assertEqual(await process.dispatch("on_nothing"), {})
+            process.disable_plugin("b")
+            self.assertEqual(list(await process.dispatch("on_test")), ["a"])
+            process.enable_plugin("b")
+            self.assertEqual(await process.dispatch("on_slow"), {"b": None})
+
+            for value in range(3):
+                process.dispatch_nowait("on_event", value)
+            await asyncio.sleep(0.01)
+            self.assertEqual(process.plugins["a"].events, [[0, 1, 2]])
+            self.assertEqual(process.plugins["b"].events, [0, 1, 2])
+
     async def test_check_handler(self):
         config = Config()
         async with CoreProcess(config) as process:
@@ -63,6 +122,80 @@ class TestCoreProcess(IsolatedAsyncioTestCase):
             # await process.add_uri("https://alpha.zrflie1.pw/PC-2/%E4%BD%8F%E5%9C%A8%E4%B8%8B%E4%BD%93%E5%8D%87%E7%BA%A7%E5%B2%9B%E4%B8%8A%E7%9A%84%E8%B4%AB%E4%B9%B3%E8%AF%A5%E5%A6%82%E4%BD%95%E6%98%AF%E5%A5%BD2(%E5%AE%98%E4%B8%AD).rar")
 
 
+
+class TestPurge(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config = Config(
+            database=f"sqlite+aiosqlite:///{self.tmpdir.name}/pyget.db",
+            dir=self.tmpdir.name,
+        )
+
+    async def asyncTearDown(self):
+        self.tmpdir.cleanup()
+
+    async def _add_tasks(self, process: CoreProcess, statuses, end_time=None):
+        async with process.session() as session:
+            for index, status in enumerate(statuses):
+                path = os.path.join(self.tmpdir.name, f"{status}{index}")
+                with open(path + self.config.tempfile_suffix, "wb"):
+                    pass
+                session.add(
+                    DownloadTask(
+                        uri=f"http://127.0.0.1/{index}",
+                        path=path,
+                        support_range=True,
+                        options={},
+                        status=status,
+                        end_time=end_time,
+                    )
+                )
+            await session.commit()
+
+    async def _statuses(self, process: CoreProcess):
+        async with process.session() as session:
+            return sorted((await session.exec(select(DownloadTask.status))).all())
+
+    async def test_purge_download_result(self):
+        process = CoreProcess(self.config)
+        await self._add_tasks(process, ["complete", "error", "paused", "error"])
+        self.assertEqual(await process.purge_download_result(), 3)
+        self.assertEqual(await self._statuses(process), ["paused"])
+        await process.shutdown()
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(self.tmpdir.name, "error1") + self.config.tempfile_suffix
+            )
+        )
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(self.tmpdir.name, "paused2") + self.config.tempfile_suffix
+            )
+        )
+
+    async def test_purge_older_than(self):
+        process = CoreProcess(self.config)
+        await self._add_tasks(
+            process, ["complete", "error"], end_time=process._now() - timedelta(days=2)
+        )
+        self.assertEqual(
+            await process.purge_download_result(older_than=timedelta(days=3)), 0
+        )
+        self.assertEqual(
+            await process.purge_download_result(older_than=timedelta(days=1)), 2
+        )
+        await process.shutdown()
+
+    async def test_remove_many(self):
+        process = CoreProcess(self.config)
+        await self._add_tasks(process, ["paused", "error", "complete"])
+        self.assertEqual(await process.remove_many([1, 2, 42]), 2)
+        self.assertEqual(await self._statuses(process), ["complete"])
+        with self.assertRaises(ValueError):
+            await process.remove(42)
+        await process.shutdown()
+
+
 if __name__ == "__main__":
     import unittest
 
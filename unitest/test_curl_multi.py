@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+cycurl不一定装了，这里假一个cycurl._curl，只模拟CurlMultiEngine用到的那几个接口:
+header一行一行回调，body调WRITEDATA.write，SIZE_DOWNLOAD_T跟着涨
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import types
+from typing import Callable, Dict, Optional, Tuple
+from unittest import IsolatedAsyncioTestCase, mock
+
+from pygetex.config import Config
+
+_curl = types.ModuleType("cycurl._curl")
+for value, name in enumerate(
+    (
+        "CURLOPT_URL",
+        "CURLOPT_RANGE",
+        "CURLOPT_FOLLOWLOCATION",
+        "CURLOPT_FAILONERROR",
+        "CURLOPT_MAXFILESIZE_LARGE",
+        "CURLOPT_HTTPHEADER",
+        "CURLOPT_CUSTOMREQUEST",
+        "CURLOPT_POSTFIELDS",
+        "CURLOPT_POSTFIELDSIZE",
+        "CURLOPT_HEADERFUNCTION",
+        "CURLOPT_WRITEDATA",
+        "CURLINFO_SIZE_DOWNLOAD_T",
+    )
+):
+    setattr(_curl, name, value)
+_curl.CURL_WRITEFUNC_ERROR = 0xFFFFFFFF
+
+# 测试设置: (url, range) -> (状态码, body)
+respond = None  # type: Optional[Callable[[str, str], Tuple[int, bytes]]]
+CHUNK = 1000
+
+
+class CurlError(Exception):
+    pass
+
+
+class Curl:
+    def __init__(self):
+        self.options = {}  # type: Dict[int, object]
+        self.downloaded = 0
+        self.closed = False
+
+    def setopt(self, option: int, value) -> None:
+        self.options[option] = value
+
+    def getinfo(self, option: int) -> int:
+        assert option == _curl.CURLINFO_SIZE_DOWNLOAD_T
+        return self.downloaded
+
+    def impersonate(self, target: str) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class AsyncCurl:
+    def __init__(self):
+        self.running = {}  # type: Dict[Curl, asyncio.Task]
+        self.removed = []
+        self.closed = False
+
+    def add_handle(self, curl: Curl) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(self._transfer(curl, future))
+        self.running[curl] = task
+        return future
+
+    def remove_handle(self, curl: Curl) -> None:
+        self.removed.append(curl)
+        self.running.pop(curl).cancel()
+
+    async def _transfer(self, curl: Curl, future: asyncio.Future) -> None:
+        options = curl.options
+        assert respond is not None
+        status, body = respond(
+            options[_curl.CURLOPT_URL].decode(),  # type: ignore
+            options[_curl.CURLOPT_RANGE].decode(),  # type: ignore
+        )
+        header_function = options[_curl.CURLOPT_HEADERFUNCTION]
+        for line in (f"HTTP/1.1 {status} X\r\n".encode(), b"\r\n"):
+            if header_function(line) != len(line):  # type: ignore
+                future.set_exception(CurlError("header callback failed"))
+                return
+        file = options[_curl.CURLOPT_WRITEDATA]
+        for offset in range(0, len(body), CHUNK):
+            await asyncio.sleep(0.01)
+            chunk = body[offset : offset + CHUNK]
+            file.write(chunk)  # type: ignore
+            curl.downloaded += len(chunk)
+        self.running.pop(curl, None)
+        future.set_result(None)
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+_curl.Curl = Curl
+_curl.AsyncCurl = AsyncCurl
+_requests = types.ModuleType("cycurl.requests")
+
+
+class AsyncSession:  # CURLDownloader的其他请求这里用不到
+    def __init__(self, **kwargs):
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+_requests.AsyncSession = AsyncSession
+_requests.Response = object
+with mock.patch.dict(
+    sys.modules,
+    {
+        "cycurl": types.ModuleType("cycurl"),
+        "cycurl._curl": _curl,
+        "cycurl.requests": _requests,
+    },
+):
+    sys.modules.pop("pygetex.downloader.curldownloader", None)
+    from pygetex.downloader import curldownloader
+sys.modules.pop("pygetex.downloader.curldownloader", None)  # 别让其他测试拿到假的
+
+
+class TestCurlMultiEngine(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        global respond
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(20 * CHUNK + 17)
+        self.path = os.path.join(self.tmp.name, "out.bin")
+        with open(self.path, "wb") as f:
+            f.truncate(len(self.data))  # 预分配好的文件
+        self.status = 206
+
+        def serve(url: str, range_: str) -> Tuple[int, bytes]:
+            start, end = map(int, range_.split("-"))
+            return self.status, self.data[start : end + 1]
+
+        respond = serve
+        self.downloader = curldownloader.CURLMultiDownloader(Config())
+        self.progress = []
+
+    async def asyncTearDown(self):
+        await self.downloader.close()
+        self.tmp.cleanup()
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    async def test_download(self):
+        blocks = [[0, 9999], [10000, len(self.data) - 1]]
+        with mock.patch.object(curldownloader, "PROGRESS_INTERVAL", 0.02):
+            await asyncio.gather(
+                *(
+                    self.downloader.download_to_file(
+                        "http://example.com/a", self.path, block, self.progress.append
+                    )
+                    for block in blocks
+                )
+            )
+        self.assertEqual(self.read(), self.data)
+        self.assertEqual(blocks, [[10000, 9999], [len(self.data), len(self.data) - 1]])
+        self.assertEqual(sum(self.progress), len(self.data))
+        self.assertGreater(len(self.progress), 2)  # 下载过程中轮询到了进度
+        engine = self.downloader._engine
+        # 同一个loop共用一个multi handle
+        self.assertIs(engine, curldownloader.CurlMultiEngine.acquire())
+        await engine.release()  # type: ignore
+        self.assertEqual(engine.transfers, {})  # type: ignore
+
+    async def test_reject_full_body(self):
+        self.status = 200  # 服务器没理Range
+        block = [5000, len(self.data) - 1]
+        with self.assertRaises(CurlError):
+            await self.downloader.download_to_file(
+                "http://example.com/a", self.path, block, self.progress.append
+            )
+        self.assertEqual(self.read(), bytes(len(self.data)))  # 一个字节都没写
+        self.assertEqual(block[0], 5000)
+        self.assertEqual(self.progress, [])
+
+    async def test_cancel(self):
+        block = [0, len(self.data) - 1]
+        task = asyncio.create_task(
+            self.downloader.download_to_file(
+                "http://example.com/a", self.path, block, self.progress.append
+            )
+        )
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        engine = self.downloader._engine
+        acurl = engine.acurl  # type: ignore
+        self.assertEqual(len(acurl.removed), 1)  # 从multi handle上摘掉了
+        self.assertTrue(acurl.removed[0].closed)
+        self.assertEqual(engine.transfers, {})  # type: ignore
+        written = acurl.removed[0].downloaded
+        self.assertTrue(0 < written < len(self.data))
+        self.assertEqual(block[0], written)  # 停下来的时候拿到准确的进度
+        self.assertEqual(sum(self.progress), written)
+        self.assertEqual(self.read()[:written], self.data[:written])
+        await self.downloader.close()
+        self.assertTrue(acurl.closed)  # 最后一个用户走了multi handle也关了
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import gzip
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+from pygetex.fileio.decompress import (
+    StreamingDecompressor,
+    load_checkpoint,
+    output_name,
+)
+
+from helpers import make_config, start_app
+
+
+class TestStreamingDecompressor(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out = os.path.join(self.tmp.name, "a.bin")
+        self.checkpoint = os.path.join(self.tmp.name, "a.bin.gz.pyget.z")
+        self.members = [os.urandom(100000), os.urandom(50000)]
+        self.data = b"".join(gzip.compress(m) for m in self.members)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_output_name(self):
+        self.assertEqual(output_name("a.tar.gz"), "a.tar")
+        self.assertEqual(output_name("a.tgz"), "a.tar")
+        self.assertEqual(output_name("a.bin"), "a.bin.out")
+
+    def test_multi_member(self):
+        decompressor = StreamingDecompressor("gzip", self.out, self.checkpoint)
+        for offset in range(0, len(self.data), 7777):
+            decompressor.feed(self.data[offset : offset + 7777])
+        decompressor.finish()
+        with open(self.out, "rb") as f:
+            self.assertEqual(f.read(), b"".join(self.members))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_resume(self):
+        decompressor = StreamingDecompressor("gzip", self.out, self.checkpoint)
+        decompressor.feed(self.data[: len(self.data) - 1000])  # 第二个member没喂完
+        decompressor.close()
+        out, consumed, produced = load_checkpoint(self.checkpoint)  # type: ignore
+        self.assertEqual(produced, len(self.members[0]))
+        decompressor = StreamingDecompressor(
+            "gzip", out, self.checkpoint, consumed, produced
+        )
+        decompressor.feed(self.data[consumed:])
+        decompressor.finish()
+        with open(self.out, "rb") as f:
+            self.assertEqual(f.read(), b"".join(self.members))
+
+    def test_truncated(self):
+        decompressor = StreamingDecompressor("gzip", self.out, self.checkpoint)
+        decompressor.feed(self.data[:-10])
+        with self.assertRaises(ValueError):
+            decompressor.finish()
+
+
+class TestDecompressDownload(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.plain = os.urandom(3 * 1024 * 1024)
+        self.data = gzip.compress(self.plain)
+        self.root = os.path.join(self.tmp.name, "www")
+        os.mkdir(self.root)
+        for name in ("range.bin.gz", "range.bin"):
+            with open(os.path.join(self.root, name), "wb") as f:
+                f.write(self.data)
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            resp = web.StreamResponse()  # 不支持range，也不给长度
+            await resp.prepare(request)
+            if request.method == "GET":
+                for offset in range(0, len(self.data), 64 * 1024):
+                    await asyncio.sleep(0)
+                    await resp.write(self.data[offset : offset + 64 * 1024])
+            return resp
+
+        app = web.Application()
+        app.router.add_route("*", "/stream.bin.gz", handle)
+        app.router.add_route("*", "/stream.bin", handle)
+        app.router.add_static("/", self.root)
+        self.runner, self.base = await start_app(app)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def download(self, name: str) -> None:
+        dest = os.path.join(self.tmp.name, "dest")
+        os.mkdir(dest)
+        config = make_config(
+            self.tmp.name,
+            dir=dest,
+            split=4,
+            stream_poll_interval=0.01,
+        )
+        async with CoreProcess(config) as process:
+            (task,) = await process.add_uri(f"{self.base}/{name}", decompress="auto")
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            stat = await process.tell_status(task.id)
+            self.assertEqual(stat.status, "complete")
+            self.assertEqual(stat.path, os.path.join(dest, name[:-3]))
+            with open(stat.path, "rb") as f:
+                self.assertEqual(f.read(), self.plain)
+            self.assertEqual(os.listdir(dest), [name[:-3]])  # 压缩包和检查点都删掉了
+
+    async def test_range(self):
+        await self.download("range.bin.gz")
+
+    async def test_no_range(self):
+        await self.download("stream.bin.gz")
+
+    async def test_unknown_format(self):
+        dest = os.path.join(self.tmp.name, "dest")
+        os.mkdir(dest)
+        config = make_config(self.tmp.name, dir=dest, split=4)
+        async with CoreProcess(config) as process:
+            for name in ("range.bin", "stream.bin"):  # 按后缀猜不出格式
+                (task,) = await process.add_uri(
+                    f"{self.base}/{name}", decompress="auto"
+                )
+                await asyncio.wait_for(process.wait(), 10)
+                await asyncio.gather(*process._dispatch_tasks)
+                stat = await process.tell_status(task.id)
+                self.assertEqual(stat.status, "error")
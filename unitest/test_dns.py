@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import socket
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from pygetex.config import Config
+from pygetex.downloader.aiohttpdownloader import AIOHTTPDownloader
+from pygetex.utils.dns import Resolver, connect_socket, get_resolver, interleave
+
+from helpers import start_app
+
+
+class TestResolver(IsolatedAsyncioTestCase):
+    async def test_cache(self):
+        resolver = Resolver()
+        results = await asyncio.gather(
+            *(resolver.resolve("localhost", 80) for _ in range(10))
+        )
+        self.assertEqual(resolver.lookups, 1)  # 同时查的只查一次
+        self.assertTrue(results[0])
+        await resolver.resolve("localhost", 80)
+        self.assertEqual(resolver.lookups, 1)
+        resolver.ttl = 0
+        resolver.clear()
+        await resolver.resolve("localhost", 80)
+        await resolver.resolve("localhost", 80)
+        self.assertEqual(resolver.lookups, 3)  # 过期了
+
+    async def test_negative(self):
+        resolver = Resolver()
+        calls = []
+
+        async def getaddrinfo(*args, **kwargs):
+            calls.append(args)
+            raise socket.gaierror(socket.EAI_NONAME, "not found")
+
+        asyncio.get_running_loop().getaddrinfo = getaddrinfo  # type: ignore
+        for _ in range(3):
+            with self.assertRaises(socket.gaierror):
+                await resolver.resolve("missing.test", 80)
+        self.assertEqual(len(calls), 1)
+
+    async def test_pin_and_spread(self):
+        resolver = Resolver()
+        resolver.configure(
+            Config(
+                dns_hosts={"Mirror.test": ["10.0.0.1", "10.0.0.2", "::1"]},
+                dns_spread=True,
+            )
+        )
+        first = [(await resolver.resolve("mirror.test", 80))[0][1][0] for _ in range(3)]
+        self.assertEqual(first, ["10.0.0.1", "10.0.0.2", "::1"])
+        self.assertEqual(resolver.lookups, 0)
+        self.assertEqual(
+            len(await resolver.resolve("mirror.test", 80, socket.AF_INET)), 2
+        )
+
+    def test_interleave(self):
+        v4 = [(socket.AF_INET, (f"10.0.0.{i}", 80)) for i in range(3)]
+        v6 = [(socket.AF_INET6, (f"::{i}", 80, 0, 0)) for i in range(1, 3)]
+        self.assertEqual(
+            [a[0] for a in interleave(v6 + v4)],
+            [socket.AF_INET6, socket.AF_INET, socket.AF_INET6, socket.AF_INET]
+            + [socket.AF_INET],
+        )
+
+
+class TestHappyEyeballs(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(body=b"hello")
+
+        app = web.Application()
+        app.router.add_get("/file", handle)
+        self.runner, _ = await start_app(app)
+        self.port = self.runner.addresses[0][1]  # 用假域名访问，只要端口
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        get_resolver().configure(Config())
+
+    async def test_fallback(self):
+        # server只听127.0.0.1，第一个地址被拒绝，马上换下一个
+        get_resolver().configure(
+            Config(dns_hosts={"slow.test": ["127.0.0.2", "127.0.0.1"]})
+        )
+        start = time.monotonic()
+        sock = await connect_socket("slow.test", self.port, 0.1)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(sock.getpeername(), ("127.0.0.1", self.port))
+        sock.close()
+
+    async def test_aiohttp(self):
+        config = Config(dns_hosts={"files.test": ["127.0.0.1"]})
+        get_resolver().configure(config)
+        downloader = AIOHTTPDownloader(config)
+        try:
+            status, headers, body = await downloader.download(
+                f"http://files.test:{self.port}/file"
+            )
+            data = b"".join([chunk async for chunk in body])
+            await body.close()
+        finally:
+            await downloader.close()
+        self.assertEqual(status, 200)
+        self.assertEqual(data, b"hello")
@@ -9,7 +9,7 @@ from loguru import logger
 
 from pygetex.config import Config
 from pygetex.core import CoreProcess
-from pygetex.plugin import PluginBase
+from pygetex.plugin import PluginBase, PluginMeta
 
 
 class LogPlugin(PluginBase):
@@ -37,6 +37,9 @@ class LogPlugin(PluginBase):
         logger.catch(e)
 
 
+PluginMeta.plugins.pop(LogPlugin.name)  # 只在这里的测试启用
+
+
 headers = """Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7
 Accept-Encoding: gzip, deflate, br
 Accept-Language: zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6
@@ -60,6 +63,12 @@ print(headers_dict)
 
 
 class TestDownloader(IsolatedAsyncioTestCase):
+    def setUp(self):
+        PluginMeta.plugins[LogPlugin.name] = LogPlugin
+
+    def tearDown(self):
+        PluginMeta.plugins.pop(LogPlugin.name)
+
     async def test_download(self):
         async with CoreProcess(
             Config(
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+from pygetex.core.events import Event, EventHub
+
+from helpers import make_config, start_app
+
+
+def event(type: str, taskid: int, **data) -> Event:
+    return Event(type, taskid, 0.0, data)
+
+
+class TestSubscription(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.process = CoreProcess(
+            make_config(
+                self.tmp.name,
+                event_queue_size=3,
+            )
+        )
+        self.hub = self.process.event_hub  # type: EventHub
+
+    async def asyncTearDown(self):
+        await self.hub.close()
+        await self.process.collector.close()
+        self.tmp.cleanup()
+
+    async def test_coalesce(self):
+        with self.hub.subscribe() as subscription:
+            for remaining in (30, 20, 10):
+                subscription.put(event("progress", 1, remaining=remaining))
+            subscription.put(event("progress", 2, remaining=5))
+            self.assertEqual(len(subscription), 2)
+            self.assertEqual((await subscription.__anext__()).data["remaining"], 10)
+            subscription.put(event("complete", 2))  # 旧的进度不要了
+            self.assertEqual(subscription.get_nowait().type, "complete")  # type: ignore
+            self.assertIsNone(subscription.get_nowait())
+
+    async def test_overflow(self):
+        with self.hub.subscribe() as subscription:
+            for taskid in range(5):
+                subscription.put(event("start", taskid))
+            self.assertEqual(len(subscription), 3)
+            first = subscription.get_nowait()
+            self.assertEqual(first.type, "overflow")  # type: ignore
+            self.assertEqual(first.data, {"dropped": 2})  # type: ignore
+            self.assertEqual(
+                [subscription.get_nowait().taskid for _ in range(3)], [2, 3, 4]  # type: ignore
+            )
+
+    async def test_filter(self):
+        with self.hub.subscribe(
+            filter=lambda e: e.type != "progress", taskids=[1]
+        ) as subscription:
+            self.hub.publish("progress", 1, remaining=1)
+            self.hub.publish("start", 2)
+            self.hub.publish("start", 1)
+            self.assertEqual(subscription.get_nowait().type, "start")  # type: ignore
+            self.assertEqual(len(subscription), 0)
+        self.assertEqual(self.hub.subscribers, set())
+
+
+class TestEvents(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(256 * 1024)
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            start = request.http_range.start or 0
+            stop = min(request.http_range.stop or len(self.data), len(self.data))
+            response = web.StreamResponse(
+                status=206 if request.http_range.start is not None else 200,
+                headers={
+                    "Accept-Ranges": "bytes",
+                    "Content-Range": f"bytes {start}-{stop - 1}/{len(self.data)}",
+                    "Content-Length": str(stop - start),
+                },
+            )
+            await response.prepare(request)
+            for offset in range(start, stop, 32 * 1024):  # 慢慢给，能看到几次进度
+                await response.write(self.data[offset : min(offset + 32 * 1024, stop)])
+                if stop - start > 1:
+                    await asyncio.sleep(0.05)
+            return response
+
+        app = web.Application()
+        app.router.add_route("*", "/{name}", handle)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/a.bin"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_stream(self):
+        config = make_config(
+            self.tmp.name,
+            split=2,
+            small_file_size=0,
+            event_interval=0.05,
+        )
+        events = []
+        async with CoreProcess(config) as process:
+
+            async def watch():
+                async for event in process.events():
+                    events.append(event)
+
+            watcher = asyncio.create_task(watch())
+            await asyncio.sleep(0)  # 先订阅上
+            (task,) = await process.add_uri(self.uri)
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+        await asyncio.wait_for(watcher, 1)  # shutdown之后async for结束
+        self.assertTrue(all(e.taskid == task.id for e in events))
+        types = [e.type for e in events]
+        self.assertEqual(types[0], "start")
+        self.assertEqual(types[-1], "complete")
+        progress = [e.data for e in events if e.type == "progress"]
+        self.assertGreaterEqual(len(progress), 2)
+        remaining = [p["remaining"] for p in progress]
+        self.assertEqual(remaining, sorted(remaining, reverse=True))
+        self.assertTrue(any(p.get("speed", 0) > 0 for p in progress))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+import aioftp  # type: ignore
+
+from pygetex.core import CoreProcess
+
+from helpers import make_config
+
+
+class TestFTPMirror(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "remote")
+        self.files = {
+            "tree/a.txt": b"a" * 100,
+            "tree/empty": b"",
+            "tree/sub/b.bin": os.urandom(2 * 1024 * 1024 + 7),  # 会分块
+            "tree/sub/deep/c.txt": b"c" * 10,
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        self.server = aioftp.Server([aioftp.User(base_path=self.root, home_path="/")])
+        await self.server.start("127.0.0.1", 0)
+        port = self.server.server.sockets[0].getsockname()[1]
+        self.uri = f"ftp://127.0.0.1:{port}/tree/"
+        self.out = os.path.join(self.tmp.name, "out")
+        os.mkdir(self.out)
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        self.tmp.cleanup()
+
+    async def mirror(self, process: CoreProcess):
+        tasks = await process.add_uri(self.uri)
+        await process.wait()
+        await asyncio.gather(*process._dispatch_tasks)
+        return tasks
+
+    async def test_mirror(self):
+        config = make_config(
+            self.tmp.name,
+            dir=self.out,
+            split=4,
+        )
+        async with CoreProcess(config) as process:
+            tasks = await self.mirror(process)
+            self.assertEqual(len(tasks), len(self.files))
+            for name, data in self.files.items():
+                with open(os.path.join(self.out, name), "rb") as f:
+                    self.assertEqual(f.read(), data)
+            for task in tasks:
+                self.assertEqual(
+                    (await process.tell_status(task.id)).status, "complete"
+                )
+
+            self.assertEqual(await self.mirror(process), [])  # 没有变化
+
+            self.files["tree/a.txt"] = b"changed"
+            with open(os.path.join(self.root, "tree/a.txt"), "wb") as f:
+                f.write(self.files["tree/a.txt"])
+            tasks = await self.mirror(process)
+            self.assertEqual(
+                [task.path for task in tasks], [os.path.join(self.out, "tree", "a.txt")]
+            )
+            with open(tasks[0].path, "rb") as f:
+                self.assertEqual(f.read(), b"changed")
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import sys
+import tempfile
+from unittest import IsolatedAsyncioTestCase, mock
+
+from aiohttp import web
+
+from pygetex.config import Config
+from pygetex.core import CoreProcess
+from pygetex.downloader import h2downloader
+from pygetex.downloader.h2downloader import H2Connection, H2Downloader
+from pygetex.handler.http import HTTPHandler
+
+from helpers import make_config, start_app
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark"
+    ),
+)
+import servers  # isort: skip
+
+
+class TestH2Downloader(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(body=b"hello", headers={"Accept-Ranges": "bytes"})
+
+        app = web.Application()
+        app.router.add_get("/", handle)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_fallback(self):
+        """明文http没开prior knowledge，退回HTTP/1.1，split不受限制"""
+        config = Config(split=8)
+        downloader = H2Downloader(config)
+        try:
+            self.assertIsNone(await downloader.stream_limit(self.uri))
+            self.assertEqual(
+                await HTTPHandler.get_split(self.uri, downloader, config), 8
+            )
+            status, headers, body = await downloader.download(self.uri)
+            self.assertEqual(status, 200)
+            self.assertEqual(b"".join([chunk async for chunk in body]), b"hello")
+            await body.close()
+        finally:
+            await downloader.close()
+
+    async def test_not_h2(self):
+        """prior knowledge打到HTTP/1.1服务器上，连接直接失败"""
+        config = Config(http2_prior_knowledge=True)
+        downloader = H2Downloader(config)
+        try:
+            with self.assertRaises(Exception):
+                await downloader.download(self.uri)
+        finally:
+            await downloader.close()
+
+
+class TestH2(IsolatedAsyncioTestCase):
+    """
+    打benchmark里的h2c服务器
+    """
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.size = 1024 * 1024 + 7
+        self.max_streams = 8
+        self.server, port = await servers.start_h2_server(
+            "127.0.0.1", 0, servers.ServerOptions(max_streams=self.max_streams)
+        )
+        self.uri = f"http://127.0.0.1:{port}/files/{self.size}/a.bin"
+        self.connections = []  # 每次open_connection
+        self.requests = []  # (连接, Range, 发出请求之后连接上的stream数)
+        open_connection = h2downloader.open_connection
+        request = H2Connection.request
+
+        async def counting_open_connection(*args, **kwargs):
+            self.connections.append(args[:2])
+            return await open_connection(*args, **kwargs)
+
+        async def recording_request(connection, method, path, headers, payload=None):
+            stream = await request(connection, method, path, headers, payload)
+            self.requests.append((connection, headers.get("Range"), connection.active))
+            return stream
+
+        self.patches = [
+            mock.patch.object(
+                h2downloader, "open_connection", counting_open_connection
+            ),
+            mock.patch.object(H2Connection, "request", recording_request),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    async def asyncTearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.close()
+        await self.server.wait_closed()
+        self.tmp.cleanup()
+
+    def config(self, **kwargs) -> Config:
+        return make_config(
+            self.tmp.name,
+            small_file_size=0,
+            http2_prior_knowledge=True,
+            http_downloader="pygetex.downloader.h2downloader.H2Downloader",
+            **kwargs,
+        )
+
+    async def download(self, config: Config) -> None:
+        async with CoreProcess(config) as process:
+            (task,) = await process.add_uri(self.uri)
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            self.assertEqual((await process.tell_status(task.id)).status, "complete")
+        with open(os.path.join(self.tmp.name, "a.bin"), "rb") as f:
+            self.assertEqual(f.read(), servers.payload(0, self.size))
+
+    def block_requests(self):
+        return [r for r in self.requests if r[1] not in (None, "bytes=0-0")]
+
+    async def test_multiplex(self):
+        """所有block都在同一条连接上，窗口很小也要把数据收全"""
+        await self.download(self.config(split=4, http2_window=16 * 1024))
+        blocks = self.block_requests()
+        self.assertEqual(len(blocks), 4)
+        # 探测元数据用的是共用的downloader，任务自己的downloader只开了一条连接
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(len({connection for connection, _, _ in blocks}), 1)
+        self.assertGreater(max(active for _, _, active in blocks), 1)  # 真的并发了
+
+    async def test_stream_limit(self):
+        """split超过服务器的MAX_CONCURRENT_STREAMS，按stream上限分块"""
+        config = self.config(split=self.max_streams * 2)
+        downloader = H2Downloader(config)
+        try:
+            self.assertEqual(await downloader.stream_limit(self.uri), self.max_streams)
+            self.assertEqual(
+                await HTTPHandler.get_split(self.uri, downloader, config),
+                self.max_streams,
+            )
+        finally:
+            await downloader.close()
+        downloader = H2Downloader(self.config(split=32, http2_connections=2))
+        try:
+            self.assertEqual(
+                await downloader.stream_limit(self.uri), self.max_streams * 2
+            )
+        finally:
+            await downloader.close()
+
+        self.requests.clear()
+        await self.download(config)
+        blocks = self.block_requests()
+        self.assertEqual(len(blocks), self.max_streams)
+        self.assertLessEqual(max(active for _, _, active in blocks), self.max_streams)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import tempfile
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from pygetex.config import Config
+from pygetex.core import CoreProcess
+from pygetex.core.loop import run
+
+from helpers import make_config
+
+
+class TestLoopMonitor(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    def block_the_loop(self):
+        time.sleep(0.3)  # 同步的pwrite或者插件
+
+    async def test_stall(self):
+        config = make_config(
+            self.tmp.name,
+            loop_monitor_interval=0.02,
+            loop_slow_threshold=0.05,
+        )
+        async with CoreProcess(config) as process:
+            await asyncio.sleep(0.1)
+            self.block_the_loop()
+            await asyncio.sleep(0.1)
+            stats = (await process.get_global_stat())["loop"]
+            self.assertGreaterEqual(stats["stalls"], 1)
+            self.assertGreater(stats["lag_max"], 0.2)
+            self.assertIn("block_the_loop", stats["slow_callbacks"][0]["stack"])
+            metrics = process.get_metrics()
+            self.assertEqual(
+                metrics["pygetex_loop_stalls_total"][0][1], stats["stalls"]
+            )
+
+
+class Policy(asyncio.DefaultEventLoopPolicy):
+    pass
+
+
+class TestEventLoop(TestCase):
+    def tearDown(self):
+        asyncio.set_event_loop_policy(None)
+
+    def test_policy_path(self):
+        config = Config(event_loop=f"{__name__}.Policy")
+
+        async def main():
+            return asyncio.get_event_loop_policy()
+
+        self.assertIsInstance(run(main(), config), Policy)
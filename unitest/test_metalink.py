@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+from pygetex.fileio.postprocess import pieces
+from pygetex.plugin import PluginMeta
+from pygetex.plugin.metalink import MetalinkParser, MetalinkPlugin
+
+from helpers import make_config, start_app
+
+# 只在这里的测试启用，不影响别的测试数plugin
+PluginMeta.plugins.pop(MetalinkPlugin.name)
+
+PIECE = 256 * 1024
+
+
+def manifest(files, base) -> bytes:
+    entries = []
+    for name, data in files.items():
+        hashes = "".join(
+            f"<hash>{hashlib.sha1(data[i : i + PIECE]).hexdigest()}</hash>"
+            for i in range(0, len(data), PIECE)
+        )
+        entries.append(f"""<file name="{name}">
+  <size>{len(data)}</size>
+  <hash type="sha-256">{hashlib.sha256(data).hexdigest()}</hash>
+  <pieces length="{PIECE}" type="sha-1">{hashes}</pieces>
+  <url priority="2">{base}/m2/{name}</url>
+  <url priority="1">{base}/m1/{name}</url>
+  <metaurl mediatype="torrent" priority="3">{base}/{name}.torrent</metaurl>
+</file>""")
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<metalink xmlns="urn:ietf:params:xml:ns:metalink">'
+        + "".join(entries)
+        + '<file name="../evil"><url>http://example.com/evil</url></file>'
+        "</metalink>"
+    ).encode()
+
+
+class TestParser(TestCase):
+    def test_streaming(self):
+        files = {"a.bin": os.urandom(PIECE + 10), "sub/b.txt": b"hello"}
+        data = manifest(files, "http://mirror")
+        parser = MetalinkParser()
+        result = []
+        for i in range(0, len(data), 50):
+            result.extend(parser.feed(data[i : i + 50]))
+        result.extend(parser.close())
+        # ../evil跳过
+        self.assertEqual([f.name for f in result], ["a.bin", "sub/b.txt"])
+        first = result[0]
+        self.assertEqual(first.size, PIECE + 10)
+        self.assertEqual(
+            first.urls, ["http://mirror/m1/a.bin", "http://mirror/m2/a.bin"]
+        )
+        self.assertEqual(first.hash[0], "sha256")  # type: ignore
+        self.assertEqual(first.pieces[0], "sha1")  # type: ignore
+        self.assertEqual(len(first.pieces[2]), 2)  # type: ignore
+
+    def test_pieces(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "a.bin")
+            data = os.urandom(3 * 100 + 7)
+            hashes = [
+                hashlib.sha1(data[i : i + 100]).hexdigest()
+                for i in range(0, len(data), 100)
+            ]
+            with open(path, "wb") as f:
+                f.write(data)
+            pieces(path, 100, hashes)
+            hashes[2] = "0" * 40
+            with self.assertRaisesRegex(ValueError, r"bad pieces \[2\]"):
+                pieces(path, 100, hashes)
+
+
+class TestMetalinkDownload(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        PluginMeta.plugins[MetalinkPlugin.name] = MetalinkPlugin
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = {
+            "a.bin": os.urandom(2 * 1024 * 1024 + 3),
+            "sub/b.txt": b"hello metalink",
+        }
+        self.requests = []  # (method, path, range)
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            self.requests.append(
+                (request.method, request.path, request.headers.get("Range"))
+            )
+            if request.path == "/files.meta4":
+                return web.Response(body=manifest(self.files, self.base))
+            mirror, name = request.path[1:].split("/", 1)
+            if mirror == "m1" and request.http_range.start:  # 首选镜像有的block会失败
+                return web.Response(status=503, body=b"<html>busy</html>")
+            data = self.files[name]
+            start = request.http_range.start or 0
+            stop = min(request.http_range.stop or len(data), len(data))
+            status = 206 if request.http_range.start is not None else 200
+            return web.Response(
+                status=status,
+                body=data[start:stop],
+                headers={
+                    "Accept-Ranges": "bytes",
+                    "Content-Range": f"bytes {start}-{stop - 1}/{len(data)}",
+                },
+            )
+
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handle)
+        self.runner, self.base = await start_app(app)
+
+    async def asyncTearDown(self):
+        PluginMeta.plugins.pop(MetalinkPlugin.name)
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_download(self):
+        config = make_config(
+            self.tmp.name,
+            split=4,
+        )
+        async with CoreProcess(config) as process:
+            tasks = await process.add_uri(f"{self.base}/files.meta4")
+            self.assertEqual(len(tasks), 2)
+            self.assertEqual(
+                sorted(task.filesize for task in tasks),
+                sorted(len(data) for data in self.files.values()),
+            )
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            for name, data in self.files.items():
+                with open(os.path.join(self.tmp.name, *name.split("/")), "rb") as f:
+                    self.assertEqual(f.read(), data)
+            for task in tasks:
+                self.assertEqual(
+                    (await process.tell_status(task.id)).status, "complete"
+                )
+        probes = [r for r in self.requests if r[0] == "HEAD" or r[2] == "bytes=0-0"]
+        self.assertEqual(probes, [])  # 大小从清单里来，不探测
+        self.assertTrue(any(r[1].startswith("/m2/") for r in self.requests))
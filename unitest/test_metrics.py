@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from pygetex.core import CoreProcess
+from pygetex.core.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+from helpers import make_config
+
+
+class TestMetrics(TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        counter = registry.register(Counter("bytes", "received", ("host",)))
+        gauge = registry.register(Gauge("tasks", "active", func=lambda: 3))
+        histogram = registry.register(
+            Histogram("latency", "write", ("fileio",), buckets=(0.1, 1.0))
+        )
+        counter.labels("a").inc(10)
+        counter.labels("a").inc(5)
+        histogram.labels("sysio").observe(0.05)
+        histogram.labels("sysio").observe(0.5)
+        histogram.labels("sysio").observe(5)
+
+        collected = registry.collect()
+        self.assertEqual(collected["bytes_total"], [({"host": "a"}, 15)])
+        self.assertEqual(collected["tasks"], [({}, 3.0)])
+        self.assertEqual(collected["latency_count"], [({"fileio": "sysio"}, 3)])
+
+        text = registry.render()
+        self.assertIn('bytes_total{host="a"} 15\n', text)
+        self.assertIn('latency_bucket{fileio="sysio",le="0.1"} 1\n', text)
+        self.assertIn('latency_bucket{fileio="sysio",le="1.0"} 2\n', text)
+        self.assertIn('latency_bucket{fileio="sysio",le="+Inf"} 3\n', text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+    def test_labels(self):
+        counter = Counter("bytes", "received", ("protocol", "host"))
+        self.assertIs(counter.labels("http", "a"), counter.labels("http", "a"))
+        with self.assertRaises(ValueError):
+            counter.labels("http")
+
+
+class TestMetricsServer(IsolatedAsyncioTestCase):
+    async def test_endpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = make_config(tmp, metrics_port=0)
+            async with CoreProcess(config) as process:
+                self.assertEqual((await process.get_global_stat())["num_active"], 0)
+                reader, writer = await asyncio.open_connection(
+                    "127.0.0.1", process._metrics_server.port  # type: ignore
+                )
+                writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                response = await reader.read()
+                writer.close()
+                self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+                self.assertIn(b"pygetex_active_tasks 0\n", response)
+                self.assertIn(b"pygetex_db_seconds_count", response)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
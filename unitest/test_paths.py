@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+from pygetex.core.paths import PathRegistry
+
+from helpers import make_config, start_app
+
+
+class TestPathRegistry(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_numbering(self):
+        open(os.path.join(self.dir, "a.zip"), "wb").close()
+        open(os.path.join(self.dir, "a(2).zip"), "wb").close()
+        registry = PathRegistry()
+        paths = [registry.reserve(self.dir, "a.zip") for _ in range(3)]
+        self.assertEqual(
+            [os.path.basename(path) for path in paths],
+            ["a(1).zip", "a(3).zip", "a(4).zip"],
+        )
+        self.assertEqual(
+            registry.reserve(self.dir, "b.zip"), os.path.join(self.dir, "b.zip")
+        )
+
+    def test_bulk(self):
+        registry = PathRegistry()
+        paths = {registry.reserve(self.dir, "same.bin") for _ in range(5000)}
+        self.assertEqual(len(paths), 5000)
+        self.assertIn(os.path.join(self.dir, "same(4999).bin"), paths)
+
+    def test_created_after_scan(self):
+        registry = PathRegistry()
+        registry.reserve(self.dir, "x.txt")  # 扫描目录
+        open(os.path.join(self.dir, "y.txt"), "wb").close()
+        self.assertEqual(
+            registry.reserve(self.dir, "y.txt"), os.path.join(self.dir, "y(1).txt")
+        )
+
+    def test_subdir(self):
+        registry = PathRegistry()
+        self.assertEqual(
+            registry.reserve(self.dir, "sub/a.txt"),
+            os.path.join(self.dir, "sub", "a.txt"),
+        )
+        self.assertEqual(
+            registry.reserve(self.dir, "sub/a.txt"),
+            os.path.join(self.dir, "sub", "a(1).txt"),
+        )
+
+    def test_release(self):
+        registry = PathRegistry()
+        paths = [registry.reserve(self.dir, "a.zip") for _ in range(4)]
+        registry.release(paths[0])
+        registry.release(paths[2])
+        self.assertEqual(registry.reserve(self.dir, "a.zip"), paths[0])
+        self.assertEqual(registry.reserve(self.dir, "a.zip"), paths[2])
+        self.assertEqual(
+            registry.reserve(self.dir, "a.zip"), os.path.join(self.dir, "a(4).zip")
+        )
+        open(paths[1], "wb").close()  # 文件还在磁盘上就不能再分配
+        registry.release(paths[1])
+        self.assertEqual(
+            registry.reserve(self.dir, "a.zip"), os.path.join(self.dir, "a(5).zip")
+        )
+
+
+class TestRelease(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            if request.http_range.start is not None:
+                return web.Response(
+                    status=206,
+                    body=b"x",
+                    headers={"Accept-Ranges": "bytes", "Content-Range": "bytes 0-0/10"},
+                )
+            return web.Response(status=503, body=b"<html>busy</html>")
+
+        app = web.Application()
+        app.router.add_get("/{name}", handle)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/a.zip"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_remove(self):
+        async with CoreProcess(make_config(self.tmp.name)) as process:
+            task = await process.submit_uri(self.uri)
+            self.assertEqual(os.path.basename(task.path), "a.zip")  # type: ignore
+            await process.remove(task.id)
+            task = await process.submit_uri(self.uri)
+            self.assertEqual(os.path.basename(task.path), "a.zip")  # type: ignore
+            await process.stop(task.id)
+            task = await process.submit_uri(self.uri)
+            self.assertEqual(os.path.basename(task.path), "a.zip")  # type: ignore
+
+    async def test_error(self):
+        """出错的任务还能unpause，路径不能给新任务"""
+        async with CoreProcess(make_config(self.tmp.name)) as process:
+            (failed,) = await process.add_uri(self.uri)
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            self.assertEqual((await process.tell_status(failed.id)).status, "error")
+            (task,) = await process.add_uri(self.uri)
+            self.assertEqual(os.path.basename(task.path), "a(1).zip")  # type: ignore
+            await process.unpause(failed.id)
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            self.assertEqual((await process.tell_status(failed.id)).path, failed.path)
+            (task,) = await process.add_uri(self.uri)
+            self.assertEqual(os.path.basename(task.path), "a(2).zip")  # type: ignore
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from aiohttp import web
+
+from pygetex.config import Config
+from pygetex.core import CoreProcess
+from pygetex.utils.misc import get_written_ranges
+
+from helpers import make_config, start_app
+
+PIECE = 64 * 1024
+
+
+class TestWrittenRanges(TestCase):
+    def test_ranges(self):
+        self.assertEqual(
+            get_written_ranges([[10, 19], [25, 29], [30, 29]], 40),
+            [[0, 9], [20, 24], [30, 39]],
+        )
+        self.assertEqual(get_written_ranges([[0, 39]], 40), [])
+
+
+class TestPeer(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(5 * PIECE + 7)
+        self.hashes = [
+            hashlib.sha1(self.data[i : i + PIECE]).hexdigest()
+            for i in range(0, len(self.data), PIECE)
+        ]
+        self.requests = []  # 源站收到的(method, range)
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            self.requests.append((request.method, request.headers.get("Range")))
+            start = request.http_range.start or 0
+            stop = min(request.http_range.stop or len(self.data), len(self.data))
+            return web.Response(
+                status=206 if request.http_range.start is not None else 200,
+                body=self.data[start:stop],
+                headers={
+                    "Accept-Ranges": "bytes",
+                    "Content-Range": f"bytes {start}-{stop - 1}/{len(self.data)}",
+                },
+            )
+
+        app = web.Application()
+        app.router.add_route("*", "/{name}", handle)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/toolchain.tar"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    def config(self, name: str, **kwargs) -> Config:
+        path = os.path.join(self.tmp.name, name)
+        os.mkdir(path)
+        return make_config(
+            path,
+            split=4,
+            small_file_size=0,
+            **{"peer_token": "secret", **kwargs},
+        )
+
+    def origin_downloads(self):
+        return [r for r in self.requests if r[0] == "GET" and r[1] != "bytes=0-0"]
+
+    async def download(self, process: CoreProcess, **options) -> str:
+        (task,) = await process.add_uri(self.uri, **options)
+        await process.wait()
+        await asyncio.gather(*process._dispatch_tasks)
+        self.assertEqual((await process.tell_status(task.id)).status, "complete")
+        with open(task.path, "rb") as f:  # type: ignore
+            self.assertEqual(f.read(), self.data)
+        return task.path  # type: ignore
+
+    async def test_fetch_from_peer(self):
+        pieces = {"op": "pieces", "length": PIECE, "hashes": self.hashes}
+        async with CoreProcess(self.config("a", peer_port=0)) as a:
+            seeded = await self.download(a, postprocess=[pieces])
+            self.assertTrue(self.origin_downloads())
+            peer = f"127.0.0.1:{a.peer_server.port}"  # type: ignore
+
+            self.requests.clear()
+            async with CoreProcess(self.config("b", peers=[peer])) as b:
+                await self.download(b, postprocess=[pieces])
+            self.assertEqual(self.origin_downloads(), [])  # 全部从peer拿
+
+            with open(seeded, "r+b") as f:  # peer上的第2个piece坏了
+                f.seek(PIECE + 1)
+                f.write(bytes([self.data[PIECE + 1] ^ 0xFF]))
+            self.requests.clear()
+            async with CoreProcess(self.config("c", peers=[peer])) as c:
+                await self.download(c, postprocess=[pieces])
+            self.assertTrue(self.origin_downloads())  # 坏的那段回源站
+
+    async def test_trust(self):
+        async with CoreProcess(self.config("a", peer_port=0)) as a:
+            await self.download(a)
+            peer = f"127.0.0.1:{a.peer_server.port}"  # type: ignore
+            self.requests.clear()
+            async with CoreProcess(self.config("b", peers=[peer])) as b:
+                await self.download(b)  # 没有hash不用peer
+            self.assertTrue(self.origin_downloads())
+            self.requests.clear()
+            async with CoreProcess(
+                self.config("c", peers=[peer], peer_trust=True)
+            ) as c:
+                await self.download(c)
+            self.assertEqual(self.origin_downloads(), [])
+
+    async def test_auth(self):
+        with self.assertRaises(ValueError):  # 没有token也没有allow不启动
+            async with CoreProcess(self.config("x", peer_port=0, peer_token=None)):
+                pass
+        pieces = {"op": "pieces", "length": PIECE, "hashes": self.hashes}
+        async with CoreProcess(self.config("a", peer_port=0)) as a:
+            await self.download(a, postprocess=[pieces])
+            peer = f"127.0.0.1:{a.peer_server.port}"  # type: ignore
+            self.requests.clear()
+            async with CoreProcess(
+                self.config("b", peers=[peer], peer_token="wrong")
+            ) as b:
+                await self.download(b, postprocess=[pieces])
+            self.assertTrue(self.origin_downloads())  # 403了回源站
+
+        async with CoreProcess(
+            self.config("c", peer_port=0, peer_token=None, peer_allow=["10.0.0.0/8"])
+        ) as c:
+            await self.download(c, postprocess=[pieces])
+            peer = f"127.0.0.1:{c.peer_server.port}"  # type: ignore
+            self.requests.clear()
+            async with CoreProcess(self.config("d", peers=[peer])) as d:
+                await self.download(d, postprocess=[pieces])
+                self.assertEqual(len(d.peers._have), 1)  # type: ignore
+                d.peers._have[self.uri] = (0, d.peers._have[self.uri][1])  # type: ignore
+                await d.peers.have("http://127.0.0.1/other")  # type: ignore
+                self.assertEqual(
+                    list(d.peers._have), ["http://127.0.0.1/other"]  # type: ignore
+                )  # 过期的清掉了
+            self.assertTrue(self.origin_downloads())  # 127.0.0.1不在allow里
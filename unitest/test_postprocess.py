@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tarfile
+import tempfile
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+from pygetex.fileio.postprocess import run_step
+
+from helpers import make_config, start_app
+
+
+def make_tar_gz(files: dict) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def slow_step(path: str, log: str) -> None:
+    """
+    在进程池里跑，第一次调用的时候慢一点，让测试有机会在这一步中间重启
+    """
+    with open(log, "a") as f:
+        f.write("x")
+    if os.path.getsize(log) == 1:
+        time.sleep(1)
+    return None
+
+
+class TestSteps(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "a.txt.gz")
+        with open(self.path, "wb") as f:
+            f.write(gzip.compress(b"hello"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_checksum(self):
+        digest = hashlib.sha256(open(self.path, "rb").read()).hexdigest()
+        self.assertEqual(
+            run_step(self.path, {"op": "checksum", "digest": digest}), self.path
+        )
+        with self.assertRaises(ValueError):
+            run_step(self.path, {"op": "checksum", "digest": "0" * 64})
+
+    def test_gunzip_move(self):
+        path = run_step(self.path, {"op": "gunzip"})
+        self.assertEqual(path, os.path.join(self.tmp.name, "a.txt"))
+        self.assertFalse(os.path.exists(self.path))
+        path = run_step(path, {"op": "move", "to": os.path.join(self.tmp.name, "b/c")})
+        with open(os.path.join(self.tmp.name, "b", "c"), "rb") as f:
+            self.assertEqual(f.read(), b"hello")
+
+    def test_untar(self):
+        path = os.path.join(self.tmp.name, "x.tar.gz")
+        with open(path, "wb") as f:
+            f.write(make_tar_gz({"d/1.txt": b"1"}))
+        dest = run_step(path, {"op": "untar", "remove": True})
+        self.assertEqual(dest, os.path.join(self.tmp.name, "x"))
+        with open(os.path.join(dest, "d", "1.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"1")
+        self.assertFalse(os.path.exists(path))
+
+    def test_call(self):
+        self.assertEqual(
+            run_step(self.path, {"op": "call", "func": "os.path.dirname"}),
+            self.tmp.name,
+        )
+        with self.assertRaises(ValueError):
+            run_step(self.path, {"op": "nope"})
+
+
+class TestPipeline(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = {"pkg/data.bin": os.urandom(100000), "pkg/readme": b"hi"}
+        self.archive = make_tar_gz(self.files)
+        www = os.path.join(self.tmp.name, "www")
+        os.mkdir(www)
+        with open(os.path.join(www, "pkg.tar.gz"), "wb") as f:
+            f.write(self.archive)
+        app = web.Application()
+        app.router.add_static("/", www)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/pkg.tar.gz"
+        self.out = os.path.join(self.tmp.name, "out")
+        os.mkdir(self.out)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_pipeline(self):
+        config = make_config(
+            self.tmp.name,
+            dir=self.out,
+            postprocess_workers=1,
+        )
+        async with CoreProcess(config) as process:
+            digest = hashlib.sha256(self.archive).hexdigest()
+            (ok,) = await process.add_uri(
+                self.uri,
+                postprocess=[
+                    {"op": "checksum", "digest": digest},
+                    {"op": "untar", "remove": True},
+                    {"op": "move", "to": os.path.join(self.out, "final")},
+                ],
+            )
+            (bad,) = await process.add_uri(
+                self.uri, postprocess=[{"op": "checksum", "digest": "0" * 64}]
+            )
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+
+            ok = await process.tell_status(ok.id)
+            self.assertEqual(ok.status, "complete")
+            self.assertEqual(ok.path, os.path.join(self.out, "final"))
+            for name, data in self.files.items():
+                with open(os.path.join(ok.path, name), "rb") as f:
+                    self.assertEqual(f.read(), data)
+            self.assertEqual((await process.tell_status(bad.id)).status, "error")
+            self.assertEqual(process.collector.processing, {})
+
+    async def test_restart(self):
+        """后处理做到一半退出，重启之后从没做完的那一步接着做"""
+        config = make_config(self.tmp.name, dir=self.out, postprocess_workers=1)
+        log = os.path.join(self.tmp.name, "slow.log")
+        final = os.path.join(self.out, "final")
+        os.mkdir(final)
+        steps = [
+            {"op": "move", "to": final},
+            {
+                "op": "call",
+                "func": "test_postprocess.slow_step",
+                "kwargs": {"log": log},
+            },
+            {"op": "checksum", "digest": hashlib.sha256(self.archive).hexdigest()},
+        ]
+        async with CoreProcess(config) as process:
+            (task,) = await process.add_uri(self.uri, postprocess=steps)
+            while not os.path.exists(log):  # 第二步开始了
+                await asyncio.sleep(0.05)
+        with sqlite3.connect(os.path.join(self.tmp.name, "pyget.db")) as db:
+            status, path, options = db.execute(
+                "SELECT status, path, options FROM download_task WHERE id = ?",
+                (task.id,),
+            ).fetchone()
+        self.assertEqual(status, "processing")
+        self.assertEqual(path, os.path.join(final, "pkg.tar.gz"))
+        self.assertEqual(
+            json.loads(options)["postprocess_done"], 2
+        )  # 退出前做完了第二步
+
+        async with CoreProcess(config) as process:
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            status = await process.tell_status(task.id)
+            self.assertEqual(status.status, "complete")
+            self.assertEqual(status.path, os.path.join(final, "pkg.tar.gz"))
+        with open(log) as f:
+            self.assertEqual(f.read(), "x")  # 做完的步骤没有重做
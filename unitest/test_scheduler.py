@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+from pygetex.task import DownloadTask
+
+from helpers import make_config, start_app
+
+
+class TestScheduler(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = make_config(
+            self.tmp.name,
+            max_concurrent_downloads=1,
+        )
+        self.process = CoreProcess(self.config)
+        self.scheduler = self.process.scheduler
+        self.started = []  # (taskid, resume)
+        self.release = {}  # type: dict
+
+    async def asyncTearDown(self):
+        for taskid in self.release:
+            self.process.collector.task_discard(taskid)  # 没写进数据库的假任务
+        await self.process.shutdown()
+        self.tmp.cleanup()
+
+    def add(self, taskid: int, host: str = "a", filesize: int = 100, **options):
+        task = DownloadTask(
+            id=taskid,
+            uri=f"http://{host}/{taskid}",
+            filesize=filesize,
+            path=f"{self.tmp.name}/{taskid}",
+            support_range=True,
+            options=options,
+        )
+        self.release[taskid] = asyncio.Event()
+
+        async def start(resume: bool = False):
+            self.started.append((taskid, resume))
+            await self.release[taskid].wait()
+
+        return asyncio.create_task(self.scheduler.run(task, start))
+
+    async def settle(self):
+        for _ in range(20):  # 让排到的任务真的开始
+            await asyncio.sleep(0)
+
+    async def finish(self, taskid: int, aiotask: asyncio.Task):
+        self.release[taskid].set()
+        await aiotask
+        await self.settle()
+
+    async def test_priority(self):
+        first = self.add(1)
+        await self.settle()
+        low = self.add(2)
+        high = self.add(3, priority=5)
+        await self.settle()
+        self.assertEqual(self.started, [(1, False), (3, False)])  # 1被抢占
+        self.assertEqual(self.scheduler.tell_waiting(), [1, 2])
+        collected = self.process.metrics.registry.collect()
+        self.assertEqual(collected["pygetex_pending_tasks"], [({}, 2)])
+        await self.finish(3, high)
+        await self.finish(1, first)
+        await self.finish(2, low)
+        self.assertEqual(self.started, [(1, False), (3, False), (1, True), (2, False)])
+
+    async def test_no_preempt_same_priority(self):
+        first = self.add(1)
+        await self.settle()
+        second = self.add(2)
+        await self.settle()
+        self.assertEqual(self.started, [(1, False)])
+        await self.finish(1, first)
+        await self.finish(2, second)
+        self.assertEqual(self.started, [(1, False), (2, False)])
+
+    async def test_host_round_robin(self):
+        aiotasks = {1: self.add(1, "a")}
+        await self.settle()
+        for taskid, host in ((2, "a"), (3, "a"), (4, "b")):
+            aiotasks[taskid] = self.add(taskid, host)
+        await self.settle()
+        for _ in range(4):
+            taskid = self.started[-1][0]
+            await self.finish(taskid, aiotasks[taskid])
+        self.assertEqual([taskid for taskid, _ in self.started], [1, 4, 2, 3])
+
+    async def test_srpt(self):
+        self.config.schedule_policy = "srpt"
+        aiotasks = {1: self.add(1)}
+        await self.settle()
+        aiotasks[2] = self.add(2, filesize=1000)
+        aiotasks[3] = self.add(3, filesize=10)
+        await self.settle()
+        for _ in range(3):
+            taskid = self.started[-1][0]
+            await self.finish(taskid, aiotasks[taskid])
+        self.assertEqual([taskid for taskid, _ in self.started], [1, 3, 2])
+
+    async def test_preempt(self):
+        low = self.add(1)
+        await self.settle()
+        high = self.add(2, priority=1)
+        await self.settle()
+        self.assertEqual(self.started, [(1, False), (2, False)])
+        await self.finish(2, high)
+        await self.settle()
+        self.assertEqual(self.started[-1], (1, True))  # 断点续传
+        await self.finish(1, low)
+
+    async def test_update(self):
+        first = self.add(1)
+        second = self.add(2)
+        third = self.add(3)
+        await self.settle()
+        self.scheduler.update(3, priority=1)
+        self.assertEqual(self.scheduler.tell_waiting(), [3, 2])
+        self.scheduler.update(1, priority=-1)  # 正在下载的降下来，被抢占
+        await self.settle()
+        self.assertEqual(self.started[-1], (3, False))
+        await self.finish(3, third)
+        await self.finish(2, second)
+        await self.finish(1, first)
+        self.assertEqual(self.started[-1], (1, True))
+
+    async def test_cancel_waiting(self):
+        first = self.add(1)
+        second = self.add(2)
+        await self.settle()
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        self.assertEqual(self.scheduler.tell_waiting(), [])
+        self.assertEqual(self.scheduler.num_waiting(), 0)
+        await self.finish(1, first)
+        self.assertEqual(self.started, [(1, False)])
+
+    async def test_deadline(self):
+        aiotasks = {1: self.add(1, "a")}
+        await self.settle()
+        aiotasks[2] = self.add(2, "b")  # 按轮流该轮到b了
+        aiotasks[3] = self.add(3, "a", deadline=time.time())  # 已经赶不上了
+        await self.settle()
+        for _ in range(3):
+            taskid = self.started[-1][0]
+            await self.finish(taskid, aiotasks[taskid])
+        self.assertEqual([taskid for taskid, _ in self.started], [1, 3, 2])
+
+
+class TestQueuedResume(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = {name: os.urandom(4 * 1024 * 1024) for name in ("a", "b")}
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            data = self.files[request.match_info["name"]]
+            start = request.http_range.start or 0
+            stop = min(request.http_range.stop or len(data), len(data))
+            response = web.StreamResponse(
+                status=206 if request.http_range.start is not None else 200,
+                headers={
+                    "Accept-Ranges": "bytes",
+                    "Content-Range": f"bytes {start}-{stop - 1}/{len(data)}",
+                    "Content-Length": str(stop - start),
+                },
+            )
+            await response.prepare(request)
+            for offset in range(start, stop, 256 * 1024):
+                await response.write(data[offset : min(offset + 256 * 1024, stop)])
+                await asyncio.sleep(0.02)
+            return response
+
+        app = web.Application()
+        app.router.add_route("*", "/{name}", handle)
+        self.runner, self.base = await start_app(app)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_close_with_queued_task(self):
+        config = make_config(self.tmp.name, max_concurrent_downloads=1, split=2)
+        async with CoreProcess(config) as process:
+            tasks = []
+            for name in self.files:
+                tasks.extend(await process.add_uri(f"{self.base}/{name}"))
+            await asyncio.sleep(0.1)
+            self.assertEqual(process.scheduler.tell_waiting(), [tasks[1].id])
+        queued = tasks[1].path + config.tempfile_suffix  # type: ignore
+        self.assertFalse(os.path.exists(queued))  # 排队的任务不存进度
+
+        async with CoreProcess(config) as process:
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            for task, data in zip(tasks, self.files.values()):
+                status = await process.tell_status(task.id)  # type: ignore
+                self.assertEqual(status.status, "complete")
+                with open(task.path, "rb") as f:  # type: ignore
+                    self.assertEqual(f.read(), data)
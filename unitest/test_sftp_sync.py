@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+import asyncssh
+
+from pygetex.core import CoreProcess
+
+from helpers import make_config
+
+
+class NoAuthServer(asyncssh.SSHServer):
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        return True
+
+
+class TestSFTPSync(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "remote")
+        self.files = {
+            "data/log.txt": b"line\n" * 1000,
+            "data/sub/big.bin": os.urandom(2 * 1024 * 1024 + 7),  # 会分块
+            "data/sub/small.txt": b"small",
+        }
+        for name, data in self.files.items():
+            self.write(name, data, "wb")
+        self.server = await asyncssh.create_server(
+            NoAuthServer,
+            "127.0.0.1",
+            0,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+            sftp_factory=lambda chan: asyncssh.SFTPServer(
+                chan, chroot=self.root.encode()
+            ),
+        )
+        port = self.server.sockets[0].getsockname()[1]
+        self.uri = f"sftp://127.0.0.1:{port}/data/"
+        self.out = os.path.join(self.tmp.name, "out")
+        os.mkdir(self.out)
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.tmp.cleanup()
+
+    def write(self, name: str, data: bytes, mode: str):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode) as f:
+            f.write(data)
+
+    async def sync(self, process: CoreProcess):
+        tasks = await process.add_uri(self.uri)
+        await process.wait()
+        await asyncio.gather(*process._dispatch_tasks)
+        return tasks
+
+    async def test_sync(self):
+        config = make_config(
+            self.tmp.name,
+            dir=self.out,
+            split=4,
+            username="user",
+            password="password",
+            known_hosts=None,
+        )
+        async with CoreProcess(config) as process:
+            tasks = await self.sync(process)
+            self.assertEqual(len(tasks), len(self.files))
+            for name, data in self.files.items():
+                with open(os.path.join(self.out, name), "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+            self.assertEqual(await self.sync(process), [])  # 没有变化
+
+            received = process.metrics.received_bytes.labels("sftp", "127.0.0.1")
+            before = received.value
+            self.write("data/log.txt", b"appended\n", "ab")
+            self.write("data/sub/small.txt", b"other", "wb")  # 大小一样内容不同
+            os.utime(os.path.join(self.root, "data/sub/small.txt"), (0, 0))
+            tasks = await self.sync(process)
+            self.assertEqual(
+                sorted(os.path.relpath(task.path, self.out) for task in tasks),
+                [
+                    os.path.join("data", "log.txt"),
+                    os.path.join("data", "sub", "small.txt"),
+                ],
+            )
+            with open(os.path.join(self.out, "data", "log.txt"), "rb") as f:
+                self.assertEqual(f.read(), b"line\n" * 1000 + b"appended\n")
+            with open(os.path.join(self.out, "data", "sub", "small.txt"), "rb") as f:
+                self.assertEqual(f.read(), b"other")
+            self.assertEqual(received.value - before, len(b"appended\n") + 5)
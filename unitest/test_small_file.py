@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+
+from helpers import make_config, start_app
+
+
+class TestSmallFile(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(10 * 1024)
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            name = request.match_info["name"]
+            if request.http_range.start is not None:  # 探测大小的bytes=0-0都正常
+                return web.Response(
+                    status=206,
+                    body=self.data[:1],
+                    headers={
+                        "Accept-Ranges": "bytes",
+                        "Content-Range": f"bytes 0-0/{len(self.data)}",
+                    },
+                )
+            if name == "busy.bin":
+                return web.Response(status=503, body=b"<html>busy</html>")
+            if name == "short.bin":
+                return web.Response(body=self.data[:-100])
+            return web.Response(body=self.data)
+
+        app = web.Application()
+        app.router.add_get("/{name}", handle)
+        self.runner, self.base = await start_app(app)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def download(self, name: str) -> str:
+        async with CoreProcess(make_config(self.tmp.name)) as process:
+            (task,) = await process.add_uri(f"{self.base}/{name}")
+            await process.wait()
+            await asyncio.gather(*process._dispatch_tasks)
+            return (await process.tell_status(task.id)).status
+
+    async def test_ok(self):
+        self.assertEqual(await self.download("ok.bin"), "complete")
+        with open(os.path.join(self.tmp.name, "ok.bin"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "ok.bin.part")))
+
+    async def test_bad_response(self):
+        for name in ("busy.bin", "short.bin"):
+            self.assertEqual(await self.download(name), "error")
+            self.assertFalse(os.path.exists(os.path.join(self.tmp.name, name)))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, mock
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+
+from helpers import make_config, start_app
+
+PIECE = 256 * 1024
+
+
+class TestStream(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(2 * 1024 * 1024 + 7)
+        self.ranges = []  # 请求过的Range起点
+
+        async def handle(request: web.Request) -> web.StreamResponse:
+            if request.http_range.start is None:
+                start, end = 0, len(self.data)
+                resp = web.StreamResponse(headers={"Accept-Ranges": "bytes"})
+            else:
+                start = request.http_range.start
+                end = min(request.http_range.stop or len(self.data), len(self.data))
+                resp = web.StreamResponse(
+                    status=206,
+                    headers={
+                        "Accept-Ranges": "bytes",
+                        "Content-Range": f"bytes {start}-{end - 1}/{len(self.data)}",
+                    },
+                )
+            resp.content_length = end - start
+            await resp.prepare(request)
+            if request.method == "GET":
+                if end - start > 1:  # 不算探测元数据的bytes=0-0
+                    self.ranges.append(start)
+                for offset in range(start, end, 64 * 1024):
+                    await asyncio.sleep(0.01)
+                    await resp.write(self.data[offset : min(offset + 64 * 1024, end)])
+            return resp
+
+        app = web.Application()
+        app.router.add_route("*", "/file.bin", handle)
+        self.runner, base = await start_app(app)
+        self.uri = f"{base}/file.bin"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_stream(self):
+        config = make_config(
+            self.tmp.name,
+            split=4,
+            stream_piece_size=PIECE,
+            stream_poll_interval=0.01,
+        )
+        async with CoreProcess(config) as process:
+            (task,) = await process.add_uri(self.uri, sequential=True)
+            received = bytearray()
+            early = None
+            async for chunk in process.open_stream(task.id, chunk_size=100000):
+                if early is None:
+                    early = task.id in process._pending_tasks  # 下载完之前就读到了
+                received += chunk
+            self.assertTrue(early)
+            self.assertEqual(bytes(received), self.data)
+            self.assertEqual(self.ranges, sorted(self.ranges))  # 从前往后下载
+            self.assertEqual(len(self.ranges), -(-len(self.data) // PIECE))
+
+            with mock.patch.dict(os.__dict__):
+                del os.pread  # windows上没有
+                async for chunk in process.open_stream(
+                    task.id, offset=len(self.data) - 7
+                ):
+                    self.assertEqual(chunk, self.data[-7:])  # 下载完了也能读
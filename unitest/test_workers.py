@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from pygetex.core import CoreProcess
+
+from helpers import make_config, start_app
+
+
+class TestWorkerPool(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(3 * 1024 * 1024 + 123)
+        with open(os.path.join(self.tmp.name, "src.bin"), "wb") as f:
+            f.write(self.data)
+        self.slow = asyncio.Event()  # set之前/slow.bin只给一点点
+
+        async def slow(request: web.Request) -> web.StreamResponse:
+            start = request.http_range.start or 0
+            stop = min(request.http_range.stop or len(self.data), len(self.data))
+            response = web.StreamResponse(
+                status=206 if request.http_range.start is not None else 200,
+                headers={
+                    "Accept-Ranges": "bytes",
+                    "Content-Range": f"bytes {start}-{stop - 1}/{len(self.data)}",
+                    "Content-Length": str(stop - start),
+                },
+            )
+            await response.prepare(request)
+            if stop - start > 1:
+                await response.write(self.data[start : start + 1024])
+                start += 1024
+                await self.slow.wait()
+            await response.write(self.data[start:stop])
+            return response
+
+        app = web.Application()
+        app.router.add_get("/slow.bin", slow)
+        app.router.add_static("/", self.tmp.name)  # FileResponse自带Range支持
+        self.runner, self.base = await start_app(app)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_download(self):
+        out = os.path.join(self.tmp.name, "out")
+        os.mkdir(out)
+        config = make_config(
+            self.tmp.name,
+            dir=out,
+            split=4,
+            workers=2,
+        )
+        async with CoreProcess(config) as process:
+            self.assertIsNotNone(process.workers)
+            tasks = await process.add_uri(f"{self.base}/src.bin")
+            await process.wait()
+            self.assertEqual(len(tasks), 1)
+            with open(tasks[0].path, "rb") as f:
+                self.assertEqual(f.read(), self.data)
+            received = process.metrics.received_bytes.labels("http", "127.0.0.1")
+            self.assertEqual(received.value, len(self.data))
+        self.assertIsNone(process.workers)
+
+    async def test_worker_killed(self):
+        out = os.path.join(self.tmp.name, "out")
+        os.mkdir(out)
+        config = make_config(
+            self.tmp.name,
+            dir=out,
+            split=4,
+            workers=2,
+        )
+        async with CoreProcess(config) as process:
+            workers = process.workers
+            assert workers is not None
+            (task,) = await process.add_uri(f"{self.base}/slow.bin")
+            for _ in range(100):  # 等两个worker都领到block
+                if all(workers._load):
+                    break
+                await asyncio.sleep(0.05)
+            victim = workers._processes[0]
+            victim.kill()  # 下到一半被杀
+            await asyncio.wait_for(process.wait(), 10)
+            await asyncio.gather(*process._dispatch_tasks)
+            self.assertEqual((await process.tell_status(task.id)).status, "error")
+            self.assertIsNot(workers._processes[0], victim)  # 拉起来了新的
+            self.assertTrue(workers._processes[0].is_alive())
+            self.assertEqual(workers._load[0], 0)  # 死掉的worker手上的block都失败了
+
+            self.slow.set()
+            tasks = await process.add_uri(f"{self.base}/src.bin")
+            await process.wait()
+            with open(tasks[0].path, "rb") as f:
+                self.assertEqual(f.read(), self.data)